@@ -0,0 +1,194 @@
+import io
+import os
+import sys
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from be import serve
+from be.model import admission
+from be.model import error
+from be.model.aio import store as aio_store
+from be.model.aio.user import User
+from be.view import aio
+from be.view import token_check
+from be.view import admission as admission_view
+
+# ASGI入口：uvicorn be.asgi:app --workers 4
+# 下单、付款、认证等接口（be/view/aio.py）在事件循环中直接处理，等待Mongo时不占用线程；
+# 其余接口（搜索、分面、补全、相似图书、/metrics）交给Flask应用，在线程池中执行。
+
+# 处理未改写接口的线程数，默认不少于搜索类请求的并发上限，放行的请求不必再在线程池中排队
+FALLBACK_THREADS = int(os.environ.get(
+    "BOOKSTORE_ASGI_FALLBACK_THREADS", str(max(8, admission.controller.search_limit))
+))
+
+flask_app = serve.create_app()
+fallback_pool = ThreadPoolExecutor(max_workers=FALLBACK_THREADS, thread_name_prefix="wsgi")
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def respond(send, status: int, body: bytes, headers: [(bytes, bytes)]):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def respond_json(send, data: dict, status: int, headers: [(bytes, bytes)] = ()):
+    headers = [(b"content-type", b"application/json")] + list(headers)
+    await respond(send, status, json.dumps(data).encode("utf-8"), headers)
+
+
+async def respond_overloaded(send, e: admission.Overloaded):
+    code, message = error.error_overloaded(e.retry_after)
+    await respond_json(send, {"message": message}, code, [(b"retry-after", str(e.retry_after).encode())])
+
+
+def endpoint_of(scope: dict) -> str:
+    # 按Flask的路由表找出端点名，路径不存在时返回None
+    try:
+        endpoint, _ = flask_app.url_map.bind("localhost").match(scope["path"], scope["method"])
+    except Exception:
+        return None
+    return endpoint
+
+
+def wsgi_environ(scope: dict, body: bytes) -> dict:
+    server = scope.get("server") or ("127.0.0.1", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def call_wsgi(environ: dict) -> (int, [(bytes, bytes)], bytes):
+    # 在线程池中执行Flask应用，收集完整的响应
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started["status"], started["headers"], body
+
+
+async def handle_native(scope: dict, receive, send, endpoint: str, handler):
+    try:
+        body = json.loads(await read_body(receive) or b"null")
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        await respond_json(send, {"message": "Invalid JSON body"}, 400)
+        return
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    try:
+        ticket = await admission.controller.admit_async(endpoint)
+    except admission.Overloaded as e:
+        await respond_overloaded(send, e)
+        return
+    try:
+        # 与Flask的before_request相同：非公开接口先校验令牌
+        if endpoint not in token_check.PUBLIC_ENDPOINTS:
+            code, message = await User().check_token(body.get("user_id"), headers.get("token"))
+            if code != 200:
+                await respond_json(send, {"message": message}, code)
+                return
+        data, code = await handler(body, headers)
+    except Exception as e:
+        logging.exception("unhandled error in {}".format(scope["path"]))
+        await respond_json(send, {"message": "{}".format(str(e))}, 500)
+        return
+    finally:
+        admission.controller.release(ticket)
+    await respond_json(send, data, code)
+
+
+async def handle_fallback(scope: dict, receive, send):
+    # 在事件循环中排队等待放行，被拒绝的请求不占用线程池
+    endpoint = endpoint_of(scope)
+    ticket = None
+    if endpoint is not None:
+        try:
+            ticket = await admission.controller.admit_async(endpoint)
+        except admission.Overloaded as e:
+            await respond_overloaded(send, e)
+            return
+    try:
+        body = await read_body(receive)
+        environ = wsgi_environ(scope, body)
+        environ[admission_view.ADMITTED] = True
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(fallback_pool, call_wsgi, environ)
+    finally:
+        admission.controller.release(ticket)
+    await respond(send, status, content, headers)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # 同步连接（后台任务、未改写接口）和异步连接都在工作进程中创建；同步初始化会访问数据库，
+            # 在线程中执行，不阻塞事件循环。迁移事先由python -m be.migrate apply执行一次，工作进程不迁移；
+            # ASGI服务器通常有多个工作进程，缓存失效总是在进程间共享
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, lambda: serve.init_worker(singleton=serve.acquire_singleton(), migrate=False, shared=True)
+            )
+            aio_store.init_database()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, serve.stop_background_tasks)
+            await aio_store.close_database()
+            await loop.run_in_executor(None, lambda: fallback_pool.shutdown(wait=True))
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    route = aio.ROUTES.get(scope["path"])
+    if route is not None and scope["method"] == "POST":
+        await handle_native(scope, receive, send, *route)
+    else:
+        await handle_fallback(scope, receive, send)
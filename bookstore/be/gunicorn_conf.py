@@ -0,0 +1,10 @@
+import os
+from be.model.store import prepare_database
+
+# gunicorn配置：gunicorn -c python:be.gunicorn_conf -w 4 --threads 8 -b 0.0.0.0:5000 be.wsgi:app
+# 迁移在主进程启动时同步执行一次，工作进程（be/wsgi.py）不再各自迁移。
+
+
+def on_starting(server):
+    # 主进程中的连接在迁移完成后即关闭，fork出的工作进程不会继承
+    prepare_database(os.path.dirname(os.path.dirname(__file__)))
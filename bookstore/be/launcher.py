@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.serving import WSGIRequestHandler
+from be import serve
+from be.model import admission
+from be.model import error
+from be.model.store import prepare_database
+
+# 预fork多进程启动器：python -m be.launcher --workers 4 --threads 8
+# 主进程完成迁移、绑定端口后fork出工作进程，各工作进程在fork之后创建自己的MongoClient，
+# 共享同一个监听套接字，由内核在进程间分配连接。
+
+WORKERS = int(os.environ.get("BOOKSTORE_WORKERS", str(os.cpu_count() or 1)))
+THREADS = int(os.environ.get("BOOKSTORE_THREADS", "8"))
+# 收到SIGTERM后等待处理中请求完成的最长秒数，超时的工作进程被强制结束
+DRAIN_TIMEOUT = float(os.environ.get("BOOKSTORE_DRAIN_TIMEOUT", "30"))
+# 工作进程意外退出后等待多少秒再重启：从RESPAWN_DELAY开始，连续退出时逐次加倍，最长RESPAWN_MAX；
+# 运行超过RESPAWN_MAX秒后才退出的视为偶发故障，重新从RESPAWN_DELAY开始
+RESPAWN_DELAY = 0.5
+RESPAWN_MAX = 30.0
+
+
+class RequestHandler(WSGIRequestHandler):
+    # 每个连接处理一个请求后关闭，空闲的keep-alive连接不会长期占用线程池中的线程
+    protocol_version = "HTTP/1.0"
+
+
+# 线程池全部占满时直接返回的响应，不解析请求内容
+OVERLOADED_BODY = json.dumps({"message": error.error_overloaded(1)[1]}).encode()
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Type: application/json\r\n"
+    + "Content-Length: {}\r\n\r\n".format(len(OVERLOADED_BODY)).encode()
+    + OVERLOADED_BODY
+)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """用固定大小的线程池处理连接的WSGI服务器
+
+    werkzeug的ThreadedWSGIServer每个连接新建一个线程；线程池限制了单个进程的并发数，
+    shutdown()之后不再接受新连接，drain()等待已接受的请求处理完。
+    已接受而未完成的连接数达到线程数时，新连接不再排队，直接返回503。
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads: int, fd: int):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker")
+        # 已回复503的连接在这个线程中等待客户端关闭，不占用接受连接的线程
+        self.closer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reject")
+        self.lock = threading.Lock()
+        self.outstanding = 0
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            full = self.outstanding >= self.threads
+            if not full:
+                self.outstanding = self.outstanding + 1
+        if full:
+            self.reject(request)
+            return
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def reject(self, request):
+        # 在接受连接的线程中只做非阻塞操作：读掉已到达的请求数据，写出503并关闭写方向
+        try:
+            request.setblocking(False)
+            try:
+                request.recv(65536)
+            except BlockingIOError:
+                pass
+            request.send(OVERLOADED_RESPONSE)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.shutdown_request(request)
+            return
+        self.closer.submit(self.linger, request)
+
+    def linger(self, request):
+        # 等客户端读完响应后关闭（或超时），避免未读的请求数据使关闭连接时发出RST、客户端收不到响应
+        try:
+            request.settimeout(1.0)
+            while request.recv(65536):
+                pass
+        except OSError:
+            pass
+        finally:
+            request.close()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.outstanding = self.outstanding - 1
+
+    def drain(self):
+        self.pool.shutdown(wait=True)
+        self.closer.shutdown(wait=True)
+
+
+def run_worker(index: int, fd: int, threads: int, shared: bool):
+    # 工作进程入口；0号工作进程负责只需运行一份的后台任务
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = serve.create_app()
+    serve.init_worker(singleton=index == 0, migrate=False, shared=shared)
+    # 同时处理的请求数不超过线程数，另留出等待放行的请求所占的线程
+    admission.controller.configure(threads)
+    server = PooledWSGIServer("127.0.0.1", 0, app, threads + admission.controller.queue, fd)
+
+    def on_term(signum, frame):
+        # serve_forever在主线程中运行，shutdown()必须从其他线程调用
+        threading.Thread(target=server.shutdown, name="drain", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_term)
+    server.serve_forever()
+    server.drain()
+    serve.stop_background_tasks()
+    logging.info("worker %d drained", index)
+
+
+class Supervisor:
+    """主进程：启动工作进程，意外退出的重新启动，SIGTERM/SIGINT时转发SIGTERM并等待排空"""
+
+    def __init__(self, sock: socket.socket, workers: int, threads: int, drain_timeout: float = DRAIN_TIMEOUT):
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.drain_timeout = drain_timeout
+        self.context = multiprocessing.get_context("fork")
+        self.processes = {}
+        self.started = {}
+        self.failures = {}
+        self.respawn_at = {}
+        self.stopping = threading.Event()
+
+    def spawn(self, index: int):
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.sock.fileno(), self.threads, self.workers > 1),
+            name="worker-{}".format(index),
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.time()
+
+    def run(self):
+        for index in range(self.workers):
+            self.spawn(index)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stopping.set())
+        while not self.stopping.wait(RESPAWN_DELAY):
+            for index, process in list(self.processes.items()):
+                if not process.is_alive():
+                    self.respawn(index, process)
+        self.stop()
+
+    def respawn(self, index: int, process):
+        # 启动即崩溃的工作进程按指数退避重启，不会每秒反复fork
+        now = time.time()
+        if index not in self.respawn_at:
+            failures = 0 if now - self.started[index] > RESPAWN_MAX else self.failures.get(index, 0) + 1
+            self.failures[index] = failures
+            delay = min(RESPAWN_MAX, RESPAWN_DELAY * 2 ** min(failures, 10))
+            self.respawn_at[index] = now + delay
+            logging.error("worker %d exited with %s, restarting in %.1fs", index, process.exitcode, delay)
+        elif now >= self.respawn_at[index]:
+            del self.respawn_at[index]
+            self.spawn(index)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.time() + self.drain_timeout
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                logging.error("worker %s did not drain in %.0fs, killing", process.name, self.drain_timeout)
+                process.kill()
+                process.join()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bookstore multi-process server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--threads", type=int, default=THREADS)
+    args = parser.parse_args()
+
+    serve.init_logging()
+    # 迁移在fork之前同步完成，连接随即关闭，工作进程不继承主进程的MongoClient
+    prepare_database(os.path.dirname(os.path.dirname(__file__)))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    logging.info("listening on %s:%d with %d workers x %d threads", args.host, args.port, args.workers, args.threads)
+    Supervisor(sock, args.workers, args.threads).run()
+
+
+if __name__ == "__main__":
+    main()
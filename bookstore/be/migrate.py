@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""索引与数据迁移命令行工具
+
+    python -m be.migrate plan     查看需要执行的迁移
+    python -m be.migrate apply    执行迁移（索引构建同步完成）
+    python -m be.migrate status   查看当前数据版本
+"""
+import argparse
+import logging
+from pymongo import MongoClient
+from be.model import migration
+from be.model.store import MONGO_URI
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bookstore schema migrations")
+    parser.add_argument("command", choices=["plan", "apply", "status"])
+    parser.add_argument("--uri", default=MONGO_URI)
+    parser.add_argument("--db", default="bookstore")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    db = MongoClient(args.uri)[args.db]
+
+    if args.command == "status":
+        print("schema version: {}".format(migration.current_version(db)))
+        return
+
+    actions = migration.plan(db)
+    if not actions:
+        print("up to date")
+        return
+    for action in actions:
+        print(action)
+    if args.command == "apply":
+        migration.apply(db, actions, background=False)
+        print("applied {} actions".format(len(actions)))
+
+
+if __name__ == "__main__":
+    main()
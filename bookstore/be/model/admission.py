@@ -0,0 +1,281 @@
+import os
+import abc
+import math
+import time
+import bisect
+import asyncio
+import threading
+from be.model import metrics
+
+# 准入控制：限制同时处理的请求数，超出时在有界队列中按优先级等待，
+# 预计等不到截止时间的请求立即以503拒绝，而不是排队到客户端超时
+
+# 请求类别，数值小的优先放行
+ORDER = "order"
+DEFAULT = "default"
+SEARCH = "search"
+PRIORITY = {ORDER: 0, DEFAULT: 1, SEARCH: 2}
+
+ORDER_ENDPOINTS = {
+    "buyer.new_order",
+    "buyer.payment",
+    "buyer.cancel_order",
+    "buyer.add_funds",
+}
+SEARCH_ENDPOINTS = {
+    "buyer.search_global",
+    "buyer.search_in_store",
+    "buyer.search_batch",
+    "buyer.facets",
+    "buyer.suggest",
+    "buyer.similar",
+}
+# 不受准入控制的接口
+EXEMPT_ENDPOINTS = {"shutdown.be_shutdown", "metrics.be_metrics"}
+
+# 每个进程同时处理的请求数上限，为0时关闭准入控制
+LIMIT = int(os.environ.get("BOOKSTORE_ADMISSION_LIMIT", "32"))
+# 搜索类请求最多占用的并发数，默认为LIMIT的一半，保证下单和付款总有空位
+SEARCH_LIMIT = int(os.environ.get("BOOKSTORE_ADMISSION_SEARCH_LIMIT", "0"))
+# 单个接口的并发上限，格式为 "端点=上限,端点=上限"
+ENDPOINT_LIMITS = os.environ.get("BOOKSTORE_ADMISSION_ENDPOINT_LIMITS", "buyer.search_batch=4")
+# 等待队列的长度上限（所有类别合计）
+QUEUE = int(os.environ.get("BOOKSTORE_ADMISSION_QUEUE", "64"))
+# 各类别请求在队列中最长等待的秒数
+MAX_WAIT = {
+    ORDER: float(os.environ.get("BOOKSTORE_ADMISSION_ORDER_WAIT", "2")),
+    DEFAULT: float(os.environ.get("BOOKSTORE_ADMISSION_WAIT", "0.5")),
+    SEARCH: float(os.environ.get("BOOKSTORE_ADMISSION_WAIT", "0.5")),
+}
+
+
+def kind_of(endpoint: str) -> str:
+    if endpoint in ORDER_ENDPOINTS:
+        return ORDER
+    if endpoint in SEARCH_ENDPOINTS:
+        return SEARCH
+    return DEFAULT
+
+
+def parse_endpoint_limits(text: str) -> dict:
+    limits = {}
+    for item in text.split(","):
+        if "=" in item:
+            endpoint, limit = item.split("=", 1)
+            limits[endpoint.strip()] = int(limit)
+    return limits
+
+
+class Overloaded(Exception):
+    """请求未被放行，retry_after为建议客户端重试前等待的秒数"""
+
+    def __init__(self, retry_after: int):
+        Exception.__init__(self, "overloaded")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, endpoint: str, kind: str):
+        self.endpoint = endpoint
+        self.kind = kind
+        self.started = time.perf_counter()
+
+
+class Waiter(abc.ABC):
+    """队列中等待放行的请求；wake在放行或被挤出队列时由Controller调用（持有Controller的锁）"""
+
+    def __init__(self, ticket: Ticket, deadline: float, retry_after: int):
+        self.ticket = ticket
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.granted = False
+        self.evicted = False
+
+    @abc.abstractmethod
+    def wake(self):
+        pass
+
+
+class ThreadWaiter(Waiter):
+    def __init__(self, ticket: Ticket, deadline: float, retry_after: int):
+        Waiter.__init__(self, ticket, deadline, retry_after)
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+
+class AsyncWaiter(Waiter):
+    def __init__(self, ticket: Ticket, deadline: float, retry_after: int):
+        Waiter.__init__(self, ticket, deadline, retry_after)
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        # 可能在其他线程中被唤醒
+        self.loop.call_soon_threadsafe(self.set_result)
+
+    def set_result(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Controller:
+    """按请求类别和端点限制并发的准入控制器
+
+    放行条件：总并发未满，所在类别（搜索）和端点的并发也未满。不满足时进入按(优先级, 到达顺序)排序的队列，
+    有请求结束时按队列顺序放行能放行的等待者，下单、付款总是先于搜索。
+    入队前按该类别最近的平均处理时间估计等待时间，超过该类别的最长等待时间时立即拒绝；
+    队列已满时，新请求的优先级更高则挤掉队尾优先级最低的等待者，否则拒绝新请求。
+    """
+
+    def __init__(self, limit: int = LIMIT, search_limit: int = SEARCH_LIMIT, endpoint_limits: dict = None,
+                 queue: int = QUEUE, max_wait: dict = None):
+        self.lock = threading.Lock()
+        self.configure(limit, search_limit)
+        self.endpoint_limits = parse_endpoint_limits(ENDPOINT_LIMITS) if endpoint_limits is None else endpoint_limits
+        self.queue = queue
+        self.max_wait = dict(MAX_WAIT) if max_wait is None else max_wait
+        self.in_flight = 0
+        self.by_kind = {kind: 0 for kind in PRIORITY}
+        self.by_endpoint = {}
+        # [(优先级, 到达序号, Waiter)]
+        self.waiters = []
+        self.seq = 0
+        # 各类别处理时间的指数移动平均（秒）
+        self.service_time = {kind: 0.05 for kind in PRIORITY}
+        self.counts = {kind: {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0} for kind in PRIORITY}
+
+    def configure(self, limit: int, search_limit: int = SEARCH_LIMIT):
+        # 多进程启动器按每个工作进程的线程数设置并发上限
+        self.limit = limit
+        self.search_limit = search_limit or max(1, limit // 2)
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    def fits(self, ticket: Ticket) -> bool:
+        # 调用者持有锁
+        if self.in_flight >= self.limit:
+            return False
+        if ticket.kind == SEARCH and self.by_kind[SEARCH] >= self.search_limit:
+            return False
+        endpoint_limit = self.endpoint_limits.get(ticket.endpoint)
+        return endpoint_limit is None or self.by_endpoint.get(ticket.endpoint, 0) < endpoint_limit
+
+    def grant(self, ticket: Ticket):
+        # 调用者持有锁
+        self.in_flight = self.in_flight + 1
+        self.by_kind[ticket.kind] = self.by_kind[ticket.kind] + 1
+        self.by_endpoint[ticket.endpoint] = self.by_endpoint.get(ticket.endpoint, 0) + 1
+        self.counts[ticket.kind]["admitted"] = self.counts[ticket.kind]["admitted"] + 1
+        ticket.started = time.perf_counter()
+
+    def estimate_wait(self, kind: str) -> float:
+        # 调用者持有锁：排在前面的等待者（优先级不低于本请求）加上本请求，按该类别可用的并发数摊分
+        ahead = sum(1 for priority, _, _ in self.waiters if priority <= PRIORITY[kind]) + 1
+        capacity = self.search_limit if kind == SEARCH else self.limit
+        return ahead * self.service_time[kind] / capacity
+
+    def reject(self, kind: str, retry_after: float):
+        self.counts[kind]["rejected"] = self.counts[kind]["rejected"] + 1
+        raise Overloaded(max(1, math.ceil(retry_after)))
+
+    def enter(self, endpoint: str, waiter_type) -> (Ticket, Waiter):
+        """放行或入队；入队时返回等待者，拒绝时抛出Overloaded"""
+        ticket = Ticket(endpoint, kind_of(endpoint))
+        kind = ticket.kind
+        with self.lock:
+            if self.fits(ticket):
+                self.grant(ticket)
+                return ticket, None
+            wait = self.estimate_wait(kind)
+            if wait > self.max_wait[kind]:
+                self.reject(kind, wait)
+            if len(self.waiters) >= self.queue:
+                priority, _, last = self.waiters[-1]
+                if priority <= PRIORITY[kind]:
+                    self.reject(kind, wait)
+                del self.waiters[-1]
+                last.evicted = True
+                self.counts[last.ticket.kind]["rejected"] = self.counts[last.ticket.kind]["rejected"] + 1
+                last.wake()
+            self.seq = self.seq + 1
+            waiter = waiter_type(ticket, time.monotonic() + self.max_wait[kind], max(1, math.ceil(wait)))
+            # seq唯一，元组比较在seq处即可分出先后，不会比较到waiter（insort的key参数需要Python 3.10）
+            bisect.insort(self.waiters, (PRIORITY[kind], self.seq, waiter))
+            self.counts[kind]["queued"] = self.counts[kind]["queued"] + 1
+            return ticket, waiter
+
+    def leave(self, waiter: Waiter) -> Ticket:
+        # 等待结束（被放行、被挤出或超时）后调用
+        with self.lock:
+            if waiter.granted:
+                return waiter.ticket
+            if not waiter.evicted:
+                self.waiters = [item for item in self.waiters if item[2] is not waiter]
+                kind = waiter.ticket.kind
+                self.counts[kind]["timed_out"] = self.counts[kind]["timed_out"] + 1
+        raise Overloaded(waiter.retry_after)
+
+    def admit(self, endpoint: str) -> Ticket:
+        """阻塞直到放行，返回的Ticket在请求结束时交给release；关闭或豁免时返回None"""
+        if not self.enabled or endpoint in EXEMPT_ENDPOINTS:
+            return None
+        ticket, waiter = self.enter(endpoint, ThreadWaiter)
+        if waiter is None:
+            return ticket
+        waiter.event.wait(max(0.0, waiter.deadline - time.monotonic()))
+        return self.leave(waiter)
+
+    async def admit_async(self, endpoint: str) -> Ticket:
+        # admit的asyncio版本，等待时不占用线程
+        if not self.enabled or endpoint in EXEMPT_ENDPOINTS:
+            return None
+        ticket, waiter = self.enter(endpoint, AsyncWaiter)
+        if waiter is None:
+            return ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(0.0, waiter.deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        return self.leave(waiter)
+
+    def release(self, ticket: Ticket):
+        if ticket is None:
+            return
+        elapsed = time.perf_counter() - ticket.started
+        with self.lock:
+            self.in_flight = self.in_flight - 1
+            self.by_kind[ticket.kind] = self.by_kind[ticket.kind] - 1
+            self.by_endpoint[ticket.endpoint] = self.by_endpoint[ticket.endpoint] - 1
+            self.service_time[ticket.kind] = 0.8 * self.service_time[ticket.kind] + 0.2 * elapsed
+            self.dispatch()
+
+    def dispatch(self):
+        # 调用者持有锁：按队列顺序放行能放行的等待者，被类别或端点上限挡住的等待者不影响其后的请求
+        remaining = []
+        for item in self.waiters:
+            waiter = item[2]
+            if self.fits(waiter.ticket):
+                self.grant(waiter.ticket)
+                waiter.granted = True
+                waiter.wake()
+            else:
+                remaining.append(item)
+        self.waiters = remaining
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "queued": len(self.waiters),
+                "service_time": dict(self.service_time),
+                "counts": {kind: dict(counts) for kind, counts in self.counts.items()},
+            }
+
+
+controller = Controller()
+metrics.register("admission", controller.snapshot)
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from pymongo.errors import BulkWriteError
+from be.model import error
+from be.model import txn
+from be.model import ordering
+from be.model import search_cache
+from be.model import expiry
+from be.model.aio import db_conn
+
+
+class Buyer(db_conn.DBConn):
+    """be.model.buyer.Buyer中订单相关接口的asyncio版本
+
+    校验、订单文档和批量写请求由be.model.ordering与同步版本共用，这里只负责读写数据库：
+    互不依赖的查询用asyncio.gather同时发出，请求等待Mongo往返时不占用线程。
+    搜索、分面、补全等接口仍由同步路径处理。
+    """
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+
+    async def new_order(
+        self, user_id: str, store_id: str, id_and_count: [(str, int)]
+    ) -> (int, str, str):
+        order_id = ""
+        try:
+            user_exists, store_exists = await asyncio.gather(
+                self.user_id_exist(user_id), self.store_id_exist(store_id)
+            )
+            if not user_exists:
+                return error.error_non_exist_user_id(user_id) + (order_id,)
+            if not store_exists:
+                return error.error_non_exist_store_id(store_id) + (order_id,)
+            order_id = ordering.new_order_id(user_id, store_id)
+            current_time = datetime.now(timezone.utc)
+            payment_deadline = current_time + ordering.PAYMENT_WINDOW
+            book_counts = ordering.merge_counts(id_and_count)
+
+            async def place_order(session, undo):
+                book_details = {}
+                async for book_detail in self.conn.inventory.find(
+                    ordering.inventory_query(store_id, book_counts), ordering.INVENTORY_PROJECTION, session=session
+                ):
+                    book_details[book_detail["book_id"]] = book_detail
+                order_books = ordering.order_lines(book_counts, book_details)
+                if not order_books:
+                    return
+
+                try:
+                    await self.conn.inventory.bulk_write(
+                        ordering.decrement_requests(store_id, book_counts), ordered=True, session=session
+                    )
+                    applied = len(book_counts)
+                except BulkWriteError as e:
+                    applied = ordering.short_line(e)
+                ordering.settle_decrement(
+                    book_counts, applied, undo, lambda book_id, count: self.restore_stock_fn(store_id, book_id, count)
+                )
+
+                await self.conn.order.insert_one(
+                    ordering.order_document(order_id, user_id, store_id, order_books, current_time), session=session
+                )
+
+            await self.run_transaction(place_order)
+            await search_cache.invalidate_store_async(self.conn, store_id)
+            expiry.schedule(order_id, payment_deadline)
+        except txn.Abort as e:
+            return e.code, e.message, order_id
+        except Exception as e:
+            logging.info("528, {}".format(str(e)))
+            return 528, "{}".format(str(e)), ""
+
+        return 200, "ok", order_id
+
+    def restore_stock_fn(self, store_id: str, book_id: str, count: int):
+        async def restore():
+            await self.restore_stock([{"store_id": store_id, "books": [{"book_id": book_id, "count": count}]}])
+        return restore
+
+    async def payment(self, user_id: str, password: str, order_id: str) -> (int, str):
+        try:
+            order = await self.conn.order.find_one(
+                {"order_id": order_id},
+                {"_id": 0, "buyer_id": 1, "store_id": 1, "status": 1, "total_price": 1},
+            )
+            buyer = store_info = None
+            if order is not None and order["buyer_id"] == user_id:
+                # 买家和商店只依赖订单，同时查询
+                buyer, store_info = await asyncio.gather(
+                    self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1, "balance": 1}),
+                    self.conn.store.find_one({"store_id": order["store_id"]}, {"_id": 0, "owner_id": 1}),
+                )
+            failure = ordering.check_payment(user_id, password, order_id, order, buyer, store_info)
+            if failure is not None:
+                return failure
+
+            seller_id = store_info["owner_id"]
+            total_price = order["total_price"]
+
+            async def pay(session, undo):
+                result = await self.conn.order.update_one(
+                    {"order_id": order_id, "status": "pending"},
+                    {"$set": {"status": "paid"}},
+                    session=session,
+                )
+                if result.matched_count == 0:
+                    raise txn.Abort(*error.error_invalid_order_id(order_id))
+
+                async def reopen():
+                    await self.conn.order.update_one(
+                        {"order_id": order_id, "status": "paid"}, {"$set": {"status": "pending"}}
+                    )
+                undo.append(reopen)
+
+                result = await self.conn.user.update_one(
+                    {"user_id": user_id, "balance": {"$gte": total_price}},
+                    {"$inc": {"balance": -total_price}},
+                    session=session,
+                )
+                if result.matched_count == 0:
+                    raise txn.Abort(*error.error_not_sufficient_funds(order_id))
+
+                async def refund():
+                    await self.conn.user.update_one({"user_id": user_id}, {"$inc": {"balance": total_price}})
+                undo.append(refund)
+
+                result = await self.conn.user.update_one(
+                    {"user_id": seller_id},
+                    {"$inc": {"balance": total_price}},
+                    session=session,
+                )
+                if result.matched_count == 0:
+                    raise txn.Abort(*error.error_non_exist_user_id(seller_id))
+
+            await self.run_transaction(pay)
+            expiry.discard(order_id)
+        except txn.Abort as e:
+            return e.code, e.message
+        except Exception as e:
+            return 528, "{}".format(str(e))
+
+        return 200, "ok"
+
+    async def add_funds(self, user_id, password, add_value) -> (int, str):
+        try:
+            user = await self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1})
+            if user is None:
+                return error.error_non_exist_user_id(user_id)
+            if user["password"] != password:
+                return error.error_authorization_fail()
+
+            result = await self.conn.user.update_one({"user_id": user_id}, {"$inc": {"balance": add_value}})
+            if result.matched_count == 0:
+                return error.error_non_exist_user_id(user_id)
+        except Exception as e:
+            return 528, "{}".format(str(e))
+
+        return 200, "ok"
+
+    async def receive(self, user_id: str, order_id: str) -> (int, str):
+        try:
+            order = await self.conn.order.find_one({"order_id": order_id}, {"_id": 0, "buyer_id": 1, "status": 1})
+            failure = ordering.check_owner(user_id, order_id, order)
+            if failure is not None:
+                return failure
+
+            result = await self.conn.order.update_one(
+                {"order_id": order_id, "status": "sent"}, {"$set": {"status": "received"}}
+            )
+            if result.matched_count == 0:
+                return error.error_invalid_order_id(order_id)
+        except Exception as e:
+            return 528, "{}".format(str(e))
+
+        return 200, "ok"
+
+    async def query_order(self, user_id: str, order_id: str) -> (int, str, dict):
+        try:
+            order = await self.conn.order.find_one({"order_id": order_id}, {"_id": 0})
+            failure = ordering.check_owner(user_id, order_id, order)
+            if failure is not None:
+                return failure + ({},)
+            data = ordering.order_view(order)
+        except Exception as e:
+            return 528, "{}".format(str(e)), {}
+
+        return 200, "ok", data
+
+    async def cancel_order(self, user_id: str, order_id: str, password: str) -> (int, str):
+        try:
+            # 订单和买家密码互不依赖，同时查询
+            order, buyer = await asyncio.gather(
+                self.conn.order.find_one({"order_id": order_id}, {"_id": 0, "buyer_id": 1, "status": 1}),
+                self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1}),
+            )
+            failure = ordering.check_cancel(user_id, password, order_id, order, buyer)
+            if failure is not None:
+                return failure
+
+            async def cancel(session, undo):
+                order = await self.cancel_pending_order({"order_id": order_id}, session, undo)
+                if order is None:
+                    raise txn.Abort(*error.error_invalid_order_id(order_id))
+                return order
+
+            order = await self.run_transaction(cancel)
+            await search_cache.invalidate_store_async(self.conn, order["store_id"])
+            expiry.discard(order_id)
+        except txn.Abort as e:
+            return e.code, e.message
+        except Exception as e:
+            return 528, "{}".format(str(e))
+
+        return 200, "ok"
@@ -0,0 +1,54 @@
+from be.model import txn
+from be.model import ordering
+from be.model.aio import store
+
+
+class DBConn:
+    """be.model.db_conn.DBConn的asyncio版本，self.conn为AsyncMongoClient的数据库"""
+
+    def __init__(self):
+        self.conn = store.get_db()
+
+    async def run_transaction(self, body):
+        # 在多文档事务（或补偿模式）中执行 await body(session, undo)
+        return await txn.run_async(self.conn.client, body, store.use_transaction())
+
+    async def user_id_exist(self, user_id):
+        user = await self.conn.user.find_one({"user_id": user_id}, {"_id": 1})
+        return user is not None
+
+    async def book_id_exist(self, store_id, book_id):
+        # 在inventory集合中查询该商店是否上架了这本书
+        book = await self.conn.inventory.find_one({"store_id": store_id, "book_id": book_id}, {"_id": 1})
+        return book is not None
+
+    async def store_id_exist(self, store_id):
+        store_doc = await self.conn.store.find_one({"store_id": store_id}, {"_id": 1})
+        return store_doc is not None
+
+    async def restore_stock(self, orders, session=None):
+        # 一次bulk_write恢复一批订单中所有书籍的库存，orders中每项包含store_id和内嵌的books明细
+        requests = ordering.restock_requests(orders)
+        if requests:
+            await self.conn.inventory.bulk_write(requests, ordered=False, session=session)
+
+    async def cancel_pending_order(self, condition: dict, session=None, undo=None, restore=True):
+        # 单文档原子更新：把满足条件的待付款订单改为已取消，restore为True时同时恢复库存
+        order = await self.conn.order.find_one_and_update(
+            dict(condition, status="pending"),
+            {"$set": {"status": "canceled"}},
+            projection=ordering.CANCEL_PROJECTION,
+            session=session,
+        )
+        if order is None:
+            return None
+        if undo is not None:
+            async def reopen():
+                await self.conn.order.update_one(
+                    {"order_id": order["order_id"], "status": "canceled"},
+                    {"$set": {"status": "pending"}},
+                )
+            undo.append(reopen)
+        if restore:
+            await self.restore_stock([order], session=session)
+        return order
@@ -0,0 +1,134 @@
+import json
+import asyncio
+from pymongo.errors import DuplicateKeyError
+from be.model import error
+from be.model import picture
+from be.model import catalog
+from be.model import search_cache
+from be.model import ngram
+from be.model import facet
+from be.model import suggest
+from be.model import similar
+from be.model.aio import db_conn
+
+
+def index_listing(book: dict, new_book: bool):
+    # 更新进程内的检索、相似图书和补全索引；这些索引在构建或拉取新书时会长时间持有各自的锁，
+    # 因此在线程池中执行，不阻塞事件循环
+    if new_book:
+        ngram.index_book(book)
+        similar.index_book(book)
+    suggest.record_listing(book)
+
+
+class Seller(db_conn.DBConn):
+    """be.model.seller.Seller的asyncio版本"""
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+
+    async def add_book(
+        self,
+        user_id: str,
+        store_id: str,
+        book_id: str,
+        book_json_str: str,
+        stock_level: int,
+    ):
+        try:
+            # 用户、商店、是否已上架和书目四个查询互不依赖，同时发出
+            user_exists, store_exists, book_exists, book = await asyncio.gather(
+                self.user_id_exist(user_id),
+                self.store_id_exist(store_id),
+                self.book_id_exist(store_id, book_id),
+                self.conn.catalog.find_one({"_id": book_id}, dict(facet.BOOK_FIELDS, title=1, author=1)),
+            )
+            if not user_exists:
+                return error.error_non_exist_user_id(user_id)
+            if not store_exists:
+                return error.error_non_exist_store_id(store_id)
+            if book_exists:
+                return error.error_exist_book_id(book_id)
+
+            book_info = json.loads(book_json_str)
+            new_book = False
+            if book is None:
+                picture_ids = await picture.put_pictures_async(self.conn, book_info.get("pictures", []))
+                book = catalog.catalog_document(book_id, book_info, picture_ids)
+                result = await self.conn.catalog.update_one({"_id": book_id}, {"$setOnInsert": book}, upsert=True)
+                new_book = result.upserted_id is not None
+
+            price = book_info.get("price", 0)
+            await self.conn.inventory.insert_one(catalog.inventory_document(store_id, book_id, price, stock_level))
+            await facet.record_listing_async(self.conn, store_id, book, price)
+            await asyncio.get_running_loop().run_in_executor(None, index_listing, book, new_book)
+            await search_cache.invalidate_store_async(self.conn, store_id, membership_changed=True)
+        except DuplicateKeyError:
+            return error.error_exist_book_id(book_id)
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
+
+    async def add_stock_level(
+        self, user_id: str, store_id: str, book_id: str, add_stock_level: int
+    ):
+        try:
+            user_exists, store_exists = await asyncio.gather(
+                self.user_id_exist(user_id), self.store_id_exist(store_id)
+            )
+            if not user_exists:
+                return error.error_non_exist_user_id(user_id)
+            if not store_exists:
+                return error.error_non_exist_store_id(store_id)
+
+            result = await self.conn.inventory.update_one(
+                {"store_id": store_id, "book_id": book_id},
+                {"$inc": {"stock_level": add_stock_level}},
+            )
+            if result.matched_count == 0:
+                return error.error_non_exist_book_id(book_id)
+            await search_cache.invalidate_store_async(self.conn, store_id)
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
+
+    async def create_store(self, user_id: str, store_id: str) -> (int, str):
+        try:
+            user_exists, store_exists = await asyncio.gather(
+                self.user_id_exist(user_id), self.store_id_exist(store_id)
+            )
+            if not user_exists:
+                return error.error_non_exist_user_id(user_id)
+            if store_exists:
+                return error.error_exist_store_id(store_id)
+            await self.conn.store.insert_one({"store_id": store_id, "owner_id": user_id, "is_open": True})
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
+
+    async def send(self, user_id: str, order_id: str) -> (int, str):
+        try:
+            user_exists, order = await asyncio.gather(
+                self.user_id_exist(user_id),
+                self.conn.order.find_one({"order_id": order_id}, {"_id": 0, "store_id": 1}),
+            )
+            if not user_exists:
+                return error.error_non_exist_user_id(user_id)
+            if order is None:
+                return error.error_invalid_order_id(order_id)
+
+            store_id = order["store_id"]
+            store_info = await self.conn.store.find_one({"store_id": store_id}, {"_id": 0, "owner_id": 1})
+            if store_info is None:
+                return error.error_non_exist_store_id(store_id)
+            if store_info["owner_id"] != user_id:
+                return error.error_authorization_fail()
+
+            result = await self.conn.order.update_one(
+                {"order_id": order_id, "status": "paid"}, {"$set": {"status": "sent"}}
+            )
+            if result.matched_count == 0:
+                return error.error_invalid_order_id(order_id)
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
@@ -0,0 +1,39 @@
+from pymongo import AsyncMongoClient
+from be.model import store
+
+# asyncio请求路径使用的AsyncMongoClient；由ASGI应用启动时（已在工作进程的事件循环中）创建。
+# 集合、索引和迁移仍由同步的store.init_database负责，这里只建立连接
+
+
+class AsyncStore:
+    def __init__(self):
+        self.client = AsyncMongoClient(store.MONGO_URI)
+        self.db = self.client['bookstore']
+
+    def get_db(self):
+        return self.db
+
+
+database_instance: AsyncStore = None
+
+
+def init_database():
+    global database_instance
+    database_instance = AsyncStore()
+
+
+async def close_database():
+    global database_instance
+    if database_instance is not None:
+        await database_instance.client.close()
+        database_instance = None
+
+
+def get_db():
+    global database_instance
+    return database_instance.get_db()
+
+
+def use_transaction() -> bool:
+    # 与同步路径使用同一个检测结果
+    return store.use_transaction()
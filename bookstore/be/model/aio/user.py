@@ -0,0 +1,114 @@
+import time
+from be.model import error
+from be.model import token_cache
+from be.model import session
+from be.model.user import jwt_encode, terminal_of, token_expires_at
+from be.model.aio import db_conn
+
+
+class User(db_conn.DBConn):
+    """be.model.user.User的asyncio版本，与同步版本共用令牌校验、令牌缓存和会话格式"""
+
+    token_lifetime: int = session.TOKEN_LIFETIME
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+
+    async def register(self, user_id: str, password: str):
+        try:
+            result = await self.conn.user.insert_one({"user_id": user_id, "password": password, "balance": 0})
+            if not result.acknowledged:
+                return error.error_exist_user_id(user_id)
+        except Exception:
+            return error.error_exist_user_id(user_id)
+        return 200, "ok"
+
+    async def check_token(self, user_id: str, token: str) -> (int, str):
+        if not user_id or not token:
+            return error.error_authorization_fail()
+        if await token_cache.cache.get_async(self.conn, user_id, token):
+            return 200, "ok"
+        generation = await token_cache.cache.snapshot_generation_async(self.conn, user_id)
+
+        terminal = terminal_of(user_id, token)
+        if terminal is None:
+            return error.error_authorization_fail()
+        row = await self.conn.session.find_one({"user_id": user_id, "terminal": terminal}, {"_id": 0, "token": 1})
+        if row is None:
+            return error.error_authorization_fail()
+        expires_at = token_expires_at(user_id, row["token"], token, self.token_lifetime)
+        if expires_at is None:
+            return error.error_authorization_fail()
+        token_cache.cache.put(user_id, token, expires_at, generation)
+        return 200, "ok"
+
+    async def check_password(self, user_id: str, password: str) -> (int, str):
+        user = await self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1})
+        if user is None or password != user["password"]:
+            return error.error_authorization_fail()
+        return 200, "ok"
+
+    async def login(self, user_id: str, password: str, terminal: str) -> (int, str, str):
+        try:
+            code, message = await self.check_password(user_id, password)
+            if code != 200:
+                return code, message, ""
+
+            token = jwt_encode(user_id, terminal)
+            previous = await self.conn.session.find_one_and_update(
+                {"user_id": user_id, "terminal": terminal},
+                {"$set": {"token": token, "expires_at": session.expires_at(time.time())}},
+                projection={"_id": 0, "token": 1},
+                upsert=True,
+            )
+            if previous is not None:
+                await token_cache.cache.invalidate_async(self.conn, user_id, previous["token"])
+        except Exception as e:
+            return 528, "{}".format(str(e)), ""
+        return 200, "ok", token
+
+    async def logout(self, user_id: str, token: str) -> (int, str):
+        try:
+            code, message = await self.check_token(user_id, token)
+            if code != 200:
+                return code, message
+
+            result = await self.conn.session.delete_one(
+                {"user_id": user_id, "terminal": terminal_of(user_id, token), "token": token}
+            )
+            await token_cache.cache.invalidate_async(self.conn, user_id, token)
+            if result.deleted_count == 0:
+                return error.error_authorization_fail()
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
+
+    async def unregister(self, user_id: str, password: str) -> (int, str):
+        try:
+            code, message = await self.check_password(user_id, password)
+            if code != 200:
+                return code, message
+
+            result = await self.conn.user.delete_one({"user_id": user_id})
+            await self.conn.session.delete_many({"user_id": user_id})
+            await token_cache.cache.invalidate_async(self.conn, user_id)
+            if result.deleted_count != 1:
+                return error.error_authorization_fail()
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
+
+    async def change_password(self, user_id: str, old_password: str, new_password: str) -> (int, str):
+        try:
+            code, message = await self.check_password(user_id, old_password)
+            if code != 200:
+                return code, message
+
+            result = await self.conn.user.update_one({"user_id": user_id}, {"$set": {"password": new_password}})
+            await self.conn.session.delete_many({"user_id": user_id})
+            await token_cache.cache.invalidate_async(self.conn, user_id)
+            if result.matched_count == 0:
+                return error.error_authorization_fail()
+        except Exception as e:
+            return 528, "{}".format(str(e))
+        return 200, "ok"
@@ -1,9 +1,17 @@
-import uuid
-import json
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+from pymongo.errors import BulkWriteError
 from be.model import db_conn
 from be.model import error
+from be.model import txn
+from be.model import ordering
+from be.model import search
+from be.model import search_cache
+from be.model import expiry
+from be.model import facet
+from be.model import suggest
+from be.model import similar
+from be.model import cursor as cursor_token
 
 
 class Buyer(db_conn.DBConn):
@@ -19,126 +27,115 @@ class Buyer(db_conn.DBConn):
                 return error.error_non_exist_user_id(user_id) + (order_id,)
             if not self.store_id_exist(store_id):
                 return error.error_non_exist_store_id(store_id) + (order_id,)
-            uid = "{}_{}_{}".format(user_id, store_id, str(uuid.uuid1()))
-            order_id = uid  # 提前设置order_id，以便错误返回时使用
-            order_records = []
-            current_time = datetime.now()
-            # 设置支付截止时间（一小时后）
-            payment_deadline = current_time + timedelta(hours=1)
-
-            for book_id, count in id_and_count:
-                # 直接从book集合查询书籍信息和库存
-                book_detail = self.conn.book.find_one({
-                    "book_id": book_id,
-                    "belong_store_id": store_id
-                })
-                
-                if book_detail is None:
-                    return error.error_non_exist_book_id(book_id) + (order_id,)
-                
-                stock_level = book_detail["stock_level"]
-                price = book_detail["price"]
-
-                if stock_level < count:
-                    return error.error_stock_level_low(book_id) + (order_id,)
-
-                # 更新book集合中的库存
-                result = self.conn.book.update_one(
-                    {"book_id": book_id, "belong_store_id": store_id, "stock_level": {"$gte": count}},
-                    {"$inc": {"stock_level": -count}}
+            order_id = ordering.new_order_id(user_id, store_id)  # 提前设置order_id，以便错误返回时使用
+            current_time = datetime.now(timezone.utc)
+            payment_deadline = current_time + ordering.PAYMENT_WINDOW
+            book_counts = ordering.merge_counts(id_and_count)
+
+            def place_order(session, undo):
+                # 一次$in查询取回所有书籍的价格和库存，只投影需要的字段
+                book_details = {
+                    book_detail["book_id"]: book_detail
+                    for book_detail in self.conn.inventory.find(
+                        ordering.inventory_query(store_id, book_counts), ordering.INVENTORY_PROJECTION,
+                        session=session,
+                    )
+                }
+                order_books = ordering.order_lines(book_counts, book_details)
+                if not order_books:
+                    return
+
+                # 一次有序bulk_write完成所有库存扣减，为已生效的各行登记补偿（加回库存）
+                try:
+                    self.conn.inventory.bulk_write(
+                        ordering.decrement_requests(store_id, book_counts), ordered=True, session=session
+                    )
+                    applied = len(book_counts)
+                except BulkWriteError as e:
+                    applied = ordering.short_line(e)
+                ordering.settle_decrement(
+                    book_counts, applied, undo, lambda book_id, count: self.restore_stock_fn(store_id, book_id, count)
                 )
-                if result.matched_count == 0:
-                    return error.error_stock_level_low(book_id) + (order_id,)
-
-                # 为每本书创建一条订单记录，status="pending"表示提交订单
-                order_records.append({
-                    "order_id": uid,
-                    "buyer_id": user_id,
-                    "store_id": store_id,
-                    "book_id": book_id,
-                    "count": count,
-                    "total_price": price * count,  # 添加该书籍总价（数量*单价）
-                    "status": "pending",  # 字符串描述状态：pending表示提交订单
-                    "created_at": current_time,  # 添加创建时间
-                    "payment_deadline": payment_deadline  # 添加支付截止时间
-                })
-
-            # 插入订单记录（每本书一条记录）
-            if order_records:
-                self.conn.order.insert_many(order_records)
+
+                self.conn.order.insert_one(
+                    ordering.order_document(order_id, user_id, store_id, order_books, current_time), session=session
+                )
+
+            self.run_transaction(place_order)
+            search_cache.invalidate_store(store_id)
+            # 登记付款截止时间，到期未付款由调度器自动取消
+            expiry.schedule(order_id, payment_deadline)
+        except txn.Abort as e:
+            return e.code, e.message, order_id
         except Exception as e:
             logging.info("528, {}".format(str(e)))
             return 528, "{}".format(str(e)), ""
 
         return 200, "ok", order_id
 
+    def restore_stock_fn(self, store_id: str, book_id: str, count: int):
+        def restore():
+            self.restore_stock([{"store_id": store_id, "books": [{"book_id": book_id, "count": count}]}])
+        return restore
+
     def payment(self, user_id: str, password: str, order_id: str) -> (int, str):
         try:
-            # 查询该订单的所有记录
-            orders = list(self.conn.order.find({"order_id": order_id}))
-            if not orders:
-                return error.error_invalid_order_id(order_id)
-
-            # 检查订单是否已付款
-            if orders[0].get("status") == "paid":
-                return error.error_invalid_order_id(order_id)  # 订单已处理
-
-            # 获取订单信息（从第一条记录获取buyer_id和store_id）
-            buyer_id = orders[0]["buyer_id"]
-            store_id = orders[0]["store_id"]
-
-            if buyer_id != user_id:
-                return error.error_authorization_fail()
-
-            # 查询买家信息
-            buyer = self.conn.user.find_one({"user_id": buyer_id})
-            if buyer is None:
-                return error.error_non_exist_user_id(buyer_id)
-            
-            balance = buyer["balance"]
-            if password != buyer["password"]:
-                return error.error_authorization_fail()
-
-            # 查询商店信息（获取卖家ID）
-            store_info = self.conn.store.find_one({"store_id": store_id})
-            if store_info is None:
-                return error.error_non_exist_store_id(store_id)
-
-            # 从商店信息中获取卖家ID
-            seller_id = store_info["owner_id"]
-
-            if not self.user_id_exist(seller_id):
-                return error.error_non_exist_user_id(seller_id)
-
-            # 计算订单总价：直接从订单记录中累加
-            total_price = sum(order_record["total_price"] for order_record in orders)
-
-            if balance < total_price:
-                return error.error_not_sufficient_funds(order_id)
-
-            # 扣除买家余额
-            result = self.conn.user.update_one(
-                {"user_id": buyer_id, "balance": {"$gte": total_price}},
-                {"$inc": {"balance": -total_price}}
-            )
-            if result.matched_count == 0:
-                return error.error_not_sufficient_funds(order_id)
-
-            # 增加卖家余额
-            result = self.conn.user.update_one(
-                {"user_id": seller_id},
-                {"$inc": {"balance": total_price}}
-            )
-
-            if result.matched_count == 0:
-                return error.error_non_exist_user_id(seller_id)
-
-            # 更新所有订单记录的状态为"paid"（已付款）
-            self.conn.order.update_many(
+            # 查询订单、买家和商店信息（获取卖家ID）
+            order = self.conn.order.find_one(
                 {"order_id": order_id},
-                {"$set": {"status": "paid"}}  # 字符串描述状态：paid表示付款
+                {"_id": 0, "buyer_id": 1, "store_id": 1, "status": 1, "total_price": 1},
             )
+            buyer = store_info = None
+            if order is not None and order["buyer_id"] == user_id:
+                buyer = self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1, "balance": 1})
+                store_info = self.conn.store.find_one({"store_id": order["store_id"]}, {"_id": 0, "owner_id": 1})
+            failure = ordering.check_payment(user_id, password, order_id, order, buyer, store_info)
+            if failure is not None:
+                return failure
+
+            # 订单总价在下单时已计算好；卖家是否存在由事务中给卖家加余额的更新检查
+            seller_id = store_info["owner_id"]
+            total_price = order["total_price"]
+
+            def pay(session, undo):
+                # 单文档原子更新：只有仍为待付款的订单才能改为已付款，防止重复付款
+                result = self.conn.order.update_one(
+                    {"order_id": order_id, "status": "pending"},
+                    {"$set": {"status": "paid"}},  # 字符串描述状态：paid表示付款
+                    session=session,
+                )
+                if result.matched_count == 0:
+                    raise txn.Abort(*error.error_invalid_order_id(order_id))
+                undo.append(lambda: self.conn.order.update_one(
+                    {"order_id": order_id, "status": "paid"},
+                    {"$set": {"status": "pending"}},
+                ))
+
+                # 扣除买家余额
+                result = self.conn.user.update_one(
+                    {"user_id": user_id, "balance": {"$gte": total_price}},
+                    {"$inc": {"balance": -total_price}},
+                    session=session,
+                )
+                if result.matched_count == 0:
+                    raise txn.Abort(*error.error_not_sufficient_funds(order_id))
+                undo.append(lambda: self.conn.user.update_one(
+                    {"user_id": user_id}, {"$inc": {"balance": total_price}}
+                ))
+
+                # 增加卖家余额
+                result = self.conn.user.update_one(
+                    {"user_id": seller_id},
+                    {"$inc": {"balance": total_price}},
+                    session=session,
+                )
+                if result.matched_count == 0:
+                    raise txn.Abort(*error.error_non_exist_user_id(seller_id))
 
+            self.run_transaction(pay)
+            expiry.discard(order_id)
+        except txn.Abort as e:
+            return e.code, e.message
         except Exception as e:
             return 528, "{}".format(str(e))
 
@@ -147,7 +144,7 @@ class Buyer(db_conn.DBConn):
     def add_funds(self, user_id, password, add_value) -> (int, str):
         try:
             # 查询用户信息
-            user = self.conn.user.find_one({"user_id": user_id})
+            user = self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1})
             if user is None:
                 return error.error_non_exist_user_id(user_id)
 
@@ -169,27 +166,21 @@ class Buyer(db_conn.DBConn):
 
     def receive(self, user_id: str, order_id: str) -> (int, str):
         try:
-            # 查询订单信息
-            orders = list(self.conn.order.find({"order_id": order_id}))
-            if not orders:
-                return error.error_invalid_order_id(order_id)
-
-            # 获取订单对应的买家ID
-            buyer_id = orders[0]["buyer_id"]
-            
-            # 验证用户权限
-            if buyer_id != user_id:
-                return error.error_authorization_fail()
-
-            # 检查订单状态是否为已发货
-            if orders[0].get("status") != "sent":
-                return error.error_invalid_order_id(order_id)
+            # 查询订单信息并验证用户权限
+            order = self.conn.order.find_one(
+                {"order_id": order_id}, {"_id": 0, "buyer_id": 1, "status": 1}
+            )
+            failure = ordering.check_owner(user_id, order_id, order)
+            if failure is not None:
+                return failure
 
-            # 更新订单状态为已收货
-            self.conn.order.update_many(
-                {"order_id": order_id},
+            # 单文档原子更新：只有已发货的订单可以改为已收货
+            result = self.conn.order.update_one(
+                {"order_id": order_id, "status": "sent"},
                 {"$set": {"status": "received"}}
             )
+            if result.matched_count == 0:
+                return error.error_invalid_order_id(order_id)
 
         except Exception as e:
             return 528, "{}".format(str(e))
@@ -198,45 +189,12 @@ class Buyer(db_conn.DBConn):
 
     def query_order(self, user_id: str, order_id: str) -> (int, str, dict):
         try:
-            # 查询订单信息
-            orders = list(self.conn.order.find({"order_id": order_id}))
-            if not orders:
-                return error.error_invalid_order_id(order_id) + ({},)
-
-            # 获取订单对应的买家ID
-            buyer_id = orders[0]["buyer_id"]
-            
-            # 验证用户权限
-            if buyer_id != user_id:
-                return error.error_authorization_fail() + ({},)
-
-            # 获取订单信息
-            store_id = orders[0]["store_id"]
-            status = orders[0]["status"]
-            created_at = orders[0]["created_at"]
-            
-            # 计算订单总价
-            total_price = sum(order["total_price"] for order in orders)
-            
-            # 构造书籍列表
-            books = []
-            for order in orders:
-                books.append({
-                    "book_id": order["book_id"],
-                    "count": order["count"],
-                    "price": order["total_price"]
-                })
-            
-            # 构造返回数据
-            data = {
-                "order_id": order_id,
-                "buyer_id": buyer_id,
-                "store_id": store_id,
-                "status": status,
-                "created_at": created_at.isoformat() if hasattr(created_at, 'isoformat') else str(created_at),
-                "books": books,
-                "total_price": total_price
-            }
+            # 查询订单信息并验证用户权限
+            order = self.conn.order.find_one({"order_id": order_id}, {"_id": 0})
+            failure = ordering.check_owner(user_id, order_id, order)
+            if failure is not None:
+                return failure + ({},)
+            data = ordering.order_view(order)
 
         except Exception as e:
             return 528, "{}".format(str(e)), {}
@@ -245,163 +203,144 @@ class Buyer(db_conn.DBConn):
 
     def cancel_order(self, user_id: str, order_id: str, password: str) -> (int, str):
         try:
-            # 查询订单信息
-            orders = list(self.conn.order.find({"order_id": order_id}))
-            if not orders:
-                return error.error_invalid_order_id(order_id)
-
-            # 获取订单对应的买家ID和商店ID
-            buyer_id = orders[0]["buyer_id"]
-            store_id = orders[0]["store_id"]
-            
-            # 验证用户权限
-            if buyer_id != user_id:
-                return error.error_authorization_fail()
-
-            # 检查订单状态是否为待付款
-            if orders[0].get("status") != "pending":
-                return error.error_invalid_order_id(order_id)
-
-            # 查询买家信息以验证密码
-            buyer = self.conn.user.find_one({"user_id": buyer_id})
-            if buyer is None:
-                return error.error_non_exist_user_id(buyer_id)
-            
-            if password != buyer["password"]:
-                return error.error_authorization_fail()
-
-            # 更新订单状态为已取消
-            self.conn.order.update_many(
-                {"order_id": order_id},
-                {"$set": {"status": "canceled"}}
+            # 查询订单信息和买家密码
+            order = self.conn.order.find_one(
+                {"order_id": order_id}, {"_id": 0, "buyer_id": 1, "status": 1}
             )
-            
-            # 恢复库存
-            for order in orders:
-                book_id = order["book_id"]
-                count = order["count"]
-                # 增加book集合中的库存
-                self.conn.book.update_one(
-                    {"book_id": book_id, "belong_store_id": store_id},
-                    {"$inc": {"stock_level": count}}
-                )
-
+            buyer = None
+            if order is not None and order["buyer_id"] == user_id:
+                buyer = self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1})
+            failure = ordering.check_cancel(user_id, password, order_id, order, buyer)
+            if failure is not None:
+                return failure
+
+            # 更新订单状态为已取消并恢复库存，订单已被付款或取消时不会命中
+            def cancel(session, undo):
+                order = self.cancel_pending_order({"order_id": order_id}, session, undo)
+                if order is None:
+                    raise txn.Abort(*error.error_invalid_order_id(order_id))
+                return order
+
+            order = self.run_transaction(cancel)
+            search_cache.invalidate_store(order["store_id"])
+            expiry.discard(order_id)
+        except txn.Abort as e:
+            return e.code, e.message
         except Exception as e:
             return 528, "{}".format(str(e))
 
         return 200, "ok"
 
-    def search_global(self, keyword: str, page: int = 1, limit: int = 10) -> (int, str, dict):
+    def search_global(
+        self, keyword: str, page: int = 1, limit: int = 10, approx_total: bool = False, cursor: str = None,
+        engine: str = None, fields: [str] = None, filters: dict = None, explain: bool = False, facets: bool = False,
+        grouped: bool = False, view: str = "full"
+    ) -> (int, str, dict):
         try:
-            # 计算分页参数
-            skip = (page - 1) * limit
-            
-            # 使用MongoDB的文本搜索功能进行全站搜索
-            # $text操作符用于执行文本搜索
-            # $meta操作符用于获取搜索结果的相关性分数
-            search_results = list(self.conn.book.find(
-                {"$text": {"$search": keyword}},
-                {
-                    "_id": 0,
-                    "book_id": 1,
-                    "title": 1,
-                    "author": 1,
-                    "price": 1,
-                    "publisher": 1,
-                    "tags": 1,
-                    "book_intro": 1,
-                    "belong_store_id": 1,
-                    "score": {"$meta": "textScore"},
-                }
-            ).sort([("score", {"$meta": "textScore"})]).skip(skip).limit(limit))
-            
-            # 获取总记录数
-            total_count = self.conn.book.count_documents({"$text": {"$search": keyword}})
-            
-            # 处理搜索结果，移除不必要的字段
-            books = []
-            for book in search_results:
-                # 移除MongoDB的_id字段和score字段
-                book_data = {
-                    "id": book.get("book_id"),
-                    "title": book.get("title"),
-                    "author": book.get("author"),
-                    "price": book.get("price"),
-                    "publisher": book.get("publisher"),
-                    "tags": book.get("tags"),
-                    "book_intro": book.get("book_intro"),
-                    "belong_store_id": book.get("belong_store_id"),
-                }
-                books.append(book_data)
-            
-            # 构造返回数据，与接口文档保持一致
-            data = {
-                "books": books,
-                "total": total_count,
-                "page": page,
-                "limit": limit
-            }
-            
+            # 全站搜索：匹配的书目在所有商店的上架记录；给出cursor时从游标处续页，忽略page；
+            # grouped时每个书目只返回一条，合并其各商店的上架记录
+            data = search.BookSearch(engine).search(
+                keyword, None, page, limit, approx_total, cursor, fields, filters, explain, facets, grouped, view
+            )
+        except cursor_token.InvalidCursor:
+            return error.error_invalid_cursor(cursor) + ({},)
+        except ValueError as e:
+            # 未知的检索后端、结果视图等参数错误
+            return error.error_invalid_parameter(str(e)) + ({},)
         except Exception as e:
             return 528, "{}".format(str(e)), {}
         
         return 200, "ok", data
 
-    def search_in_store(self, keyword: str, store_id: str, page: int = 1, limit: int = 10) -> (int, str, dict):
+    def search_in_store(
+        self, keyword: str, store_id: str, page: int = 1, limit: int = 10, approx_total: bool = False,
+        cursor: str = None, engine: str = None, fields: [str] = None, filters: dict = None, explain: bool = False,
+        facets: bool = False, view: str = "full"
+    ) -> (int, str, dict):
         try:
             # 检查商店是否存在
             if not self.store_id_exist(store_id):
                 return error.error_non_exist_store_id(store_id) + ({},)
             
-            # 计算分页参数
-            skip = (page - 1) * limit
-            
-            # 使用MongoDB的文本搜索功能进行店铺内搜索
-            # 同时限定商店ID条件
-            search_results = list(self.conn.book.find(
-                {"$text": {"$search": keyword}, "belong_store_id": store_id},
-                {
-                    "_id": 0,
-                    "book_id": 1,
-                    "title": 1,
-                    "author": 1,
-                    "price": 1,
-                    "publisher": 1,
-                    "tags": 1,
-                    "book_intro": 1,
-                    "belong_store_id": 1,
-                    "score": {"$meta": "textScore"},
-                }
-            ).sort([("score", {"$meta": "textScore"})]).skip(skip).limit(limit))
-            
-            # 获取总记录数
-            total_count = self.conn.book.count_documents({"$text": {"$search": keyword}, "belong_store_id": store_id})
-            
-            # 处理搜索结果，移除不必要的字段
-            books = []
-            for book in search_results:
-                # 移除MongoDB的_id字段和score字段
-                book_data = {
-                    "id": book.get("book_id"),
-                    "title": book.get("title"),
-                    "author": book.get("author"),
-                    "price": book.get("price"),
-                    "publisher": book.get("publisher"),
-                    "tags": book.get("tags"),
-                    "book_intro": book.get("book_intro"),
-                    "belong_store_id": book.get("belong_store_id"),
-                }
-                books.append(book_data)
-            
-            # 构造返回数据，与接口文档保持一致
-            data = {
-                "books": books,
-                "total": total_count,
-                "page": page,
-                "limit": limit
-            }
-            
+            # 店铺内搜索：匹配的书目在该商店的上架记录
+            data = search.BookSearch(engine).search(
+                keyword, store_id, page, limit, approx_total, cursor, fields, filters, explain, facets,
+                view=view
+            )
+        except cursor_token.InvalidCursor:
+            return error.error_invalid_cursor(cursor) + ({},)
+        except ValueError as e:
+            # 未知的检索后端、结果视图等参数错误
+            return error.error_invalid_parameter(str(e)) + ({},)
         except Exception as e:
             return 528, "{}".format(str(e)), {}
         
         return 200, "ok", data
+
+    def search_batch(self, queries: [dict]) -> (int, str, dict):
+        """批量搜索：各查询在线程池中并发执行，按请求中的顺序返回各自的(code, message, data)
+
+        queries中每一项为search_global的关键字参数，带store_id时按search_in_store执行。
+        """
+        def run(query: dict) -> dict:
+            if query.get("store_id"):
+                code, message, data = self.search_in_store(**query)
+            else:
+                code, message, data = self.search_global(**query)
+            return {"code": code, "message": message, "data": data}
+
+        try:
+            futures = [search.batch_pool.submit(run, query) for query in queries]
+            results = [future.result() for future in futures]
+        except Exception as e:
+            return 528, "{}".format(str(e)), {}
+
+        return 200, "ok", {"results": results}
+
+    def facets(self, store_id: str = None) -> (int, str, dict):
+        try:
+            # 全站或某个商店的预先统计的分面计数，上架时增量维护
+            if store_id is not None and not self.store_id_exist(store_id):
+                return error.error_non_exist_store_id(store_id) + ({},)
+            data = facet.precomputed(self.conn, store_id)
+        except Exception as e:
+            return 528, "{}".format(str(e)), {}
+
+        return 200, "ok", {"facets": data}
+
+    def suggest(self, prefix: str, limit: int = 10) -> (int, str, dict):
+        try:
+            # 书名、作者、标签的前缀补全，按热度取前limit个，不访问数据库
+            suggestions = suggest.get_index().complete(prefix, limit)
+        except Exception as e:
+            return 528, "{}".format(str(e)), {}
+
+        return 200, "ok", {"suggestions": suggestions}
+
+    def similar(self, book_id: str, limit: int = 10) -> (int, str, dict):
+        try:
+            # TF-IDF余弦相似度最高的limit本书
+            neighbours = similar.get_index().nearest(book_id, limit)
+            if neighbours is None:
+                return error.error_non_exist_book_id(book_id) + ({},)
+            books = {
+                book["_id"]: book
+                for book in self.conn.catalog.find(
+                    {"_id": {"$in": [other_id for other_id, _ in neighbours]}},
+                    {"title": 1, "author": 1, "tags": 1},
+                )
+            }
+        except Exception as e:
+            return 528, "{}".format(str(e)), {}
+
+        result = []
+        for other_id, score in neighbours:
+            book = books.get(other_id, {})
+            result.append({
+                "id": other_id,
+                "title": book.get("title"),
+                "author": book.get("author"),
+                "tags": book.get("tags"),
+                "score": score,
+            })
+        return 200, "ok", {"books": result}
@@ -0,0 +1,81 @@
+from datetime import datetime
+from pymongo import UpdateOne
+
+# 书目信息保存在全局的catalog集合中（_id为book_id，每本书一条），
+# 各商店的价格和库存保存在inventory集合中（store_id + book_id唯一）
+CATALOG_FIELDS = {
+    "author": "",
+    "author_intro": "",
+    "binding": "",
+    "book_intro": "",
+    "content": "",
+    "currency_unit": "",
+    "isbn": "",
+    "original_title": "",
+    "pages": 0,
+    "pub_year": "",
+    "publisher": "",
+    "tags": [],
+    "title": "",
+    "translator": "",
+}
+
+
+def catalog_document(book_id: str, book_info: dict, picture_ids: [str]) -> dict:
+    # 从书籍信息中取出书目字段，缺失的字段使用默认值
+    doc = {"_id": book_id}
+    for field, default in CATALOG_FIELDS.items():
+        doc[field] = book_info.get(field, default)
+    doc["picture_ids"] = picture_ids
+    doc["created_at"] = datetime.now()
+    return doc
+
+
+def inventory_document(store_id: str, book_id: str, price: int, stock_level: int) -> dict:
+    return {
+        "store_id": store_id,
+        "book_id": book_id,
+        "price": price,
+        "stock_level": stock_level,
+    }
+
+
+def split_book_collection(db) -> int:
+    """迁移：把旧版本每个商店一份完整书籍信息的book集合拆分为catalog和inventory
+
+    catalog和inventory都使用upsert写入，中途失败后可以重复执行；
+    全部写入后删除book集合。返回处理的book文档数。
+    """
+    moved = 0
+    catalog_ops = []
+    inventory_ops = []
+
+    def flush():
+        if catalog_ops:
+            db.catalog.bulk_write(catalog_ops, ordered=False)
+            del catalog_ops[:]
+        if inventory_ops:
+            db.inventory.bulk_write(inventory_ops, ordered=False)
+            del inventory_ops[:]
+
+    for book in db.book.find({}):
+        book_id = book["book_id"]
+        store_id = book["belong_store_id"]
+        catalog_ops.append(UpdateOne(
+            {"_id": book_id},
+            {"$setOnInsert": catalog_document(book_id, book, book.get("picture_ids", []))},
+            upsert=True,
+        ))
+        inventory_ops.append(UpdateOne(
+            {"store_id": store_id, "book_id": book_id},
+            {"$setOnInsert": inventory_document(
+                store_id, book_id, book.get("price", 0), book.get("stock_level", 0)
+            )},
+            upsert=True,
+        ))
+        moved = moved + 1
+        if len(inventory_ops) >= 1000:
+            flush()
+    flush()
+    db.book.drop()
+    return moved
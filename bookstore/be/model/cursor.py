@@ -0,0 +1,63 @@
+import base64
+import hashlib
+import json
+
+# 续页游标：把上一页最后一条记录的排序键编码为不透明的字符串，
+# 下一页只取排序在其之后的记录，代价与页深度无关
+
+
+class InvalidCursor(Exception):
+    """游标格式错误或不属于该查询"""
+
+
+def fingerprint(*parts) -> str:
+    # 游标只能用于生成它的同一个查询
+    text = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def encode(query_fingerprint: str, last: list, extra: dict = None) -> str:
+    """last为上一页最后一条记录按排序字段顺序的取值，extra为需要随游标传递的其他信息"""
+    payload = {"q": query_fingerprint, "k": last}
+    if extra:
+        payload["x"] = extra
+    text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode(token: str, query_fingerprint: str) -> (list, dict):
+    """返回(last, extra)；游标格式错误或不属于该查询时抛出InvalidCursor"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        last = payload["k"]
+        extra = payload.get("x", {})
+    except Exception:
+        raise InvalidCursor("malformed cursor")
+    if payload.get("q") != query_fingerprint or not isinstance(last, list):
+        raise InvalidCursor("cursor does not match query")
+    return last, extra
+
+
+def after(sort: [(str, int)], last: list, inclusive_prefix: int = None) -> dict:
+    """构造“排序在last之后”的查询条件
+
+    sort为[(字段, 1或-1), ...]，last为对应字段的取值。条件按字典序展开为
+    {$or: [{f1 > v1}, {f1 = v1, f2 > v2}, ...]}（-1方向使用$lt）。
+    inclusive_prefix=n 时只使用前n个字段，且最后一个字段取等号也满足，
+    用于在关联展开前按较粗的键预先过滤。
+    """
+    if inclusive_prefix is not None:
+        sort = sort[:inclusive_prefix]
+        last = last[:inclusive_prefix]
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {sort[j][0]: last[j] for j in range(i)}
+        inclusive = inclusive_prefix is not None and i == len(sort) - 1
+        if direction > 0:
+            op = "$gte" if inclusive else "$gt"
+        else:
+            op = "$lte" if inclusive else "$lt"
+        clause[field] = {op: last[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
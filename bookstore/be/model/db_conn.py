@@ -1,24 +1,30 @@
 from be.model import store
+from be.model import txn
+from be.model import ordering
 
 
 class DBConn:
     def __init__(self):
         self.conn = store.get_db()
 
+    def run_transaction(self, body):
+        # 在多文档事务（或补偿模式）中执行 body(session, undo)
+        return txn.run(self.conn.client, body, store.use_transaction())
+
     def user_id_exist(self, user_id):
         # 使用MongoDB查询用户是否存在
-        user = self.conn.user.find_one({"user_id": user_id})
+        user = self.conn.user.find_one({"user_id": user_id}, {"_id": 1})
         if user is None:
             return False
         else:
             return True
 
     def book_id_exist(self, store_id, book_id):
-        # 直接在book集合中查询书籍是否存在
-        book = self.conn.book.find_one({
-            "book_id": book_id,
-            "belong_store_id": store_id
-        })
+        # 在inventory集合中查询该商店是否上架了这本书
+        book = self.conn.inventory.find_one({
+            "store_id": store_id,
+            "book_id": book_id
+        }, {"_id": 1})
         if book is None:
             return False
         else:
@@ -27,8 +33,34 @@ class DBConn:
     def store_id_exist(self, store_id):
         # 使用MongoDB查询商店是否存在
         # 假设store集合中至少有一本书用来表示商店存在
-        store = self.conn.store.find_one({"store_id": store_id})
+        store = self.conn.store.find_one({"store_id": store_id}, {"_id": 1})
         if store is None:
             return False
         else:
             return True
+
+    def restore_stock(self, orders, session=None):
+        # 一次bulk_write恢复一批订单中所有书籍的库存，orders中每项包含store_id和内嵌的books明细
+        requests = ordering.restock_requests(orders)
+        if requests:
+            self.conn.inventory.bulk_write(requests, ordered=False, session=session)
+
+    def cancel_pending_order(self, condition: dict, session=None, undo=None, restore=True):
+        # 单文档原子更新：把满足条件的待付款订单改为已取消，restore为True时同时恢复库存
+        # 返回被取消的订单，订单不存在或已不是待付款状态时返回None
+        order = self.conn.order.find_one_and_update(
+            dict(condition, status="pending"),
+            {"$set": {"status": "canceled"}},
+            projection=ordering.CANCEL_PROJECTION,
+            session=session,
+        )
+        if order is None:
+            return None
+        if undo is not None:
+            undo.append(lambda: self.conn.order.update_one(
+                {"order_id": order["order_id"], "status": "canceled"},
+                {"$set": {"status": "pending"}},
+            ))
+        if restore:
+            self.restore_stock([order], session=session)
+        return order
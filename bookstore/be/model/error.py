@@ -1,5 +1,7 @@
 error_code = {
+    400: "invalid parameter: {}",
     401: "authorization fail.",
+    503: "server overloaded, retry after {} seconds",
     511: "non exist user id {}",
     512: "exist user id {}",
     513: "non exist store id {}",
@@ -9,7 +11,7 @@ error_code = {
     517: "stock level low, book id {}",
     518: "invalid order id {}",
     519: "not sufficient funds, order id {}",
-    520: "",
+    520: "invalid cursor {}",
     521: "",
     522: "",
     523: "",
@@ -57,6 +59,18 @@ def error_not_sufficient_funds(order_id):
     return 519, error_code[519].format(order_id)
 
 
+def error_invalid_cursor(cursor):
+    return 520, error_code[520].format(cursor)
+
+
+def error_invalid_parameter(message):
+    return 400, error_code[400].format(message)
+
+
+def error_overloaded(retry_after):
+    return 503, error_code[503].format(retry_after)
+
+
 def error_authorization_fail():
     return 401, error_code[401]
 
@@ -0,0 +1,214 @@
+import heapq
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from be.model import db_conn
+from be.model import metrics
+from be.model import lease
+from be.model import search_cache
+
+# 每批最多取消的订单数
+MAX_BATCH = 200
+# 从数据库装载未来多长时间内到期的订单；每隔一半时间重新扫描一次，
+# 以发现其他进程创建、或本进程启动前创建的订单
+LOAD_WINDOW = timedelta(seconds=60)
+# 订单按order_id哈希分到的分区数，多个后端进程通过租约各自负责一部分分区
+PARTITIONS = int(os.environ.get("BOOKSTORE_EXPIRY_PARTITIONS", "4"))
+
+
+def utc(moment: datetime) -> datetime:
+    # 付款截止时间以UTC保存，pymongo读出的是不带时区的UTC时间，补上时区后才能与datetime.now(timezone.utc)比较
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+
+def partition_of(order_id: str) -> int:
+    return zlib.crc32(order_id.encode("utf-8")) % PARTITIONS
+
+
+class ExpiryScheduler(db_conn.DBConn):
+    """按订单付款截止时间到期取消订单的调度器
+
+    待取消订单按截止时间放在内存小顶堆中，后台线程等待到堆顶订单的截止时间
+    后一次取出所有已到期的订单批量取消：每个订单用单文档条件更新把状态从
+    pending 改为 canceled（已付款或已取消的订单不会命中），再用一次
+    bulk_write 恢复这一批订单的库存。
+
+    多进程部署时订单按 order_id 哈希分区，每个分区由持有其租约的一个进程负责，
+    进程只装载和取消自己分区内的订单；租约转移后由新持有者重新装载。
+    即使租约交接期间两个进程同时处理同一订单，条件更新也保证只有一个进程
+    取消成功并恢复库存。
+    """
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+        self.heap = []
+        # 已在堆中的订单，避免重复扫描时重复入堆
+        self.scheduled = set()
+        # 已付款或已取消、堆中条目作废的订单
+        self.discarded = set()
+        self.cond = threading.Condition()
+        # 已从数据库装载到该时间为止到期的订单
+        self.loaded_until = None
+        self.thread = None
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "pending": 0,
+            "batches": 0,
+            "canceled": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_lag": 0.0,
+            "max_lag": 0.0,
+        }
+        metrics.register("expiry", self.snapshot)
+        self.lease = lease.LeaseManager("expiry", PARTITIONS, on_change=self.reload)
+
+    def schedule(self, order_id: str, deadline: datetime):
+        deadline = utc(deadline)
+        with self.cond:
+            if order_id in self.scheduled:
+                return
+            self.scheduled.add(order_id)
+            heapq.heappush(self.heap, (deadline, order_id))
+            # 新订单成为最早到期的订单时唤醒后台线程重新计算等待时间
+            if self.heap[0][1] == order_id:
+                self.cond.notify()
+
+    def discard(self, order_id: str):
+        # 订单已付款或被买家取消，到期时无需再访问数据库
+        with self.cond:
+            if order_id in self.scheduled:
+                self.discarded.add(order_id)
+
+    def load(self, now: datetime):
+        # 使用 (status, payment_deadline) 索引装载下一时间窗口内到期的待付款订单
+        until = now + LOAD_WINDOW
+        for order in self.conn.order.find(
+            {"status": "pending", "payment_deadline": {"$lt": until}},
+            {"_id": 0, "order_id": 1, "payment_deadline": 1},
+        ):
+            if self.lease.owns(partition_of(order["order_id"])):
+                self.schedule(order["order_id"], order["payment_deadline"])
+        self.loaded_until = until
+
+    def reload(self):
+        # 持有的分区发生变化，立即重新装载
+        with self.cond:
+            self.loaded_until = None
+            self.cond.notify()
+
+    def pop_due(self, now: datetime) -> [(datetime, str)]:
+        due = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now and len(due) < MAX_BATCH:
+                deadline, order_id = heapq.heappop(self.heap)
+                self.scheduled.discard(order_id)
+                if order_id in self.discarded:
+                    self.discarded.discard(order_id)
+                    continue
+                # 不属于本进程分区的订单由持有该分区租约的进程取消
+                if not self.lease.owns(partition_of(order_id)):
+                    continue
+                due.append((deadline, order_id))
+        return due
+
+    def cancel_batch(self, due: [(datetime, str)], now: datetime) -> [dict]:
+        def cancel(session, undo):
+            canceled = []
+            for _, order_id in due:
+                order = self.cancel_pending_order(
+                    {"order_id": order_id, "payment_deadline": {"$lte": now}},
+                    session,
+                    undo,
+                    restore=False,
+                )
+                if order is not None:
+                    canceled.append(order)
+            # 一次bulk_write恢复这一批订单的全部库存
+            self.restore_stock(canceled, session=session)
+            return canceled
+
+        canceled = self.run_transaction(cancel)
+        for store_id in set(order["store_id"] for order in canceled):
+            search_cache.invalidate_store(store_id)
+        return canceled
+
+    def record_batch(self, canceled: [dict]):
+        done = datetime.now(timezone.utc)
+        with self.stats_lock:
+            self.stats["batches"] = self.stats["batches"] + 1
+            self.stats["canceled"] = self.stats["canceled"] + len(canceled)
+            self.stats["last_batch_size"] = len(canceled)
+            self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(canceled))
+            for order in canceled:
+                # 延迟：订单实际被取消的时间与付款截止时间之差（秒）
+                lag = (done - utc(order["payment_deadline"])).total_seconds()
+                self.stats["last_lag"] = lag
+                self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+
+    def snapshot(self) -> dict:
+        with self.stats_lock:
+            data = dict(self.stats)
+        with self.cond:
+            data["pending"] = len(self.heap) - len(self.discarded)
+        return data
+
+    def wait_seconds(self, now: datetime) -> float:
+        # 等待到堆顶订单到期或下一次扫描数据库，取较早者
+        with self.cond:
+            if self.loaded_until is None:
+                return 0
+            wake = self.loaded_until - LOAD_WINDOW / 2
+            if self.heap and self.heap[0][0] < wake:
+                wake = self.heap[0][0]
+        return max((wake - now).total_seconds(), 0)
+
+    def run(self):
+        while True:
+            try:
+                now = datetime.now(timezone.utc)
+                if self.loaded_until is None or now >= self.loaded_until - LOAD_WINDOW / 2:
+                    self.load(now)
+                due = self.pop_due(now)
+                if due:
+                    self.record_batch(self.cancel_batch(due, now))
+                    continue
+                with self.cond:
+                    self.cond.wait(self.wait_seconds(now))
+            except Exception as e:
+                logging.error("取消过期订单时出错: {}".format(str(e)))
+                time.sleep(1)
+
+    def start(self):
+        self.lease.start()
+        self.thread = threading.Thread(target=self.run, name="expiry", daemon=True)
+        self.thread.start()
+
+
+scheduler: ExpiryScheduler = None
+
+
+def start_scheduler():
+    global scheduler
+    scheduler = ExpiryScheduler()
+    scheduler.start()
+
+
+def stop_scheduler():
+    # 进程退出前释放租约，其他进程的调度器随即接管这些分区
+    if scheduler is not None:
+        scheduler.lease.stop()
+
+
+def schedule(order_id: str, deadline: datetime):
+    # 下单后登记订单的付款截止时间，调度器未启动时忽略
+    if scheduler is not None:
+        scheduler.schedule(order_id, deadline)
+
+
+def discard(order_id: str):
+    if scheduler is not None:
+        scheduler.discard(order_id)
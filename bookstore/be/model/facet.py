@@ -0,0 +1,162 @@
+import os
+import bisect
+from pymongo import UpdateOne
+
+# 分面：按出版社、标签、装帧、价格区间、出版年份统计上架记录数，供买家进一步筛选
+FACETS = ("publisher", "tag", "binding", "price_bucket", "pub_year")
+
+# 计算分面需要的书目字段
+BOOK_FIELDS = {"publisher": 1, "tags": 1, "binding": 1, "pub_year": 1}
+
+# 价格区间的下界（价格单位为分），最后一个区间没有上界
+PRICE_BUCKETS = [0, 1000, 2000, 5000, 10000, 20000, 50000]
+
+# 查询时分面最多统计的匹配记录数，每个分面返回的取值个数
+FACET_CAP = int(os.environ.get("BOOKSTORE_FACET_CAP", "2000"))
+FACET_TOP = 20
+
+# 全站统计的范围名；各商店的统计以store_id为范围名
+GLOBAL_SCOPE = "*"
+
+
+def price_bucket(price) -> str:
+    if not isinstance(price, (int, float)) or price < 0:
+        return None
+    i = bisect.bisect_right(PRICE_BUCKETS, price) - 1
+    if i == len(PRICE_BUCKETS) - 1:
+        return "{}+".format(PRICE_BUCKETS[i])
+    return "{}-{}".format(PRICE_BUCKETS[i], PRICE_BUCKETS[i + 1])
+
+
+def facet_values(book: dict, price) -> [(str, str)]:
+    # 一条上架记录的各分面取值；pub_year形如"2008-1"，只取年份
+    values = []
+    if book.get("publisher"):
+        values.append(("publisher", book["publisher"]))
+    for tag in set(book.get("tags") or []):
+        if tag:
+            values.append(("tag", tag))
+    if book.get("binding"):
+        values.append(("binding", book["binding"]))
+    bucket = price_bucket(price)
+    if bucket is not None:
+        values.append(("price_bucket", bucket))
+    year = str(book.get("pub_year") or "")[:4]
+    if year:
+        values.append(("pub_year", year))
+    return values
+
+
+def count_updates(store_id: str, book: dict, price, n: int = 1) -> [UpdateOne]:
+    ops = []
+    for facet, value in facet_values(book, price):
+        for scope in (GLOBAL_SCOPE, store_id):
+            ops.append(UpdateOne(
+                {"scope": scope, "facet": facet, "value": value}, {"$inc": {"count": n}}, upsert=True
+            ))
+    return ops
+
+
+def record_listing(db, store_id: str, book: dict, price):
+    """上架一本书时增量更新全站和该商店的分面计数"""
+    ops = count_updates(store_id, book, price)
+    if ops:
+        db.facet_count.bulk_write(ops, ordered=False)
+
+
+async def record_listing_async(db, store_id: str, book: dict, price):
+    # record_listing的asyncio版本
+    ops = count_updates(store_id, book, price)
+    if ops:
+        await db.facet_count.bulk_write(ops, ordered=False)
+
+
+def precomputed(db, store_id: str = None, top: int = FACET_TOP) -> dict:
+    # 预先统计的分面计数，每个分面取计数最多的top个取值
+    scope = GLOBAL_SCOPE if store_id is None else store_id
+    result = {}
+    for facet in FACETS:
+        cursor = db.facet_count.find(
+            {"scope": scope, "facet": facet, "count": {"$gt": 0}}, {"_id": 0, "value": 1, "count": 1}
+        ).sort([("count", -1), ("value", 1)]).limit(top)
+        result[facet] = [{"value": doc["value"], "count": doc["count"]} for doc in cursor]
+    return result
+
+
+def facet_stages(top: int = FACET_TOP, price: str = "$inventory.price") -> dict:
+    """查询时分面的$facet子管道，输入为search的上架记录（书目字段 + inventory）
+
+    每个子管道只统计匹配集合中的前FACET_CAP条记录；price为价格区间分面所用的价格字段。
+    """
+    def group(expr) -> list:
+        return [
+            {"$group": {"_id": expr, "count": {"$sum": 1}}},
+            {"$match": {"_id": {"$nin": [None, ""]}}},
+            {"$sort": {"count": -1, "_id": 1}},
+            {"$limit": top},
+        ]
+
+    cap = {"$limit": FACET_CAP}
+    return {
+        "facet_publisher": [cap] + group("$publisher"),
+        "facet_tag": [cap, {"$unwind": "$tags"}] + group("$tags"),
+        "facet_binding": [cap] + group("$binding"),
+        "facet_price_bucket": [
+            cap,
+            {
+                "$bucket": {
+                    "groupBy": price,
+                    "boundaries": PRICE_BUCKETS + [float("inf")],
+                    "default": None,
+                    "output": {"count": {"$sum": 1}},
+                }
+            },
+            {"$match": {"_id": {"$ne": None}}},
+        ],
+        "facet_pub_year": [cap] + group({"$substrCP": [{"$ifNull": ["$pub_year", ""]}, 0, 4]}),
+    }
+
+
+def from_facet_result(result: dict) -> dict:
+    facets = {}
+    for facet in FACETS:
+        entries = result.get("facet_" + facet, [])
+        if facet == "price_bucket":
+            facets[facet] = [{"value": price_bucket(entry["_id"]), "count": entry["count"]} for entry in entries]
+        else:
+            facets[facet] = [{"value": entry["_id"], "count": entry["count"]} for entry in entries]
+    return facets
+
+
+def count_rows(rows: [dict], top: int = FACET_TOP) -> dict:
+    # rows为(书目, 价格)，在进程内统计，用于不经过聚合管道的n-gram检索
+    counts = {facet: {} for facet in FACETS}
+    for book, price in rows[:FACET_CAP]:
+        for facet, value in facet_values(book, price):
+            counts[facet][value] = counts[facet].get(value, 0) + 1
+    facets = {}
+    for facet, values in counts.items():
+        ranked = sorted(values.items(), key=lambda item: (-item[1], item[0]))[:top]
+        facets[facet] = [{"value": value, "count": count} for value, count in ranked]
+    return facets
+
+
+def rebuild_counts(db) -> int:
+    """迁移：按现有的catalog和inventory重新统计分面计数，可以重复执行"""
+    db.facet_count.delete_many({})
+    books = {}
+    ops = []
+    n = 0
+    for item in db.inventory.find({}, {"_id": 0, "store_id": 1, "book_id": 1, "price": 1}):
+        book = books.get(item["book_id"])
+        if book is None:
+            book = db.catalog.find_one({"_id": item["book_id"]}, BOOK_FIELDS) or {}
+            books[item["book_id"]] = book
+        ops.extend(count_updates(item["store_id"], book, item.get("price")))
+        n = n + 1
+        if len(ops) >= 1000:
+            db.facet_count.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        db.facet_count.bulk_write(ops, ordered=False)
+    return n
@@ -0,0 +1,137 @@
+import logging
+import math
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import DuplicateKeyError
+from be.model import db_conn
+from be.model import metrics
+
+# 租约有效期，持有者需在到期前续约，否则其他进程可以接管
+LEASE_TTL = timedelta(seconds=10)
+# 心跳（续约、抢占空闲租约）间隔
+HEARTBEAT_INTERVAL = 3
+
+
+class LeaseManager(db_conn.DBConn):
+    """基于lease集合的分区租约
+
+    每个分区一个租约文档 {_id: "<name>:<分区号>", owner, expires_at}。获取和续约都是
+    一次条件 find_one_and_update：只有租约不存在、已过期或本进程持有时才能写入，
+    其他进程持有且未过期时 upsert 触发唯一键冲突，因此任一时刻每个分区只有一个持有者。
+    各进程同时登记 "worker:<id>" 心跳文档，按存活进程数均分分区，新进程加入后
+    持有过多分区的进程会主动释放多余的租约。
+    """
+
+    def __init__(self, name: str, partitions: int, on_change=None):
+        db_conn.DBConn.__init__(self)
+        self.name = name
+        self.partitions = partitions
+        self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.owned = set()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.counts = {"acquired": 0, "lost": 0, "released": 0}
+        metrics.register("lease_" + name, self.snapshot)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            data = dict(self.counts)
+            data["owner"] = self.owner
+            data["partitions"] = sorted(self.owned)
+        return data
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] = self.counts[key] + 1
+
+    def lease_id(self, partition: int) -> str:
+        return "{}:{}".format(self.name, partition)
+
+    def owns(self, partition: int) -> bool:
+        with self.lock:
+            return partition in self.owned
+
+    def owned_partitions(self) -> set:
+        with self.lock:
+            return set(self.owned)
+
+    def try_acquire(self, lease_id: str, now: datetime) -> bool:
+        # 租约不存在、已过期或本进程持有时写入本进程为持有者并延长有效期
+        try:
+            self.conn.lease.find_one_and_update(
+                {"_id": lease_id, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + LEASE_TTL}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def release(self, lease_id: str):
+        self.conn.lease.delete_one({"_id": lease_id, "owner": self.owner})
+
+    def live_workers(self, now: datetime) -> int:
+        return self.conn.lease.count_documents(
+            {"_id": {"$regex": "^worker:{}:".format(self.name)}, "expires_at": {"$gte": now}}
+        )
+
+    def heartbeat(self):
+        # expires_at上的TTL索引按UTC判断过期，写入和比较都使用UTC时间
+        now = datetime.now(timezone.utc)
+        self.try_acquire("worker:{}:{}".format(self.name, self.owner), now)
+        share = int(math.ceil(self.partitions / float(max(self.live_workers(now), 1))))
+
+        owned = set()
+        # 续约已持有的分区，续约失败说明已被其他进程接管
+        for partition in sorted(self.owned_partitions()):
+            if self.try_acquire(self.lease_id(partition), now):
+                owned.add(partition)
+            else:
+                self.count("lost")
+        # 持有超过均分份额时释放多余的分区
+        while len(owned) > share:
+            partition = max(owned)
+            self.release(self.lease_id(partition))
+            owned.discard(partition)
+            self.count("released")
+        # 抢占空闲或已过期的分区，接管崩溃进程的工作
+        for partition in range(self.partitions):
+            if len(owned) >= share:
+                break
+            if partition not in owned and self.try_acquire(self.lease_id(partition), now):
+                owned.add(partition)
+                self.count("acquired")
+
+        with self.lock:
+            changed = owned != self.owned
+            self.owned = owned
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.heartbeat()
+            except Exception as e:
+                # 无法续约时放弃所有分区，避免租约过期后与接管者同时工作
+                logging.error("租约续约失败: {}".format(str(e)))
+                with self.lock:
+                    self.owned = set()
+            self.stopped.wait(HEARTBEAT_INTERVAL)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="lease-" + self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        for partition in self.owned_partitions():
+            self.release(self.lease_id(partition))
+        self.conn.lease.delete_one({"_id": "worker:{}:{}".format(self.name, self.owner)})
+        with self.lock:
+            self.owned = set()
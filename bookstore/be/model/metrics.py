@@ -0,0 +1,35 @@
+import threading
+
+# 各模块的运行时指标，通过 /metrics 接口统一输出
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class Counters:
+    """线程安全的一组计数器，创建时自动注册到指标表中"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.values = {}
+        register(name, self.snapshot)
+
+    def inc(self, key: str, n: int = 1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+
+def register(name: str, provider):
+    # provider 为无参函数，返回可序列化为 JSON 的 dict
+    with _providers_lock:
+        _providers[name] = provider
+
+
+def snapshot() -> dict:
+    with _providers_lock:
+        providers = dict(_providers)
+    return {name: provider() for name, provider in providers.items()}
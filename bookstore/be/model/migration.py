@@ -0,0 +1,297 @@
+import logging
+import threading
+from datetime import datetime
+from be.model import picture
+from be.model import catalog
+from be.model import facet
+from be.model import session
+
+# schema_version 集合中记录当前数据版本的文档ID
+SCHEMA_VERSION_ID = "bookstore"
+# 文档数超过该值的集合，非唯一索引的创建和重建放到后台线程执行
+BACKGROUND_THRESHOLD = 10000
+
+
+class Index:
+    """声明式的索引定义，keys 与 create_index 的参数一致"""
+
+    def __init__(self, keys, name: str, **options):
+        self.keys = keys
+        self.name = name
+        self.options = options
+
+    @property
+    def is_text(self) -> bool:
+        return any(direction == "text" for _, direction in self.keys)
+
+    def matches(self, existing: dict) -> bool:
+        # existing 为 list_indexes() 返回的索引信息
+        if self.is_text:
+            # 文本索引的 key 固定为 {_fts: text, _ftsx: 1}，字段和权重保存在 weights 中
+            weights = self.options.get("weights", {})
+            declared_weights = {field: weights.get(field, 1) for field, _ in self.keys}
+            existing_weights = {k: int(v) for k, v in existing.get("weights", {}).items()}
+            if declared_weights != existing_weights:
+                return False
+            if self.options.get("default_language", "english") != existing.get("default_language", "english"):
+                return False
+        else:
+            existing_keys = [(field, int(direction)) for field, direction in existing["key"].items()]
+            if existing_keys != [(field, int(direction)) for field, direction in self.keys]:
+                return False
+        for option in ("unique", "sparse"):
+            if bool(self.options.get(option, False)) != bool(existing.get(option, False)):
+                return False
+        for option in ("expireAfterSeconds", "partialFilterExpression"):
+            if self.options.get(option) != existing.get(option):
+                return False
+        return True
+
+    def create(self, collection):
+        collection.create_index(self.keys, name=self.name, **self.options)
+
+
+# 各集合应有的索引，启动时与 list_indexes() 对比，只创建缺失的、重建定义变化的索引
+INDEXES = {
+    "user": [
+        Index([("user_id", 1)], "user_id_1", unique=True),
+    ],
+    "session": [
+        # 每个用户的每个终端一个会话，登录时按此条件upsert
+        Index([("user_id", 1), ("terminal", 1)], "user_id_terminal_unique", unique=True),
+        # 令牌过期后会话自动删除
+        Index([("expires_at", 1)], "expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "store": [
+        Index([("store_id", 1)], "store_id_1", unique=True),
+    ],
+    "catalog": [
+        # 全文索引覆盖title、tags、content、book_intro、author、publisher，并设置权重
+        # 每本书的书目只有一条，只被索引一次
+        Index(
+            [
+                ("title", "text"),
+                ("tags", "text"),
+                ("content", "text"),
+                ("book_intro", "text"),
+                ("author", "text"),
+                ("publisher", "text"),
+            ],
+            "book_text_index",
+            default_language="english",
+            weights={
+                "title": 10,
+                "tags": 6,
+                "book_intro": 5,
+                "content": 3,
+                "author": 2,
+                "publisher": 1,
+            },
+        ),
+        # 结构化筛选条件各自使用独立的索引，由查询规划器选择，tags为多键索引
+        Index([("author", 1)], "author_1"),
+        Index([("publisher", 1)], "publisher_1"),
+        Index([("tags", 1)], "tags_1"),
+        Index([("pub_year", 1)], "pub_year_1"),
+        # 进程内的检索、补全、相似图书索引按created_at增量拉取新书目
+        Index([("created_at", 1)], "created_at_1"),
+    ],
+    "inventory": [
+        # store_id和book_id的组合唯一，同一本书可以在不同商店中有各自的价格和库存
+        Index([("store_id", 1), ("book_id", 1)], "store_id_book_id_unique", unique=True),
+        # 搜索时按book_id关联各商店的库存记录
+        Index([("book_id", 1)], "book_id_1"),
+        # 按价格区间筛选：店铺内搜索使用(store_id, price)，全站搜索使用price
+        Index([("store_id", 1), ("price", 1)], "store_id_price"),
+        Index([("price", 1)], "price_1"),
+    ],
+    "order": [
+        # 一个订单一条记录，order_id全局唯一
+        Index([("order_id", 1)], "order_id_1", unique=True),
+        # 过期订单调度器按状态和付款截止时间范围查询待付款订单
+        Index([("status", 1), ("payment_deadline", 1)], "status_payment_deadline"),
+    ],
+    "facet_count": [
+        # 每个范围（全站或商店）、分面和取值一条计数，上架时按此条件upsert
+        Index([("scope", 1), ("facet", 1), ("value", 1)], "scope_facet_value_unique", unique=True),
+        # 按计数从高到低取每个分面的前若干个取值
+        Index([("scope", 1), ("facet", 1), ("count", -1), ("value", 1)], "scope_facet_count"),
+    ],
+    "lease": [
+        # 过期的租约和进程心跳文档在一分钟后自动删除
+        Index([("expires_at", 1)], "expires_at_ttl", expireAfterSeconds=60),
+    ],
+}
+
+# 已废弃、存在时需要删除的索引
+OBSOLETE_INDEXES = {
+    # 旧版本一本书一条订单记录时使用的复合唯一索引
+    "order": ["order_id_book_id_unique"],
+}
+
+
+def convert_line_orders(db) -> int:
+    """把旧版本“一本书一条记录”的订单合并为内嵌书籍明细的订单文档
+
+    旧记录的特征是顶层带有 book_id 字段。每个订单先以 order_id 为条件
+    upsert 合并后的订单文档，再删除旧记录，因此中途失败后可以重复执行。
+    返回转换的订单数。
+    """
+    pipeline = [
+        {"$match": {"book_id": {"$exists": True}}},
+        {"$sort": {"order_id": 1, "book_id": 1}},
+        {
+            "$group": {
+                "_id": "$order_id",
+                "buyer_id": {"$first": "$buyer_id"},
+                "store_id": {"$first": "$store_id"},
+                "status": {"$first": "$status"},
+                "created_at": {"$first": "$created_at"},
+                "payment_deadline": {"$first": "$payment_deadline"},
+                "total_price": {"$sum": "$total_price"},
+                "books": {
+                    "$push": {
+                        "book_id": "$book_id",
+                        "count": "$count",
+                        "total_price": "$total_price",
+                    }
+                },
+            }
+        },
+    ]
+    converted = 0
+    for group in db.order.aggregate(pipeline, allowDiskUse=True):
+        order_id = group.pop("_id")
+        for book in group["books"]:
+            # 旧记录只保存了该书籍总价，单价由总价和数量推出
+            book["price"] = book["total_price"] // book["count"] if book["count"] else 0
+        group["order_id"] = order_id
+        db.order.replace_one(
+            {"order_id": order_id, "book_id": {"$exists": False}}, group, upsert=True
+        )
+        db.order.delete_many({"order_id": order_id, "book_id": {"$exists": True}})
+        converted = converted + 1
+    if converted:
+        logging.info("converted {} line orders".format(converted))
+    return converted
+
+
+# 按版本号顺序执行的数据迁移：(版本号, 说明, 迁移函数)
+# 迁移函数必须可以重复执行，执行成功后 schema_version 才会更新到该版本
+MIGRATIONS = [
+    (1, "merge per-line orders into order documents", convert_line_orders),
+    (2, "move embedded book pictures into the picture blob store", picture.move_embedded_pictures),
+    (3, "split book into shared catalog and per-store inventory", catalog.split_book_collection),
+    (4, "count search facets of existing listings", facet.rebuild_counts),
+    (5, "move login tokens from user documents into sessions", session.move_user_tokens),
+]
+
+
+class Action:
+    """迁移计划中的一步操作"""
+
+    def __init__(self, kind: str, collection: str, name: str, detail: str = "", run=None, background=False):
+        self.kind = kind
+        self.collection = collection
+        self.name = name
+        self.detail = detail
+        self.run = run
+        self.background = background
+
+    def __str__(self):
+        text = "{:<14} {}.{}".format(self.kind, self.collection, self.name)
+        if self.detail:
+            text = "{}  ({})".format(text, self.detail)
+        if self.background:
+            text = text + "  [background]"
+        return text
+
+
+def current_version(db) -> int:
+    doc = db.schema_version.find_one({"_id": SCHEMA_VERSION_ID})
+    return doc["version"] if doc else 0
+
+
+def _set_version(db, version: int, description: str):
+    db.schema_version.update_one(
+        {"_id": SCHEMA_VERSION_ID},
+        {
+            "$set": {"version": version, "updated_at": datetime.now()},
+            "$push": {"history": {"version": version, "description": description, "applied_at": datetime.now()}},
+        },
+        upsert=True,
+    )
+
+
+def plan(db) -> [Action]:
+    """对比 schema_version 与 MIGRATIONS、list_indexes() 与 INDEXES，返回需要执行的操作"""
+    actions = []
+    version = current_version(db)
+    for migration_version, description, fn in MIGRATIONS:
+        if migration_version > version:
+            actions.append(Action(
+                "migrate", "schema_version", str(migration_version), description,
+                run=lambda fn=fn, v=migration_version, d=description: (fn(db), _set_version(db, v, d)),
+            ))
+
+    collection_names = set(db.list_collection_names())
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        existing = {}
+        if collection_name in collection_names:
+            existing = {info["name"]: info for info in collection.list_indexes()}
+        large = bool(existing) and collection.estimated_document_count() > BACKGROUND_THRESHOLD
+
+        for name in OBSOLETE_INDEXES.get(collection_name, []):
+            if name in existing:
+                actions.append(Action(
+                    "drop_index", collection_name, name,
+                    run=lambda c=collection, n=name: c.drop_index(n),
+                ))
+
+        for index in indexes:
+            background = large and not index.options.get("unique", False)
+            if index.name not in existing:
+                actions.append(Action(
+                    "create_index", collection_name, index.name,
+                    run=lambda c=collection, i=index: i.create(c),
+                    background=background,
+                ))
+            elif not index.matches(existing[index.name]):
+                actions.append(Action(
+                    "rebuild_index", collection_name, index.name, "definition changed",
+                    run=lambda c=collection, i=index: (c.drop_index(i.name), i.create(c)),
+                    background=background,
+                ))
+    return actions
+
+
+def apply(db, actions: [Action] = None, background: bool = True) -> threading.Thread:
+    """执行迁移计划
+
+    数据迁移、索引删除和唯一索引等需要立即生效的操作同步执行；
+    background 为 True 时大集合上的非唯一索引在后台线程中创建，返回该线程。
+    """
+    if actions is None:
+        actions = plan(db)
+    deferred = []
+    for action in actions:
+        if background and action.background:
+            deferred.append(action)
+            continue
+        logging.info("migration: {}".format(action))
+        action.run()
+    if not deferred:
+        return None
+
+    def run_deferred():
+        for action in deferred:
+            try:
+                logging.info("migration (background): {}".format(action))
+                action.run()
+            except Exception as e:
+                logging.error("后台迁移失败 {}: {}".format(action, str(e)))
+
+    thread = threading.Thread(target=run_deferred, name="migration", daemon=True)
+    thread.start()
+    return thread
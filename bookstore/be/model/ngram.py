@@ -0,0 +1,256 @@
+import logging
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from datetime import timedelta
+from be.model import db_conn
+from be.model import metrics
+from be.model import migration
+
+# 进程内的n-gram倒排索引：Mongo的$text索引按英文分词，无法切分中文，
+# 标题、标签、简介中间的中文词搜不到。这里把中文按单字和相邻两字切分，
+# 英文和数字按整词切分，用BM25打分。
+
+# 距上次增量刷新超过该秒数时，搜索前先从catalog拉取新书目
+REFRESH_INTERVAL = float(os.environ.get("BOOKSTORE_NGRAM_REFRESH", "5"))
+# 增量刷新时向前多取的秒数，避免遗漏写入时间早于水位线、提交时间晚于水位线的书目
+REFRESH_OVERLAP = 5
+
+# BM25参数
+K1 = 1.2
+B = 0.75
+
+CJK_RANGES = "㐀-䶿一-鿿豈-﫿"
+TOKEN_RE = re.compile("([{0}]+)|([^\\W_{0}]+)".format(CJK_RANGES))
+
+
+def field_weights() -> dict:
+    # 字段权重与catalog上的文本索引保持一致
+    for index in migration.INDEXES["catalog"]:
+        if index.is_text:
+            weights = index.options.get("weights", {})
+            return {field: weights.get(field, 1) for field, _ in index.keys}
+    return {"title": 1}
+
+
+def tokenize(text: str, for_query: bool = False) -> [[str]]:
+    """把文本切分为词，每个词展开为若干个n-gram
+
+    建索引时中文连续段同时产生单字和相邻两字；查询时两字以上的中文词只用两字gram，
+    一个查询词的所有gram都出现才算命中，效果接近子串匹配。
+    """
+    words = []
+    for cjk, other in TOKEN_RE.findall(text.lower()):
+        if other:
+            words.append([other])
+            continue
+        bigrams = [cjk[i:i + 2] for i in range(len(cjk) - 1)]
+        if for_query:
+            words.append(bigrams or [cjk])
+        else:
+            words.append(list(cjk) + bigrams)
+    return words
+
+
+def field_text(value) -> str:
+    if isinstance(value, list):
+        return " ".join(str(v) for v in value)
+    return str(value or "")
+
+
+class Postings:
+    """一个版本的倒排数据
+
+    每本书分配一个递增的文档号；每个gram的倒排表为三个紧凑数组：
+    文档号array('I')（递增）、加权词频array('f')和出现字段的位掩码array('H')。
+    新书只追加到数组末尾，倒排表始终有序，增量更新不需要重建。
+    """
+
+    def __init__(self, weights: dict, field_bits: dict):
+        self.weights = weights
+        self.field_bits = field_bits
+        self.book_ids = []
+        self.doc_of = {}
+        self.doc_len = array("f")
+        self.total_len = 0.0
+        self.postings = {}
+        self.watermark = None
+
+    def add(self, doc: dict):
+        # doc为catalog文档，已索引的书目忽略
+        book_id = doc["_id"]
+        if book_id in self.doc_of:
+            return
+        tf = {}
+        masks = {}
+        length = 0.0
+        for field, weight in self.weights.items():
+            for word in tokenize(field_text(doc.get(field))):
+                for gram in word:
+                    tf[gram] = tf.get(gram, 0.0) + weight
+                    masks[gram] = masks.get(gram, 0) | self.field_bits[field]
+                    length = length + weight
+        docno = len(self.book_ids)
+        self.book_ids.append(book_id)
+        self.doc_of[book_id] = docno
+        self.doc_len.append(length)
+        self.total_len = self.total_len + length
+        for gram, freq in tf.items():
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = (array("I"), array("f"), array("H"))
+                self.postings[gram] = posting
+            posting[0].append(docno)
+            posting[1].append(freq)
+            posting[2].append(masks[gram])
+        created_at = doc.get("created_at")
+        if created_at is not None and (self.watermark is None or created_at > self.watermark):
+            self.watermark = created_at
+
+
+class NgramIndex(db_conn.DBConn):
+    """catalog的内存倒排索引
+
+    全量构建在锁外填充一个新的Postings，完成后在锁内替换；增量拉取也在锁外查询，只在追加时持有锁。
+    构建和拉取由refresh_lock串行化，期间搜索和上架不被阻塞（构建完成前的搜索等待构建结束）。
+    """
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+        self.weights = field_weights()
+        self.field_bits = {field: 1 << i for i, field in enumerate(self.weights)}
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.data = Postings(self.weights, self.field_bits)
+        self.loaded = False
+        self.last_refresh = 0.0
+        self.stats = {"queries": 0, "build_documents": 0, "refresh_documents": 0}
+        metrics.register("ngram_index", self.snapshot)
+
+    def add(self, doc: dict):
+        with self.lock:
+            self.data.add(doc)
+
+    def fetch(self, query: dict = None) -> [dict]:
+        projection = {field: 1 for field in self.weights}
+        projection["created_at"] = 1
+        return list(self.conn.catalog.find(query or {}, projection).sort("created_at", 1))
+
+    def ensure_fresh(self):
+        # 第一次使用时全量构建，之后按created_at增量拉取其他进程写入的书目
+        now = time.time()
+        with self.lock:
+            loaded = self.loaded
+            if loaded and now - self.last_refresh < REFRESH_INTERVAL:
+                return
+        # 构建完成前的查询等待构建结束；已构建时不等待其他线程正在进行的拉取
+        if not self.refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            with self.lock:
+                if not loaded and self.loaded:
+                    return
+                self.last_refresh = now
+                watermark = self.data.watermark
+            if not loaded:
+                start = time.time()
+                docs = self.fetch()
+                data = Postings(self.weights, self.field_bits)
+                for doc in docs:
+                    data.add(doc)
+                with self.lock:
+                    self.data = data
+                    self.loaded = True
+                    self.stats["build_documents"] = len(docs)
+                logging.info("ngram index built: %d documents in %.2fs", len(docs), time.time() - start)
+            else:
+                query = {}
+                if watermark is not None:
+                    query = {"created_at": {"$gte": watermark - timedelta(seconds=REFRESH_OVERLAP)}}
+                docs = self.fetch(query)
+                with self.lock:
+                    for doc in docs:
+                        self.data.add(doc)
+                    self.stats["refresh_documents"] = self.stats["refresh_documents"] + len(docs)
+        finally:
+            self.refresh_lock.release()
+
+    def score_word(self, data: Postings, grams: [str], n_docs: int, avg_len: float, field_mask: int) -> dict:
+        # 一个查询词的所有gram都在指定字段中命中的文档及其BM25分数；从最短的倒排表开始求交
+        postings = []
+        for gram in set(grams):
+            posting = data.postings.get(gram)
+            if posting is None:
+                return {}
+            postings.append(posting)
+        postings.sort(key=lambda p: len(p[0]))
+        scores = None
+        for docs, tfs, masks in postings:
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            current = {}
+            for docno, tf, mask in zip(docs, tfs, masks):
+                if not mask & field_mask or (scores is not None and docno not in scores):
+                    continue
+                norm = K1 * (1 - B + B * data.doc_len[docno] / avg_len)
+                current[docno] = (scores[docno] if scores is not None else 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+            scores = current
+            if not scores:
+                return {}
+        return scores
+
+    def search(self, keyword: str, fields: [str] = None) -> [(str, float)]:
+        """返回[(book_id, 分数)]，按分数降序、book_id升序；多个查询词之间为“或”
+
+        fields给出时只匹配这些字段中出现的词，分数仍按全部字段的加权词频计算。
+        """
+        self.ensure_fresh()
+        field_mask = 0
+        for field in fields or self.weights:
+            field_mask = field_mask | self.field_bits[field]
+        with self.lock:
+            data = self.data
+            n_docs = len(data.book_ids)
+            if n_docs == 0:
+                return []
+            avg_len = data.total_len / n_docs or 1.0
+            scores = {}
+            for grams in tokenize(keyword, for_query=True):
+                for docno, score in self.score_word(data, grams, n_docs, avg_len, field_mask).items():
+                    scores[docno] = scores.get(docno, 0.0) + score
+            ranked = [(data.book_ids[docno], score) for docno, score in scores.items()]
+            self.stats["queries"] = self.stats["queries"] + 1
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+        return ranked
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            data = dict(self.stats)
+            data["documents"] = len(self.data.book_ids)
+            data["grams"] = len(self.data.postings)
+        return data
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> NgramIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = NgramIndex()
+        return _index
+
+
+def warm_up():
+    # 启动时在后台线程中构建索引，构建完成前的查询会等待构建结束
+    threading.Thread(target=get_index().ensure_fresh, name="ngram-build", daemon=True).start()
+
+
+def index_book(doc: dict):
+    # 上架新书目时立即加入本进程的索引；索引尚未构建时由构建或之后的增量拉取加入
+    if _index is not None and _index.loaded:
+        _index.add(doc)
@@ -0,0 +1,180 @@
+import uuid
+from datetime import timedelta
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from be.model import error
+from be.model import txn
+
+# 订单相关的纯逻辑：校验、订单文档和批量写请求的构造。同步（be.model.buyer）和asyncio（be.model.aio.buyer）
+# 两条路径共用，它们只负责读写数据库
+
+# 下单后的付款期限
+PAYMENT_WINDOW = timedelta(hours=1)
+
+# 下单时读取的上架记录字段
+INVENTORY_PROJECTION = {"_id": 0, "book_id": 1, "price": 1, "stock_level": 1}
+# 取消订单时取回的字段：恢复库存和撤销取消所需的信息
+CANCEL_PROJECTION = {"_id": 0, "order_id": 1, "store_id": 1, "books": 1, "payment_deadline": 1}
+
+
+def new_order_id(user_id: str, store_id: str) -> str:
+    return "{}_{}_{}".format(user_id, store_id, str(uuid.uuid1()))
+
+
+def merge_counts(id_and_count: [(str, int)]) -> dict:
+    # 合并同一本书的多次购买，保持下单顺序
+    book_counts = {}
+    for book_id, count in id_and_count:
+        book_counts[book_id] = book_counts.get(book_id, 0) + count
+    return book_counts
+
+
+def inventory_query(store_id: str, book_counts: dict) -> dict:
+    return {"store_id": store_id, "book_id": {"$in": list(book_counts.keys())}}
+
+
+def order_lines(book_counts: dict, book_details: dict) -> [dict]:
+    """按下单顺序生成订单内嵌的书籍明细：单价、数量和该书籍总价（数量*单价）
+
+    book_details为book_id到上架记录的映射；书籍未上架或库存不足时抛出txn.Abort。
+    """
+    order_books = []
+    for book_id, count in book_counts.items():
+        book_detail = book_details.get(book_id)
+        if book_detail is None:
+            raise txn.Abort(*error.error_non_exist_book_id(book_id))
+        if book_detail["stock_level"] < count:
+            raise txn.Abort(*error.error_stock_level_low(book_id))
+        order_books.append({
+            "book_id": book_id,
+            "count": count,
+            "price": book_detail["price"],
+            "total_price": book_detail["price"] * count,
+        })
+    return order_books
+
+
+def decrement_requests(store_id: str, book_counts: dict) -> [UpdateOne]:
+    """下单时按book_counts的顺序扣减库存的有序bulk_write请求
+
+    扣减带库存条件，防止并发下单导致库存为负。不满足条件的一行按upsert插入同一(store_id, book_id)，
+    触发store_id_book_id_unique唯一键冲突，有序bulk_write在这一行停止：之前的行已扣减，之后的行未执行。
+    上架记录在下单前已查到，不会被删除，因此upsert不会真正插入。
+    """
+    return [
+        UpdateOne(
+            {"store_id": store_id, "book_id": book_id, "stock_level": {"$gte": count}},
+            {"$inc": {"stock_level": -count}},
+            upsert=True,
+        )
+        for book_id, count in book_counts.items()
+    ]
+
+
+def short_line(e: BulkWriteError) -> int:
+    # 库存不足的一行在decrement_requests中的位置，其他写错误原样抛出
+    errors = e.details.get("writeErrors") or []
+    if not errors or errors[0].get("code") != 11000:
+        raise e
+    return errors[0]["index"]
+
+
+def settle_decrement(book_counts: dict, applied: int, undo: list, restore_fn):
+    """为前applied行已生效的扣减登记补偿（restore_fn(book_id, count)返回加回库存的动作）
+
+    有库存不足的一行时抛出txn.Abort：事务模式下事务中止，已生效的扣减一并回滚，补偿模式下执行登记的补偿。
+    """
+    lines = list(book_counts.items())
+    for book_id, count in lines[:applied]:
+        undo.append(restore_fn(book_id, count))
+    if applied < len(lines):
+        raise txn.Abort(*error.error_stock_level_low(lines[applied][0]))
+
+
+def order_document(order_id: str, user_id: str, store_id: str, order_books: [dict], created_at) -> dict:
+    # 一个订单一条记录，status="pending"表示提交订单，到payment_deadline未付款自动取消
+    return {
+        "order_id": order_id,
+        "buyer_id": user_id,
+        "store_id": store_id,
+        "books": order_books,
+        "total_price": sum(book["total_price"] for book in order_books),
+        "status": "pending",
+        "created_at": created_at,
+        "payment_deadline": created_at + PAYMENT_WINDOW,
+    }
+
+
+def restock_requests(orders) -> [UpdateOne]:
+    # 恢复一批订单中所有书籍库存的请求，orders中每项包含store_id和内嵌的books明细；
+    # 同一商店同一本书的数量先合并，只产生一次更新
+    counts = {}
+    for order in orders:
+        for book in order["books"]:
+            key = (order["store_id"], book["book_id"])
+            counts[key] = counts.get(key, 0) + book["count"]
+    return [
+        UpdateOne({"store_id": store_id, "book_id": book_id}, {"$inc": {"stock_level": count}})
+        for (store_id, book_id), count in counts.items()
+    ]
+
+
+def check_payment(user_id: str, password: str, order_id: str, order: dict, buyer: dict, store_info: dict):
+    """付款前的校验，通过时返回None，否则返回错误(code, message)
+
+    order为None或已不是待付款状态时订单无效；余额在事务中按条件扣减时再次检查。
+    """
+    if order is None or order.get("status") != "pending":
+        return error.error_invalid_order_id(order_id)
+    if order["buyer_id"] != user_id:
+        return error.error_authorization_fail()
+    if buyer is None:
+        return error.error_non_exist_user_id(order["buyer_id"])
+    if password != buyer["password"]:
+        return error.error_authorization_fail()
+    if store_info is None:
+        return error.error_non_exist_store_id(order["store_id"])
+    if buyer["balance"] < order["total_price"]:
+        return error.error_not_sufficient_funds(order_id)
+    return None
+
+
+def check_cancel(user_id: str, password: str, order_id: str, order: dict, buyer: dict):
+    # 取消订单前的校验：只有买家本人可以取消自己的待付款订单
+    if order is None:
+        return error.error_invalid_order_id(order_id)
+    if order["buyer_id"] != user_id:
+        return error.error_authorization_fail()
+    if order.get("status") != "pending":
+        return error.error_invalid_order_id(order_id)
+    if buyer is None:
+        return error.error_non_exist_user_id(user_id)
+    if password != buyer["password"]:
+        return error.error_authorization_fail()
+    return None
+
+
+def check_owner(user_id: str, order_id: str, order: dict):
+    # 收货、查询订单前的校验：订单存在且属于该买家
+    if order is None:
+        return error.error_invalid_order_id(order_id)
+    if order["buyer_id"] != user_id:
+        return error.error_authorization_fail()
+    return None
+
+
+def order_view(order: dict) -> dict:
+    # query_order返回的订单，books中的price为该书籍总价
+    created_at = order["created_at"]
+    return {
+        "order_id": order["order_id"],
+        "buyer_id": order["buyer_id"],
+        "store_id": order["store_id"],
+        "status": order["status"],
+        "created_at": created_at.isoformat() if hasattr(created_at, 'isoformat') else str(created_at),
+        "books": [
+            {"book_id": book["book_id"], "count": book["count"], "price": book["total_price"]}
+            for book in order["books"]
+        ],
+        "total_price": order["total_price"],
+    }
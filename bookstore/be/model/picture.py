@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import gridfs
+from gridfs.errors import FileExists
+
+# 图片按内容的sha256寻址存放在GridFS（picture.files/picture.chunks）中，
+# 书籍文档只保存图片的sha256，不同商店、不同书籍中相同的图片只存一份
+PICTURE_BUCKET = "picture"
+
+
+def _fs(db):
+    return gridfs.GridFS(db, collection=PICTURE_BUCKET)
+
+
+def put_pictures(db, pictures: [str]) -> [str]:
+    """保存base64编码的图片，返回与输入一一对应的图片sha256列表"""
+    fs = _fs(db)
+    picture_ids = []
+    saved = set()
+    for encoded in pictures:
+        data = base64.b64decode(encoded)
+        picture_id = hashlib.sha256(data).hexdigest()
+        picture_ids.append(picture_id)
+        if picture_id in saved:
+            continue
+        saved.add(picture_id)
+        if fs.exists(picture_id):
+            continue
+        try:
+            fs.put(data, _id=picture_id)
+        except FileExists:
+            # 并发写入同一张图片，已由其他请求保存
+            pass
+    return picture_ids
+
+
+async def put_pictures_async(db, pictures: [str]) -> [str]:
+    """put_pictures的asyncio版本，db为AsyncMongoClient的数据库"""
+    fs = gridfs.AsyncGridFS(db, collection=PICTURE_BUCKET)
+    picture_ids = []
+    saved = set()
+    for encoded in pictures:
+        data = base64.b64decode(encoded)
+        picture_id = hashlib.sha256(data).hexdigest()
+        picture_ids.append(picture_id)
+        if picture_id in saved:
+            continue
+        saved.add(picture_id)
+        if await fs.exists(picture_id):
+            continue
+        try:
+            await fs.put(data, _id=picture_id)
+        except FileExists:
+            pass
+    return picture_ids
+
+
+def move_embedded_pictures(db) -> int:
+    """迁移：把书籍文档中内嵌的base64图片列表picture移入GridFS，改为picture_ids"""
+    moved = 0
+    for book in db.book.find({"picture": {"$exists": True}}, {"_id": 1, "picture": 1}):
+        picture_ids = put_pictures(db, book.get("picture") or [])
+        db.book.update_one(
+            {"_id": book["_id"]},
+            {"$set": {"picture_ids": picture_ids}, "$unset": {"picture": ""}},
+        )
+        moved = moved + 1
+    return moved
@@ -0,0 +1,137 @@
+import re
+from pymongo.errors import OperationFailure
+from be.model import db_conn
+
+# 估算候选索引的命中数时最多扫描的索引项数
+PROBE_LIMIT = 1000
+
+# 店铺内关键词搜索时，店铺的上架记录不超过这么多条，就先从inventory取出书目ID限定全文匹配的范围
+PREFILTER_LIMIT = 5000
+
+# 书目上的结构化筛选条件及其专用索引
+CATALOG_FILTER_INDEXES = {
+    "author": "author_1",
+    "publisher": "publisher_1",
+    "tag": "tags_1",
+    "pub_year": "pub_year_1",
+}
+
+
+def catalog_condition(name: str, value) -> dict:
+    if name == "tag":
+        # tags为数组，tags_1为多键索引
+        return {"tags": value}
+    if name == "pub_year":
+        # pub_year形如"2008-1"，按年份前缀匹配，锚定的前缀正则可以使用索引的范围扫描
+        return {"pub_year": {"$regex": "^" + re.escape(str(value))}}
+    return {name: value}
+
+
+def catalog_match(filters: dict) -> dict:
+    match = {}
+    for name in CATALOG_FILTER_INDEXES:
+        if filters.get(name) is not None:
+            match.update(catalog_condition(name, filters[name]))
+    return match
+
+
+def price_condition(filters: dict) -> dict:
+    condition = {}
+    if filters.get("min_price") is not None:
+        condition["$gte"] = filters["min_price"]
+    if filters.get("max_price") is not None:
+        condition["$lte"] = filters["max_price"]
+    return condition
+
+
+def inventory_match(store_id: str, filters: dict) -> dict:
+    match = {}
+    if store_id is not None:
+        match["store_id"] = store_id
+    price = price_condition(filters)
+    if price:
+        match["price"] = price
+    return match
+
+
+class Plan:
+    """一次搜索的执行计划
+
+    driver为驱动查询的数据源：text（catalog的全文索引）、ngram（进程内n-gram索引）、
+    catalog或inventory（按index指定的普通索引读取，再关联另一个集合）。
+    prefilter为真时，全文匹配限定在先从inventory按商店取出的书目ID中。
+    """
+
+    def __init__(
+        self, driver: str, index: str = None, reason: str = "", estimates: dict = None, prefilter: bool = False
+    ):
+        self.driver = driver
+        self.index = index
+        self.reason = reason
+        self.estimates = estimates or {}
+        self.prefilter = prefilter
+
+    def to_dict(self) -> dict:
+        return {
+            "driver": self.driver,
+            "index": self.index,
+            "reason": self.reason,
+            "estimates": self.estimates,
+            "prefilter": self.prefilter,
+        }
+
+
+class Planner(db_conn.DBConn):
+    """为搜索请求选择代价最低的索引"""
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+
+    def candidates(self, store_id: str, filters: dict) -> [(str, str, dict)]:
+        # 每个可用的索引对应一个(集合, 索引名, 该索引能处理的查询条件)
+        result = []
+        for name, index in CATALOG_FILTER_INDEXES.items():
+            if filters.get(name) is not None:
+                result.append(("catalog", index, catalog_condition(name, filters[name])))
+        if price_condition(filters):
+            index = "store_id_price" if store_id is not None else "price_1"
+            result.append(("inventory", index, inventory_match(store_id, filters)))
+        elif store_id is not None:
+            result.append(("inventory", "store_id_book_id_unique", {"store_id": store_id}))
+        return result
+
+    def plan(self, keyword: str, fields: [str], store_id: str, filters: dict, engine: str) -> Plan:
+        if keyword and fields:
+            # 只有n-gram索引记录了每个gram出现在哪些字段
+            return Plan("ngram", reason="fields scoped keyword search")
+        if keyword and engine == "text" and store_id is not None:
+            # 店铺内搜索：店铺的上架记录较少时先按(store_id, book_id)索引取出书目ID，与全文匹配取交集，
+            # 不为店铺外的全站匹配逐本关联inventory
+            n = self.conn.inventory.count_documents(inventory_match(store_id, filters), limit=PREFILTER_LIMIT + 1)
+            if n <= PREFILTER_LIMIT:
+                return Plan(
+                    "text", "book_text_index", reason="store scoped keyword search",
+                    estimates={"store_listings": n}, prefilter=True
+                )
+        if keyword:
+            # 其他筛选条件在全文匹配的结果上过滤
+            index = "book_text_index" if engine == "text" else None
+            return Plan(engine, index, reason="keyword search")
+
+        # 只有筛选条件：用有限的计数探测每个候选索引的命中数，选择命中最少的索引驱动查询，
+        # 其余条件在关联后过滤
+        best = None
+        estimates = {}
+        for collection, index, query in self.candidates(store_id, filters):
+            try:
+                n = self.conn[collection].count_documents(query, hint=index, limit=PROBE_LIMIT)
+            except OperationFailure:
+                # 索引还在后台构建或尚未创建
+                continue
+            estimates[index] = n
+            if best is None or n < best[0]:
+                best = (n, collection, index)
+        if best is None:
+            collection = "inventory" if store_id is not None or price_condition(filters) else "catalog"
+            return Plan(collection, reason="no usable index", estimates=estimates)
+        return Plan(best[1], best[2], reason="fewest matching index keys", estimates=estimates)
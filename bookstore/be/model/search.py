@@ -0,0 +1,551 @@
+import bisect
+import os
+from concurrent.futures import ThreadPoolExecutor
+from be.model import db_conn
+from be.model import search_cache
+from be.model import ngram
+from be.model import planner
+from be.model import facet
+from be.model import snippet
+from be.model import singleflight
+from be.model import cursor as cursor_token
+
+# 检索后端：text为Mongo的$text索引，ngram为进程内的n-gram倒排索引（支持中文）
+ENGINES = ("text", "ngram")
+DEFAULT_ENGINE = os.environ.get("BOOKSTORE_SEARCH_ENGINE", "text")
+
+# 结果视图：full返回完整书目字段，compact只返回ID、书名、作者、价格、商店和简介摘要
+VIEWS = ("full", "compact")
+# compact视图去掉的字段
+COMPACT_DROPPED = ("publisher", "tags", "book_intro")
+
+# 近似总数模式下最多统计的上架记录数；n-gram检索总是最多保留这么多本匹配的书目
+APPROX_TOTAL_CAP = 1000
+
+# n-gram检索第一批查询上架记录的书目数，之后每批加倍
+LISTING_CHUNK = 100
+
+# 结果的排序键：相关性分数降序，其次书目ID、商店ID升序，保证顺序确定；
+# 没有关键词、只按条件筛选时分数都为0
+SORT_KEY = [("score", -1), ("_id", 1), ("inventory.store_id", 1)]
+
+# 按书目合并时每本书只有一行，排序键不含商店ID
+GROUP_SORT_KEY = [("score", -1), ("_id", 1)]
+
+# 可以限定的关键词匹配字段，content即目录
+FIELDS = tuple(ngram.field_weights())
+
+# 结构化筛选条件：作者、出版社、标签精确匹配，出版年份前缀匹配，价格区间
+FILTERS = ("author", "publisher", "tag", "pub_year", "min_price", "max_price")
+
+# 批量搜索一次最多包含的查询数，以及并发执行这些查询的线程数（各进程一个线程池）
+BATCH_MAX = 20
+BATCH_WORKERS = int(os.environ.get("BOOKSTORE_SEARCH_BATCH_WORKERS", "8"))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="search-batch")
+
+# 同时到达的相同搜索只执行一次
+flights = singleflight.Group("search_singleflight")
+
+BOOK_PROJECTION = {"_id": 1, "title": 1, "author": 1, "publisher": 1, "tags": 1, "book_intro": 1}
+
+# 按书目合并各商店上架记录时的累加字段：最低价格、总库存、商店ID列表和商店数
+GROUP_FIELDS = {
+    "min_price": {"$min": "$price"},
+    "total_stock": {"$sum": "$stock_level"},
+    "store_ids": {"$push": "$store_id"},
+    "store_count": {"$sum": 1},
+}
+
+
+def group_listings(listings: [dict]) -> [dict]:
+    # 进程内按书目合并上架记录，listings须已按(书目, 商店)排序；与GROUP_FIELDS的含义一致
+    groups = []
+    for item in listings:
+        if not groups or groups[-1]["book_id"] != item["book_id"]:
+            groups.append({"book_id": item["book_id"], "min_price": None, "total_stock": 0, "store_ids": []})
+        group = groups[-1]
+        price = item.get("price")
+        if price is not None and (group["min_price"] is None or price < group["min_price"]):
+            group["min_price"] = price
+        group["total_stock"] = group["total_stock"] + (item.get("stock_level") or 0)
+        group["store_ids"].append(item["store_id"])
+    for group in groups:
+        group["store_count"] = len(group["store_ids"])
+    return groups
+
+
+def explain_summary(explain: dict) -> dict:
+    # 收集explain输出中出现的执行阶段和索引，确认没有全集合扫描
+    stages = set()
+    indexes = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "stage" and isinstance(value, str):
+                    stages.add(value)
+                elif key == "indexName" and isinstance(value, str):
+                    indexes.add(value)
+                elif key == "indexesUsed" and isinstance(value, list):
+                    indexes.update(v for v in value if isinstance(v, str))
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain)
+    return {"stages": sorted(stages), "indexes": sorted(indexes), "collscan": "COLLSCAN" in stages}
+
+
+class SearchQuery:
+    """一次搜索的条件：关键词（只按条件筛选时为空）、范围、限定字段和结构化筛选条件"""
+
+    def __init__(
+        self, keyword: str, store_id: str = None, fields: [str] = None, filters: dict = None,
+        approx_total: bool = False, engine: str = None, grouped: bool = False
+    ):
+        self.keyword = keyword or ""
+        self.store_id = store_id
+        self.fields = sorted(fields) if fields else None
+        self.filters = {name: value for name, value in (filters or {}).items() if value is not None}
+        self.approx_total = approx_total
+        self.grouped = grouped
+        self.engine = engine or DEFAULT_ENGINE
+        if self.engine not in ENGINES:
+            raise ValueError("unknown search engine {}".format(self.engine))
+
+    def options(self) -> dict:
+        # 除关键词、范围和分页外影响结果的参数，用于缓存键和游标
+        return {
+            "approx_total": self.approx_total,
+            "engine": self.engine,
+            "fields": tuple(self.fields or ()),
+            "filters": tuple(sorted(self.filters.items())),
+            "grouped": self.grouped,
+        }
+
+    @property
+    def sort_key(self) -> list:
+        return GROUP_SORT_KEY if self.grouped else SORT_KEY
+
+    def fingerprint(self) -> str:
+        return cursor_token.fingerprint(
+            search_cache.normalize_keyword(self.keyword), self.store_id, sorted(self.options().items())
+        )
+
+
+class BookSearch(db_conn.DBConn):
+    """图书搜索：在catalog上匹配书目，再关联inventory得到各商店的上架记录"""
+
+    def __init__(self, engine: str = None):
+        db_conn.DBConn.__init__(self)
+        self.engine = engine
+
+    def inventory_lookup(self, store_id: str = None, price: dict = None, grouped: bool = False) -> dict:
+        # 关联该书在各商店（或指定商店）的库存记录，只取价格和商店ID；
+        # grouped时在子管道内合并为一条，得到最低价格、总库存和商店ID列表
+        match = {"$expr": {"$eq": ["$book_id", "$$book_id"]}}
+        if store_id is not None:
+            match["store_id"] = store_id
+        if price:
+            match["price"] = price
+        pipeline = [{"$match": match}, {"$sort": {"store_id": 1}}]
+        if grouped:
+            pipeline += [{"$group": dict(_id=None, **GROUP_FIELDS)}, {"$project": {"_id": 0}}]
+        else:
+            pipeline.append({"$project": {"_id": 0, "store_id": 1, "price": 1}})
+        return {
+            "$lookup": {
+                "from": "inventory",
+                "let": {"book_id": "$_id"},
+                "pipeline": pipeline,
+                "as": "group" if grouped else "inventory",
+            }
+        }
+
+    def catalog_lookup(self, filters: dict, grouped: bool = False) -> list:
+        # 以库存记录驱动时关联书目，书目上的筛选条件在关联时过滤；grouped时先按书目合并上架记录
+        match = {"$expr": {"$eq": ["$_id", "$$book_id"]}}
+        match.update(planner.catalog_match(filters))
+        stages = []
+        if grouped:
+            stages = [
+                {"$sort": {"book_id": 1, "store_id": 1}},
+                {"$group": dict(_id="$book_id", **GROUP_FIELDS)},
+            ]
+            listing = {"group": {name: "$" + name for name in GROUP_FIELDS}}
+        else:
+            listing = {"inventory": {"store_id": "$store_id", "price": "$price"}}
+        return stages + [
+            {
+                "$lookup": {
+                    "from": "catalog",
+                    "let": {"book_id": "$_id" if grouped else "$book_id"},
+                    "pipeline": [{"$match": match}, {"$project": dict(BOOK_PROJECTION, **facet.BOOK_FIELDS)}],
+                    "as": "book",
+                }
+            },
+            {"$unwind": "$book"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$book", dict(listing, score=0.0)]}}},
+        ]
+
+    def search(
+        self, keyword: str, store_id: str = None, page: int = 1, limit: int = 10, approx_total: bool = False,
+        cursor: str = None, fields: [str] = None, filters: dict = None, explain: bool = False, facets: bool = False,
+        grouped: bool = False, view: str = "full"
+    ) -> dict:
+        query = SearchQuery(keyword, store_id, fields, filters, approx_total, self.engine, grouped)
+        if view not in VIEWS:
+            raise ValueError("unknown view {}".format(view))
+
+        # 相同的条件和分页直接返回缓存的结果页；explain请求总是实际执行
+        key = search_cache.make_key(
+            store_id, query.keyword, page, limit, cursor=cursor, facets=facets, view=view, **query.options()
+        )
+        if explain:
+            return self.run(query, key, page, limit, cursor, explain, facets, view)
+        data = search_cache.cache.get(key)
+        if data is not None:
+            return data
+
+        # 缓存未命中时，并发的相同请求（同一个缓存键）合并为一次执行，共享结果和写入缓存的结果页
+        return flights.do(key, lambda: self.run(query, key, page, limit, cursor, explain, facets, view))
+
+    def run(
+        self, query: SearchQuery, key: tuple, page: int, limit: int, cursor: str, explain: bool, facets: bool,
+        view: str
+    ) -> dict:
+        store_id = query.store_id
+        generation = search_cache.cache.snapshot_generation(store_id)
+
+        # 游标格式错误或不属于该查询时抛出InvalidCursor
+        last, extra = None, {}
+        if cursor:
+            last, extra = cursor_token.decode(cursor, query.fingerprint())
+            if len(last) != len(query.sort_key):
+                raise cursor_token.InvalidCursor("malformed cursor")
+
+        plan = planner.Planner().plan(query.keyword, query.fields, store_id, query.filters, query.engine)
+        if plan.driver == "ngram":
+            data = self.execute_ngram(query, page, limit, last, extra, explain, facets)
+        elif last is not None:
+            # 分面和总数一样只在第一页统计
+            data = self.execute_after(query, plan, last, extra, limit, explain)
+        else:
+            data = self.execute(query, plan, page, limit, explain, facets)
+        if view == "compact":
+            self.compact(query, data)
+        if explain:
+            data["plan"] = dict(plan.to_dict(), **data.pop("explain"))
+        else:
+            # 合并结果依赖书目所在的所有商店，其中任一商店的价格、库存变化都使该页失效
+            stores = []
+            for book in data["books"]:
+                stores.extend(book["store_ids"] if query.grouped else [book["belong_store_id"]])
+            search_cache.cache.put(key, data, stores, generation)
+        return data
+
+    def rows_pipeline(self, query: SearchQuery, plan: planner.Plan, last: list = None, limit: int = None) -> list:
+        """按query.sort_key顺序产生上架记录（grouped时为合并后的书目）的聚合管道，
+        last给出时只产生排序在其之后的记录
+        """
+        price = planner.price_condition(query.filters)
+        sort_key = query.sort_key
+        if plan.driver == "inventory":
+            pipeline = [{"$match": planner.inventory_match(query.store_id, query.filters)}]
+            pipeline += self.catalog_lookup(query.filters, query.grouped)
+            if last is not None:
+                pipeline.append({"$match": cursor_token.after(sort_key, last)})
+            return pipeline + [{"$sort": dict(sort_key)}]
+
+        match = planner.catalog_match(query.filters)
+        if plan.driver == "text":
+            # $text按关键词匹配书目，每本书的书目只被索引一次；分数存为普通字段以便排序和比较
+            match["$text"] = {"$search": query.keyword}
+            score = {"$meta": "textScore"}
+            if plan.prefilter:
+                match["_id"] = {"$in": self.store_books(query)}
+        else:
+            score = {"$literal": 0.0}
+        pipeline = [{"$match": match}, {"$addFields": {"score": score}}]
+        # grouped时每个书目关联出一条合并记录，没有上架记录的书目被$unwind去掉
+        lookup = [
+            self.inventory_lookup(query.store_id, price, query.grouped),
+            {"$unwind": "$group" if query.grouped else "$inventory"},
+        ]
+        if last is None:
+            # 按相关性分数排序后展开为每个商店一条上架记录
+            return pipeline + [{"$sort": {"score": -1, "_id": 1}}] + lookup
+
+        if query.grouped:
+            # 每个书目只有一行，按(分数, 书目ID)过滤即得到续页
+            return pipeline + [
+                {"$match": cursor_token.after(GROUP_SORT_KEY, last)},
+                {"$sort": {"score": -1, "_id": 1}},
+            ] + lookup
+
+        # 关联库存之前先按(分数, 书目ID)粗过滤，游标所在的书目可能还有未返回的商店，取等号保留
+        pipeline += [
+            {"$match": cursor_token.after(SORT_KEY, last, inclusive_prefix=2)},
+            {"$sort": {"score": -1, "_id": 1}},
+        ]
+        if plan.prefilter or (query.store_id is None and not price):
+            # 全站范围内（或限定在店铺上架的书目中时）每个书目至少有一条符合条件的上架记录，
+            # limit+1个书目足以凑满一页
+            pipeline.append({"$limit": limit + 1})
+        return pipeline + lookup + [
+            {"$match": cursor_token.after(SORT_KEY, last)},
+            {"$sort": dict(SORT_KEY)},
+        ]
+
+    def store_books(self, query: SearchQuery) -> list:
+        # 店铺内符合价格条件的书目ID，按(store_id, book_id)索引只读取索引项
+        condition = planner.inventory_match(query.store_id, query.filters)
+        options = {} if "price" in condition else {"hint": "store_id_book_id_unique"}
+        return [item["book_id"] for item in self.conn.inventory.find(condition, {"_id": 0, "book_id": 1}, **options)]
+
+    def aggregate(self, plan: planner.Plan, pipeline: list, explain: bool) -> (list, dict):
+        # 按计划选定的集合和索引执行聚合；explain时另外取得执行计划摘要
+        collection = "inventory" if plan.driver == "inventory" else "catalog"
+        options = {"hint": plan.index} if plan.index and plan.driver != "text" else {}
+        summary = None
+        if explain:
+            summary = explain_summary(
+                self.conn.command("aggregate", collection, pipeline=pipeline, explain=True, **options)
+            )
+        return list(self.conn[collection].aggregate(pipeline, **options)), summary
+
+    def execute(
+        self, query: SearchQuery, plan: planner.Plan, page: int = 1, limit: int = 10, explain: bool = False,
+        facets: bool = False
+    ) -> dict:
+        # 计算分页参数
+        skip = (page - 1) * limit
+
+        pipeline = self.rows_pipeline(query, plan)
+        if query.approx_total:
+            # 近似总数：最多数到APPROX_TOTAL_CAP条上架记录，超过时返回“至少N条”
+            pipeline.append({"$limit": max(APPROX_TOTAL_CAP, skip + limit)})
+
+        # 一次$facet同时得到当前页、总记录数和分面计数，匹配只执行一次
+        branches = {
+            "books": [{"$skip": skip}, {"$limit": limit}, self.projection()],
+            "total": [{"$count": "total"}],
+        }
+        if facets:
+            # grouped时分面统计书目数，价格区间按最低价格划分
+            branches.update(facet.facet_stages(price="$group.min_price" if query.grouped else "$inventory.price"))
+        pipeline.append({"$facet": branches})
+        results, summary = self.aggregate(plan, pipeline, explain)
+        result = results[0]
+
+        total_count = result["total"][0]["total"] if result["total"] else 0
+        total_exact = not query.approx_total or total_count < max(APPROX_TOTAL_CAP, skip + limit)
+        data = self.build_page(query, result["books"], total_count, total_exact, page, limit, summary)
+        if facets:
+            data["facets"] = facet.from_facet_result(result)
+            data["facets_exact"] = total_exact and total_count <= facet.FACET_CAP
+        return data
+
+    def execute_after(
+        self, query: SearchQuery, plan: planner.Plan, last: list, extra: dict, limit: int = 10,
+        explain: bool = False
+    ) -> dict:
+        # 续页：只取排序键在游标之后的记录，不再$skip前面的页，也不重复统计总数
+        pipeline = self.rows_pipeline(query, plan, last, limit) + [{"$limit": limit}, self.projection()]
+        rows, summary = self.aggregate(plan, pipeline, explain)
+
+        # 总数沿用第一页统计的结果，随游标传递
+        return self.build_page(
+            query, rows, extra.get("total", 0), extra.get("total_exact", True), extra.get("page", 1) + 1, limit,
+            summary
+        )
+
+    def execute_ngram(
+        self, query: SearchQuery, page: int = 1, limit: int = 10, last: list = None, extra: dict = None,
+        explain: bool = False, facets: bool = False
+    ) -> dict:
+        # n-gram索引给出按分数排序的书目，再按分数顺序分批查出上架记录，按与$text相同的排序键分页
+        ranked = ngram.get_index().search(query.keyword, query.fields)
+        catalog_filters = planner.catalog_match(query.filters)
+        if catalog_filters and ranked:
+            # 书目上的筛选条件按_id在catalog上过滤
+            catalog_filters["_id"] = {"$in": [book_id for book_id, _ in ranked]}
+            allowed = {book["_id"] for book in self.conn.catalog.find(catalog_filters, {"_id": 1})}
+            ranked = [item for item in ranked if item[0] in allowed]
+        skip = (page - 1) * limit
+        # 匹配的书目最多保留APPROX_TOTAL_CAP本（不少于当前页所需），超过时总数为“至少N条”
+        truncated = len(ranked) > max(APPROX_TOTAL_CAP, skip + limit)
+        if truncated:
+            ranked = ranked[:max(APPROX_TOTAL_CAP, skip + limit)]
+        score_of = dict(ranked)
+        condition = planner.inventory_match(query.store_id, query.filters)
+
+        if last is not None:
+            # 续页从游标所在的书目开始取；不分组时该书目可能还有未返回的商店，取等号保留
+            position = [(-score, book_id) for book_id, score in ranked]
+            after = (-last[0],) + tuple(last[1:])
+            if query.grouped:
+                begin = bisect.bisect_right(position, after)
+            else:
+                begin = bisect.bisect_left(position, after[:2])
+            listings, _, probe = self.ranked_listings(query, ranked, condition, begin, limit, after)
+            total_count = extra.get("total", 0)
+            total_exact = extra.get("total_exact", True)
+            page = extra.get("page", 1) + 1
+            facet_counts = None
+        else:
+            # 第一页只取到当前页（和分面统计）所需的记录为止
+            needed = skip + limit
+            if facets:
+                needed = max(needed, facet.FACET_CAP)
+            listings, complete, probe = self.ranked_listings(query, ranked, condition, 0, needed)
+            if complete:
+                total_count = len(listings)
+            else:
+                # 没有取完时在服务端统计总数，不把所有上架记录传回进程
+                condition["book_id"] = {"$in": list(score_of)}
+                if query.grouped:
+                    total_count = len(self.conn.inventory.distinct("book_id", condition))
+                else:
+                    total_count = self.conn.inventory.count_documents(condition)
+            total_exact = not truncated
+            facet_counts = None
+            if facets:
+                facet_counts = self.count_facets(query, listings[:facet.FACET_CAP])
+            listings = listings[skip:]
+        listings = listings[:limit]
+        summary = None
+        if explain:
+            # 没有匹配的书目时没有查询inventory，执行计划为空
+            summary = explain_summary(self.conn.inventory.find(probe).explain()) if probe else explain_summary({})
+
+        # 只为当前页的书目读取书目信息
+        books = {
+            book["_id"]: book
+            for book in self.conn.catalog.find(
+                {"_id": {"$in": [item["book_id"] for item in listings]}}, BOOK_PROJECTION
+            )
+        }
+        rows = []
+        for item in listings:
+            row = dict(books.get(item["book_id"], {"_id": item["book_id"]}))
+            row["score"] = score_of[item["book_id"]]
+            if query.grouped:
+                row["group"] = {name: item[name] for name in GROUP_FIELDS}
+            else:
+                row["inventory"] = {"store_id": item["store_id"], "price": item.get("price")}
+            rows.append(row)
+        data = self.build_page(query, rows, total_count, total_exact, page, limit, summary)
+        if facet_counts is not None:
+            data["facets"] = facet_counts
+            data["facets_exact"] = total_exact and total_count <= facet.FACET_CAP
+        return data
+
+    def ranked_listings(
+        self, query: SearchQuery, ranked: list, condition: dict, begin: int, needed: int, after: tuple = None
+    ) -> (list, bool, dict):
+        """从ranked[begin:]起按分数顺序分批查询上架记录（grouped时为合并后的书目），
+        凑满needed条（只计排序键在after之后的记录）即停止；返回记录、是否已取完和第一批的查询条件
+        """
+        projection = {"_id": 0, "book_id": 1, "store_id": 1, "price": 1}
+        if query.grouped:
+            projection["stock_level"] = 1
+        rows, probe = [], None
+        size = LISTING_CHUNK
+        while begin < len(ranked) and len(rows) < needed:
+            # 每批只查一段书目，限定商店时上架记录稀疏，批量逐次加倍以减少往返
+            score_of = dict(ranked[begin:begin + size])
+            chunk = dict(condition, book_id={"$in": list(score_of)})
+            probe = probe or chunk
+            listings = list(self.conn.inventory.find(chunk, projection))
+            listings.sort(key=lambda item: (-score_of[item["book_id"]], item["book_id"], item["store_id"]))
+            if query.grouped:
+                listings = group_listings(listings)
+            if after is not None:
+                listings = [item for item in listings if self.listing_key(query, item, score_of) > after]
+            rows.extend(listings)
+            begin += size
+            size *= 2
+        return rows, begin >= len(ranked), probe
+
+    def listing_key(self, query: SearchQuery, item: dict, score_of: dict) -> tuple:
+        key = (-score_of[item["book_id"]], item["book_id"])
+        return key if query.grouped else key + (item["store_id"],)
+
+    def count_facets(self, query: SearchQuery, counted: list) -> dict:
+        # 分面在进程内统计匹配集合中的前FACET_CAP条记录
+        books = {
+            book["_id"]: book
+            for book in self.conn.catalog.find(
+                {"_id": {"$in": list({item["book_id"] for item in counted})}}, facet.BOOK_FIELDS
+            )
+        }
+        price = "min_price" if query.grouped else "price"
+        return facet.count_rows([(books.get(item["book_id"], {}), item.get(price)) for item in counted])
+
+    def compact(self, query: SearchQuery, data: dict):
+        # 在服务端把简介截成关键词附近的摘要，去掉较长的字段，减小响应体
+        pattern = snippet.terms_pattern(query.keyword)
+        for book in data["books"]:
+            book["snippet"] = snippet.make(book.get("book_intro"), pattern)
+            for name in COMPACT_DROPPED:
+                book.pop(name, None)
+
+    def projection(self) -> dict:
+        return {"$project": dict(BOOK_PROJECTION, score=1, inventory=1, group=1)}
+
+    def build_page(
+        self, query: SearchQuery, rows: list, total_count: int, total_exact: bool, page: int, limit: int,
+        explain: dict = None
+    ) -> dict:
+        books = []
+        for book in rows:
+            item = {
+                "id": book["_id"],
+                "title": book.get("title"),
+                "author": book.get("author"),
+            }
+            if query.grouped:
+                group = book["group"]
+                item.update({
+                    "min_price": group.get("min_price"),
+                    "total_stock": group.get("total_stock"),
+                    "store_ids": group.get("store_ids"),
+                    "store_count": group.get("store_count"),
+                })
+            else:
+                item["price"] = book["inventory"].get("price")
+            item.update({
+                "publisher": book.get("publisher"),
+                "tags": book.get("tags"),
+                "book_intro": book.get("book_intro"),
+            })
+            if not query.grouped:
+                item["belong_store_id"] = book["inventory"].get("store_id")
+            books.append(item)
+
+        # 本页已满时返回续页游标，编码最后一条记录的排序键
+        next_cursor = None
+        if rows and len(rows) == limit:
+            last = rows[-1]
+            key = [last["score"], last["_id"]]
+            if not query.grouped:
+                key.append(last["inventory"].get("store_id"))
+            next_cursor = cursor_token.encode(
+                query.fingerprint(), key, {"total": total_count, "total_exact": total_exact, "page": page}
+            )
+
+        # 构造返回数据，与接口文档保持一致；total_exact为False时total表示“至少total条”
+        data = {
+            "books": books,
+            "total": total_count,
+            "total_exact": total_exact,
+            "page": page,
+            "limit": limit,
+            "next_cursor": next_cursor,
+        }
+        if explain is not None:
+            data["explain"] = explain
+        return data
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from pymongo import UpdateOne
+from be.model import metrics
+from be.model import store
+
+# 缓存的搜索结果页数上限和有效期（秒）
+CAPACITY = int(os.environ.get("BOOKSTORE_SEARCH_CACHE_SIZE", "1024"))
+TTL = float(os.environ.get("BOOKSTORE_SEARCH_CACHE_TTL", "30"))
+
+# 失效代号的范围：各商店一个；上架新书（匹配集合变化）时递增MEMBERSHIP，任一商店变化时递增ANY_STORE
+MEMBERSHIP = "*"
+ANY_STORE = "#"
+
+
+def normalize_keyword(keyword: str) -> str:
+    # 忽略大小写和多余空白，"Python  入门" 与 "python 入门" 命中同一缓存
+    return " ".join(keyword.lower().split())
+
+
+def make_key(store_id: str, keyword: str, page: int, limit: int, **options) -> tuple:
+    # store_id为None表示全站搜索；options为其他影响结果的参数
+    return (store_id, normalize_keyword(keyword), page, limit, tuple(sorted(options.items())))
+
+
+def store_scope(store_id: str) -> str:
+    return "store:" + store_id
+
+
+def changed_scopes(store_id: str, membership_changed: bool) -> list:
+    scopes = [store_scope(store_id), ANY_STORE]
+    if membership_changed:
+        scopes.append(MEMBERSHIP)
+    return scopes
+
+
+class LocalGenerations:
+    """进程内的失效代号，单进程部署时使用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def read(self, scopes) -> tuple:
+        with self.lock:
+            return tuple(self.values.get(scope, 0) for scope in scopes)
+
+    async def read_async(self, conn, scopes) -> tuple:
+        return self.read(scopes)
+
+    def bump(self, scopes):
+        with self.lock:
+            for scope in scopes:
+                self.values[scope] = self.values.get(scope, 0) + 1
+
+    async def bump_async(self, conn, scopes):
+        self.bump(scopes)
+
+
+class SharedGenerations:
+    """保存在cache_generation集合中、各进程共享的失效代号，每个范围一个文档{_id, n}
+
+    其他进程的写操作递增代号后，本进程下一次读取缓存条目时即发现失效；每次命中多一次按_id的读取，
+    仍远小于重新执行搜索聚合的代价。
+    """
+
+    def read(self, scopes) -> tuple:
+        found = store.get_db().cache_generation.find({"_id": {"$in": list(scopes)}})
+        values = {doc["_id"]: doc["n"] for doc in found}
+        return tuple(values.get(scope, 0) for scope in scopes)
+
+    async def read_async(self, conn, scopes) -> tuple:
+        found = conn.cache_generation.find({"_id": {"$in": list(scopes)}})
+        values = {doc["_id"]: doc["n"] async for doc in found}
+        return tuple(values.get(scope, 0) for scope in scopes)
+
+    def requests(self, scopes) -> list:
+        return [UpdateOne({"_id": scope}, {"$inc": {"n": 1}}, upsert=True) for scope in scopes]
+
+    def bump(self, scopes):
+        store.get_db().cache_generation.bulk_write(self.requests(scopes), ordered=False)
+
+    async def bump_async(self, conn, scopes):
+        await conn.cache_generation.bulk_write(self.requests(scopes), ordered=False)
+
+
+class SearchCache:
+    """有界的LRU+TTL搜索结果缓存，按商店失效
+
+    写操作不直接删除缓存条目，而是递增代号（见changed_scopes）。
+    条目保存写入时所依赖范围的代号，读取时代号已变化即视为失效：
+      - 店铺内搜索条目依赖该商店的代号；
+      - 全站搜索条目依赖MEMBERSHIP，以及结果页中出现的各商店的代号。
+    上架新书改变匹配集合和总数，同时递增该商店代号和MEMBERSHIP；
+    价格、库存变化只递增该商店代号，只影响包含该商店的结果页。
+    代号默认保存在进程内；多进程部署时换成SharedGenerations，一个进程的写操作使所有进程的条目失效。
+    """
+
+    def __init__(self, capacity: int = CAPACITY, ttl: float = TTL, generations=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generations = generations or LocalGenerations()
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counts["misses"] = self.counts["misses"] + 1
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                self.counts["expired"] = self.counts["expired"] + 1
+                self.counts["misses"] = self.counts["misses"] + 1
+                return None
+        # 共享代号需要读取数据库，不在持有锁时进行
+        _, scopes, values, data = entry
+        valid = self.generations.read(scopes) == values
+        with self.lock:
+            if not valid:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+                self.counts["invalidated"] = self.counts["invalidated"] + 1
+                self.counts["misses"] = self.counts["misses"] + 1
+                return None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.counts["hits"] = self.counts["hits"] + 1
+            return data
+
+    def put(self, key: tuple, data: dict, store_ids, generation: tuple):
+        """generation 为查询开始前调用 snapshot_generation 得到的代号
+
+        查询执行期间发生的写操作会使代号变化，这样的结果不写入缓存。
+        """
+        store_id = key[0]
+        watched = self.watched_scopes(store_id)
+        if store_id is None:
+            scopes = (MEMBERSHIP,) + tuple(store_scope(item) for item in sorted(set(store_ids)))
+        else:
+            scopes = watched
+        # 一次读出查询前观察的代号和条目依赖的代号
+        values = self.generations.read(watched + scopes)
+        if values[:len(watched)] != generation:
+            return
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, scopes, values[len(watched):], data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.counts["evictions"] = self.counts["evictions"] + 1
+
+    def watched_scopes(self, store_id: str) -> tuple:
+        # 全站搜索期间任一商店变化都不写入缓存
+        if store_id is None:
+            return (MEMBERSHIP, ANY_STORE)
+        return (store_scope(store_id),)
+
+    def snapshot_generation(self, store_id: str) -> tuple:
+        return self.generations.read(self.watched_scopes(store_id))
+
+    def invalidate_store(self, store_id: str, membership_changed: bool = False):
+        self.generations.bump(changed_scopes(store_id, membership_changed))
+
+    async def invalidate_store_async(self, conn, store_id: str, membership_changed: bool = False):
+        await self.generations.bump_async(conn, changed_scopes(store_id, membership_changed))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            data = dict(self.counts)
+            data["size"] = len(self.entries)
+        data["shared"] = isinstance(self.generations, SharedGenerations)
+        return data
+
+
+cache = SearchCache()
+metrics.register("search_cache", cache.snapshot)
+
+
+def share_generations():
+    # 多进程部署时在工作进程中调用，此后的失效对所有进程可见
+    cache.generations = SharedGenerations()
+
+
+def invalidate_store(store_id: str, membership_changed: bool = False):
+    cache.invalidate_store(store_id, membership_changed)
+
+
+async def invalidate_store_async(conn, store_id: str, membership_changed: bool = False):
+    await cache.invalidate_store_async(conn, store_id, membership_changed)
@@ -1,5 +1,13 @@
+from pymongo.errors import DuplicateKeyError
 from be.model import error
 from be.model import db_conn
+from be.model import picture
+from be.model import catalog
+from be.model import search_cache
+from be.model import ngram
+from be.model import facet
+from be.model import suggest
+from be.model import similar
 
 
 class Seller(db_conn.DBConn):
@@ -21,41 +29,34 @@ class Seller(db_conn.DBConn):
                 return error.error_non_exist_store_id(store_id)
             
             # 检查该商店中是否已存在该书籍ID（使用复合唯一索引保证）
-            existing_book = self.conn.book.find_one({"book_id": book_id, "belong_store_id": store_id})
-            if existing_book is not None:
-                # 如果该商店中已存在该书籍ID，返回错误
+            if self.book_id_exist(store_id, book_id):
                 return error.error_exist_book_id(book_id)
             
             # 解析书籍信息
             import json
             book_info = json.loads(book_json_str)
+
+            # 书目信息全局只保存一份，只有第一次上架这本书时才写入catalog
+            book = self.conn.catalog.find_one({"_id": book_id}, dict(facet.BOOK_FIELDS, title=1, author=1))
+            if book is None:
+                # 图片存入按内容寻址的picture存储，书目只保存图片的sha256
+                picture_ids = picture.put_pictures(self.conn, book_info.get("pictures", []))
+                book = catalog.catalog_document(book_id, book_info, picture_ids)
+                result = self.conn.catalog.update_one({"_id": book_id}, {"$setOnInsert": book}, upsert=True)
+                if result.upserted_id is not None:
+                    ngram.index_book(book)
+                    similar.index_book(book)
+
+            # 为当前商店插入库存记录，只包含价格和库存
+            price = book_info.get("price", 0)
+            self.conn.inventory.insert_one(catalog.inventory_document(store_id, book_id, price, stock_level))
+            # 新的上架记录计入全站和该商店的分面计数
+            facet.record_listing(self.conn, store_id, book, price)
+            suggest.record_listing(book)
+            search_cache.invalidate_store(store_id, membership_changed=True)
             
-            # 为当前商店插入新的书籍记录
-            # 使用 book_id + store_id 作为 _id 确保唯一性
-            book_detail_doc = {
-                "_id": "{}_{}".format(book_id, store_id),
-                "author": book_info.get("author", ""),
-                "author_intro": book_info.get("author_intro", ""),
-                "binding": book_info.get("binding", ""),
-                "book_id": book_id,
-                "belong_store_id": store_id,
-                "stock_level": stock_level,
-                "book_intro": book_info.get("book_intro", ""),
-                "content": book_info.get("content", ""),
-                "currency_unit": book_info.get("currency_unit", ""),
-                "isbn": book_info.get("isbn", ""),
-                "original_title": book_info.get("original_title", ""),
-                "pages": book_info.get("pages", 0),
-                "picture": book_info.get("pictures", []),
-                "price": book_info.get("price", 0),
-                "pub_year": book_info.get("pub_year", ""),
-                "publisher": book_info.get("publisher", ""),
-                "tags": book_info.get("tags", []),
-                "title": book_info.get("title", ""),
-                "translator": book_info.get("translator", "")
-            }
-            self.conn.book.insert_one(book_detail_doc)
-            
+        except DuplicateKeyError:
+            return error.error_exist_book_id(book_id)
         except Exception as e:
             return 528, "{}".format(str(e))
         return 200, "ok"
@@ -70,10 +71,10 @@ class Seller(db_conn.DBConn):
                 return error.error_non_exist_store_id(store_id)
             
             # 查找书籍并更新库存
-            result = self.conn.book.update_one(
+            result = self.conn.inventory.update_one(
                 {
-                    "book_id": book_id,
-                    "belong_store_id": store_id
+                    "store_id": store_id,
+                    "book_id": book_id
                 },
                 {
                     "$inc": {
@@ -85,6 +86,7 @@ class Seller(db_conn.DBConn):
             # 检查是否找到了匹配的文档
             if result.matched_count == 0:
                 return error.error_non_exist_book_id(book_id)
+            search_cache.invalidate_store(store_id)
                 
         except Exception as e:
             return 528, "{}".format(str(e))
@@ -115,12 +117,14 @@ class Seller(db_conn.DBConn):
                 return error.error_non_exist_user_id(user_id)
             
             # 查询订单信息
-            orders = list(self.conn.order.find({"order_id": order_id}))
-            if not orders:
+            order = self.conn.order.find_one(
+                {"order_id": order_id}, {"_id": 0, "store_id": 1}
+            )
+            if order is None:
                 return error.error_invalid_order_id(order_id)
             
             # 获取订单对应的商店ID
-            store_id = orders[0]["store_id"]
+            store_id = order["store_id"]
             
             # 查询商店信息，确认该用户是商店的所有者
             store_info = self.conn.store.find_one({"store_id": store_id})
@@ -131,15 +135,13 @@ class Seller(db_conn.DBConn):
             if seller_id != user_id:
                 return error.error_authorization_fail()
             
-            # 检查订单状态是否为已支付
-            if orders[0].get("status") != "paid":
-                return error.error_invalid_order_id(order_id)
-            
-            # 更新订单状态为已发货
-            self.conn.order.update_many(
-                {"order_id": order_id},
+            # 单文档原子更新：只有已支付的订单可以改为已发货
+            result = self.conn.order.update_one(
+                {"order_id": order_id, "status": "paid"},
                 {"$set": {"status": "sent"}}
             )
+            if result.matched_count == 0:
+                return error.error_invalid_order_id(order_id)
             
         except Exception as e:
             return 528, "{}".format(str(e))
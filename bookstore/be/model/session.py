@@ -0,0 +1,40 @@
+import time
+import logging
+from datetime import datetime, timezone
+import jwt
+
+# 登录会话：session集合中每个(user_id, terminal)一条 {user_id, terminal, token, expires_at}，
+# 同一用户可以同时在多个终端登录；登录、登出只写session，不再改写user文档
+
+# 令牌有效期（秒）
+TOKEN_LIFETIME = 3600
+
+
+def expires_at(issued_at: float) -> datetime:
+    # TTL索引按UTC时间比较，使用带时区的UTC时间
+    return datetime.fromtimestamp(issued_at + TOKEN_LIFETIME, timezone.utc)
+
+
+def move_user_tokens(db) -> int:
+    """迁移：把user文档中的token、terminal移到session集合，可以重复执行
+
+    仍在有效期内的令牌写入对应终端的会话，过期的直接丢弃；之后从user文档中删除这两个字段。
+    返回处理的用户数。
+    """
+    n = 0
+    for user in db.user.find({"token": {"$exists": True}}, {"user_id": 1, "token": 1, "terminal": 1}):
+        try:
+            issued_at = jwt.decode(user["token"], key=user["user_id"], algorithms="HS256")["timestamp"]
+        except Exception:
+            issued_at = None
+        if issued_at is not None and issued_at + TOKEN_LIFETIME > time.time():
+            db.session.update_one(
+                {"user_id": user["user_id"], "terminal": user.get("terminal", "")},
+                {"$set": {"token": user["token"], "expires_at": expires_at(issued_at)}},
+                upsert=True,
+            )
+        db.user.update_one({"_id": user["_id"]}, {"$unset": {"token": "", "terminal": ""}})
+        n = n + 1
+    if n:
+        logging.info("moved tokens of {} users into sessions".format(n))
+    return n
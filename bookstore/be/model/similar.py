@@ -0,0 +1,398 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+import numpy as np
+from be.model import db_conn
+from be.model import metrics
+from be.model import ngram
+
+# 相似图书：在title、tags、book_intro上构建TF-IDF向量，按余弦相似度取最近邻。
+# 向量矩阵按版本保存为.npy文件，各进程以只读方式内存映射同一份文件。
+
+SIMILAR_DIR = os.environ.get("BOOKSTORE_SIMILAR_DIR", os.path.join(tempfile.gettempdir(), "bookstore_similar"))
+FIELDS = ("title", "tags", "book_intro")
+# 词项按哈希分桶，新书的向量不依赖共享的词表
+DIMENSION = 1 << 18
+# 每本书只保留权重最高的若干个词项，控制矩阵大小和查询时扫描的倒排长度
+TERMS_PER_BOOK = 64
+# 增量加入的新书超过基础矩阵的该比例（且不少于MIN_REBUILD本）时在后台重建矩阵
+REBUILD_FRACTION = 0.1
+MIN_REBUILD = 1000
+
+ARRAYS = ("csr_indptr", "csr_indices", "csr_data", "csc_indptr", "csc_indices", "csc_data", "idf")
+
+
+def term_counts(book: dict, weights: dict) -> dict:
+    # 按字段权重累计每个哈希桶的词频；中文取两字gram，英文取整词
+    counts = {}
+    for field in FIELDS:
+        weight = weights.get(field, 1)
+        for word in ngram.tokenize(ngram.field_text(book.get(field)), for_query=True):
+            for gram in word:
+                col = zlib.crc32(gram.encode("utf-8")) % DIMENSION
+                counts[col] = counts.get(col, 0.0) + weight
+    return counts
+
+
+def vectorize(counts: dict, idf) -> (np.ndarray, np.ndarray):
+    """返回按列号升序的(列号, 权重)，权重为(1+log tf)*idf，只保留前TERMS_PER_BOOK个并归一化"""
+    if not counts:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    cols = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+    tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    vals = (1 + np.log(tf)) * idf[cols]
+    if len(cols) > TERMS_PER_BOOK:
+        keep = np.argpartition(-vals, TERMS_PER_BOOK)[:TERMS_PER_BOOK]
+        cols, vals = cols[keep], vals[keep]
+    norm = float(np.linalg.norm(vals))
+    if norm > 0:
+        vals = vals / norm
+    order = np.argsort(cols)
+    return cols[order], vals[order].astype(np.float32)
+
+
+class SimilarIndex(db_conn.DBConn):
+    """TF-IDF最近邻索引
+
+    基础矩阵以CSR（按书查向量）和CSC（按词项查书）两种形式保存在版本目录中，
+    SIMILAR_DIR/CURRENT记录当前版本；其后上架的新书按当时的idf计算向量，
+    保存在进程内的增量表中，超过一定数量后由一个进程重建矩阵，其他进程发现版本变化后重新映射。
+
+    构建、映射和拉取新书只持有refresh_lock，self.lock只在读写内存状态时短暂持有，
+    构建期间上架（add）和已映射后的查询不会被阻塞；映射完成前上架的书先缓存在pending中。
+    """
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+        self.weights = ngram.field_weights()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.version = None
+        self.arrays = None
+        self.book_ids = []
+        self.row_of = {}
+        self.delta = {}
+        # 增量表按行堆叠成的稀疏矩阵，增量表变化后在下一次查询时重新生成
+        self.delta_matrix = None
+        self.pending = {}
+        self.watermark = None
+        self.last_refresh = 0.0
+        self.rebuilding = False
+        self.stats = {"queries": 0, "builds": 0}
+        metrics.register("similar", self.snapshot)
+
+    def current_version(self) -> str:
+        try:
+            with open(os.path.join(SIMILAR_DIR, "CURRENT")) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def open_version(self) -> bool:
+        # 映射CURRENT指向的版本；版本未变化时不做任何事，返回是否有可用的版本
+        # 文件在锁外读取和映射，最后在锁内一次切换
+        version = self.current_version()
+        with self.lock:
+            current = self.version
+        if version is None:
+            return current is not None
+        if version == current:
+            return True
+        path = os.path.join(SIMILAR_DIR, version)
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ARRAYS}
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        book_ids = meta["book_ids"]
+        row_of = {book_id: i for i, book_id in enumerate(book_ids)}
+        watermark = datetime.fromisoformat(meta["watermark"]) if meta.get("watermark") else None
+        with self.lock:
+            self.arrays = arrays
+            self.book_ids = book_ids
+            self.row_of = row_of
+            self.version = version
+            if self.watermark is None or (watermark is not None and watermark > self.watermark):
+                self.watermark = watermark
+            # 已经进入基础矩阵的书不再保留在增量表中
+            for book_id in list(self.delta):
+                if book_id in row_of:
+                    del self.delta[book_id]
+            self.delta_matrix = None
+        return True
+
+    def build(self):
+        """从catalog全量构建一个新版本并切换CURRENT"""
+        books = []
+        watermark = None
+        projection = {field: 1 for field in FIELDS}
+        projection["created_at"] = 1
+        for book in self.conn.catalog.find({}, projection).sort("_id", 1):
+            books.append((book["_id"], term_counts(book, self.weights)))
+            created_at = book.get("created_at")
+            if created_at is not None and (watermark is None or created_at > watermark):
+                watermark = created_at
+
+        df = np.zeros(DIMENSION, dtype=np.float32)
+        for _, counts in books:
+            if counts:
+                df[np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))] += 1
+        idf = (np.log((1 + len(books)) / (1 + df)) + 1).astype(np.float32)
+
+        indptr = np.zeros(len(books) + 1, dtype=np.int64)
+        indices = []
+        data = []
+        for i, (_, counts) in enumerate(books):
+            cols, vals = vectorize(counts, idf)
+            indices.append(cols)
+            data.append(vals)
+            indptr[i + 1] = indptr[i] + len(cols)
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(data) if data else np.zeros(0, dtype=np.float32)
+
+        # 转为CSC：按列号稳定排序，行号由CSR的行指针展开得到
+        rows = np.repeat(np.arange(len(books), dtype=np.int32), np.diff(indptr))
+        order = np.argsort(indices, kind="stable")
+        csc_indptr = np.zeros(DIMENSION + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=DIMENSION), out=csc_indptr[1:])
+
+        version = "v{}-{}".format(int(time.time() * 1000), os.getpid())
+        path = os.path.join(SIMILAR_DIR, version)
+        os.makedirs(path)
+        arrays = {
+            "csr_indptr": indptr,
+            "csr_indices": indices,
+            "csr_data": data,
+            "csc_indptr": csc_indptr,
+            "csc_indices": rows[order],
+            "csc_data": data[order],
+            "idf": idf,
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({
+                "book_ids": [book_id for book_id, _ in books],
+                "watermark": watermark.isoformat() if watermark else None,
+            }, f)
+
+        # 原子地切换当前版本，删除更早的版本（已映射的进程在Linux上仍可继续读取）
+        tmp = os.path.join(SIMILAR_DIR, "CURRENT.{}".format(os.getpid()))
+        with open(tmp, "w") as f:
+            f.write(version)
+        os.replace(tmp, os.path.join(SIMILAR_DIR, "CURRENT"))
+        for name in os.listdir(SIMILAR_DIR):
+            if name.startswith("v") and name not in (version, self.version):
+                shutil.rmtree(os.path.join(SIMILAR_DIR, name), ignore_errors=True)
+        with self.lock:
+            self.stats["builds"] = self.stats["builds"] + 1
+        logging.info("similar index built: %d books, %d terms", len(books), len(indices))
+
+    def build_exclusive(self, wait: bool) -> bool:
+        # 同一台机器上只允许一个进程构建；wait为True时等待其他进程构建完成
+        os.makedirs(SIMILAR_DIR, exist_ok=True)
+        lock_path = os.path.join(SIMILAR_DIR, "BUILDING")
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # 构建进程崩溃后遗留的锁文件在10分钟后失效
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > 600:
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if not wait:
+                    return False
+                time.sleep(0.5)
+                if self.current_version() is not None:
+                    return True
+                continue
+            try:
+                os.write(fd, str(os.getpid()).encode())
+                self.build()
+            finally:
+                os.close(fd)
+                os.remove(lock_path)
+            return True
+
+    def rebuild_in_background(self):
+        def run():
+            try:
+                self.build_exclusive(wait=False)
+            except Exception as e:
+                logging.error("similar index rebuild failed: {}".format(str(e)))
+            finally:
+                self.rebuilding = False
+
+        self.rebuilding = True
+        threading.Thread(target=run, name="similar-build", daemon=True).start()
+
+    def add(self, book: dict):
+        # 新书按当前版本的idf计算向量（在锁外计算），加入增量表；矩阵尚未映射时先缓存
+        with self.lock:
+            if self.arrays is None:
+                self.pending[book["_id"]] = book
+                return
+            if book["_id"] in self.row_of or book["_id"] in self.delta:
+                return
+            idf = self.arrays["idf"]
+        vector = vectorize(term_counts(book, self.weights), idf)
+        with self.lock:
+            if book["_id"] in self.row_of or book["_id"] in self.delta:
+                return
+            self.delta[book["_id"]] = vector
+            self.delta_matrix = None
+            created_at = book.get("created_at")
+            if created_at is not None and (self.watermark is None or created_at > self.watermark):
+                self.watermark = created_at
+
+    def ensure_fresh(self, force: bool = False):
+        # 第一次使用时映射当前版本（没有时构建），之后定期检查新版本并拉取其后上架的新书
+        now = time.time()
+        with self.lock:
+            loaded = self.arrays is not None
+            if loaded and not force and now - self.last_refresh < ngram.REFRESH_INTERVAL:
+                return
+        # 已映射时不等待其他线程正在进行的刷新
+        if not self.refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            if not loaded:
+                if not self.open_version():
+                    self.build_exclusive(wait=True)
+                    self.open_version()
+            else:
+                self.open_version()
+            with self.lock:
+                self.last_refresh = now
+                pending = list(self.pending.values())
+                self.pending = {}
+                watermark = self.watermark
+            for book in pending:
+                self.add(book)
+            query = {}
+            if watermark is not None:
+                query = {"created_at": {"$gte": watermark - timedelta(seconds=ngram.REFRESH_OVERLAP)}}
+            projection = {field: 1 for field in FIELDS}
+            projection["created_at"] = 1
+            for book in self.conn.catalog.find(query, projection):
+                self.add(book)
+            with self.lock:
+                rebuild = not self.rebuilding and \
+                    len(self.delta) >= max(MIN_REBUILD, REBUILD_FRACTION * len(self.book_ids))
+            if rebuild:
+                self.rebuild_in_background()
+        finally:
+            self.refresh_lock.release()
+
+    def stacked_delta(self) -> ([str], np.ndarray, np.ndarray, np.ndarray):
+        # 调用者持有锁：增量表按行堆叠为(书号, 行号, 列号, 权重)，每个非零元一项
+        if self.delta_matrix is None:
+            ids = list(self.delta)
+            vectors = [self.delta[book_id] for book_id in ids]
+            lengths = np.fromiter((len(cols) for cols, _ in vectors), dtype=np.int64, count=len(vectors))
+            rows = np.repeat(np.arange(len(ids)), lengths)
+            cols = np.concatenate([cols for cols, _ in vectors]) if vectors else np.zeros(0, dtype=np.int32)
+            vals = np.concatenate([vals for _, vals in vectors]) if vectors else np.zeros(0, dtype=np.float32)
+            self.delta_matrix = (ids, rows, cols, vals)
+        return self.delta_matrix
+
+    def vector_of(self, book_id: str):
+        # 调用者持有锁
+        row = self.row_of.get(book_id)
+        if row is not None:
+            start, end = self.arrays["csr_indptr"][row], self.arrays["csr_indptr"][row + 1]
+            return np.asarray(self.arrays["csr_indices"][start:end]), np.asarray(self.arrays["csr_data"][start:end])
+        return self.delta.get(book_id)
+
+    def nearest(self, book_id: str, k: int = 10) -> [(str, float)]:
+        """返回与book_id最相似的k本书[(book_id, 余弦相似度)]；该书不在索引中时返回None"""
+        self.ensure_fresh()
+        with self.lock:
+            vector = self.vector_of(book_id)
+        if vector is None:
+            # 可能是其他进程刚上架的书
+            self.ensure_fresh(force=True)
+            with self.lock:
+                vector = self.vector_of(book_id)
+        if vector is None:
+            return None
+        # 在锁内取得当前版本和增量矩阵的引用，计算在锁外进行（映射的数组和堆叠后的增量矩阵不会被修改）
+        with self.lock:
+            arrays, book_ids, row_of = self.arrays, self.book_ids, self.row_of
+            delta_ids, delta_rows, delta_cols, delta_vals = self.stacked_delta()
+            self.stats["queries"] = self.stats["queries"] + 1
+        cols, vals = vector
+        indptr = arrays["csc_indptr"]
+        n = len(book_ids)
+
+        # 基础矩阵：取查询向量各词项的倒排，按行号累加 权重×权重
+        starts, ends = indptr[cols], indptr[cols + 1]
+        lengths = ends - starts
+        if lengths.sum():
+            positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            rows = arrays["csc_indices"][positions]
+            weights = arrays["csc_data"][positions] * np.repeat(vals, lengths)
+            scores = np.bincount(rows, weights=weights, minlength=n)
+        else:
+            scores = np.zeros(n)
+
+        candidates = []
+        if n:
+            self_row = row_of.get(book_id)
+            if self_row is not None:
+                scores[self_row] = -1
+            top = min(k, n)
+            best = np.argpartition(-scores, top - 1)[:top]
+            candidates = [(book_ids[i], float(scores[i])) for i in best if scores[i] > 0]
+
+        # 增量表：一次稀疏矩阵×向量，查询向量的列号有序，用二分查找对齐每个非零元
+        if len(delta_ids) and len(cols):
+            positions = np.minimum(np.searchsorted(cols, delta_cols), len(cols) - 1)
+            weights = np.where(cols[positions] == delta_cols, vals[positions] * delta_vals, 0.0)
+            delta_scores = np.bincount(delta_rows, weights=weights, minlength=len(delta_ids))
+            top = min(k + 1, len(delta_ids))
+            for i in np.argpartition(-delta_scores, top - 1)[:top]:
+                if delta_scores[i] > 0 and delta_ids[i] != book_id:
+                    candidates.append((delta_ids[i], float(delta_scores[i])))
+
+        candidates.sort(key=lambda item: (-item[1], item[0]))
+        return candidates[:k]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            data = dict(self.stats)
+            data["books"] = len(self.book_ids)
+            data["delta_books"] = len(self.delta)
+            data["pending_books"] = len(self.pending)
+            data["version"] = self.version
+        return data
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> SimilarIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SimilarIndex()
+        return _index
+
+
+def warm_up():
+    # 启动时在后台线程中映射（必要时构建）矩阵
+    threading.Thread(target=get_index().ensure_fresh, name="similar-build", daemon=True).start()
+
+
+def index_book(book: dict):
+    # 上架新书目时加入本进程的增量表；索引尚未映射时由第一次查询处理
+    if _index is not None:
+        _index.add(book)
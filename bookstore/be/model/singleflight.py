@@ -0,0 +1,59 @@
+import threading
+from be.model import metrics
+
+# 请求合并：同一个键同时只执行一次，执行期间到达的相同请求等待并共享这次的结果
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    """按键合并并发调用
+
+    第一个到达的调用者执行fn，之后到达的调用者等待其完成并得到同一个结果（或同一个异常）。
+    执行结束时先从表中移除该键再唤醒等待者，之后到达的请求会重新执行，不会拿到已完成的旧结果。
+    """
+
+    def __init__(self, name: str):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"executions": 0, "shared": 0}
+        metrics.register(name, self.snapshot)
+
+    def do(self, key, fn):
+        leader = False
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = Call()
+                self.calls[key] = call
+                self.stats["executions"] = self.stats["executions"] + 1
+                leader = True
+            else:
+                self.stats["shared"] = self.stats["shared"] + 1
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            data = dict(self.stats, in_flight=len(self.calls))
+        requests = data["executions"] + data["shared"]
+        # 合并比例：共享结果的请求占全部请求的比例
+        data["coalescing_ratio"] = data["shared"] / requests if requests else 0.0
+        return data
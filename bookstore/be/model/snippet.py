@@ -0,0 +1,46 @@
+import html
+import re
+from be.model import ngram
+
+# 搜索结果摘要：在简介中截取关键词附近的一段文字，命中的词用<em>标出
+
+# 摘要截取的字符数（不含省略号和标记）
+SNIPPET_CHARS = 80
+HIGHLIGHT = ("<em>", "</em>")
+ELLIPSIS = "…"
+
+
+def terms_pattern(keyword: str):
+    """关键词中需要标出的词：每个查询词本身，中文词另加其相邻两字
+
+    n-gram检索只要求两字gram都出现，中文词整体不一定出现在文本中，因此也标出两字片段；
+    较长的词排在前面，优先整体匹配。没有可标出的词时返回None。
+    """
+    terms = set()
+    for cjk, other in ngram.TOKEN_RE.findall((keyword or "").lower()):
+        terms.add(cjk or other)
+        terms.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    if not terms:
+        return None
+    return re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+
+
+def make(text: str, pattern, width: int = SNIPPET_CHARS) -> str:
+    # 以第一个命中位置为准截取width个字符，命中处放在窗口前三分之一；没有命中时取开头
+    text = " ".join(str(text or "").split())
+    match = pattern.search(text) if pattern is not None else None
+    start = 0
+    if match is not None:
+        start = max(0, min(match.start() - width // 3, len(text) - width))
+    end = min(len(text), start + width)
+
+    # 文本做HTML转义，只有高亮标记是标签
+    pieces = []
+    pos = start
+    if pattern is not None:
+        for m in pattern.finditer(text, start, end):
+            pieces.append(html.escape(text[pos:m.start()]))
+            pieces.append(HIGHLIGHT[0] + html.escape(m.group()) + HIGHLIGHT[1])
+            pos = m.end()
+    pieces.append(html.escape(text[pos:end]))
+    return (ELLIPSIS if start > 0 else "") + "".join(pieces) + (ELLIPSIS if end < len(text) else "")
@@ -2,71 +2,57 @@ import logging
 import os
 import threading
 from pymongo import MongoClient
+from be.model import migration
+
+# MongoDB连接串，使用单节点副本集时例如 mongodb://localhost:27017/?replicaSet=rs0
+MONGO_URI = os.environ.get("BOOKSTORE_MONGO_URI", "mongodb://localhost:27017/")
+# 下单等多步写操作的执行方式：
+#   auto        连接到副本集时使用多文档事务，否则使用补偿模式
+#   transaction 强制使用多文档事务
+#   compensate  不使用事务，失败时执行补偿操作
+TXN_MODE = os.environ.get("BOOKSTORE_TXN_MODE", "auto")
+# 启动时是否自动执行迁移，设为0时需通过 python -m be.migrate apply 手动执行
+AUTO_MIGRATE = os.environ.get("BOOKSTORE_AUTO_MIGRATE", "1") == "1"
 
 
 class Store:
-    def __init__(self, db_path):
-        # 连接到本地MongoDB的bookstore数据库
-        self.client = MongoClient('localhost', 27017)
+    def __init__(self, db_path, migrate: bool = AUTO_MIGRATE, background: bool = True):
+        # 连接到本地MongoDB的bookstore数据库；多进程部署时每个工作进程在fork之后各自创建连接
+        self.client = MongoClient(MONGO_URI)
         self.db = self.client['bookstore']
-        self.init_collections()
+        self.use_transaction = self.detect_transaction_support()
+        self.init_collections(migrate, background)
+
+    def detect_transaction_support(self) -> bool:
+        if TXN_MODE == "transaction":
+            return True
+        if TXN_MODE == "compensate":
+            return False
+        # 只有副本集（或分片集群）支持多文档事务
+        try:
+            hello = self.client.admin.command("hello")
+        except Exception as e:
+            logging.error("检测事务支持失败: {}".format(str(e)))
+            return False
+        return "setName" in hello or hello.get("msg") == "isdbgrid"
 
-    def init_collections(self):
+    def init_collections(self, migrate: bool = AUTO_MIGRATE, background: bool = True):
         # 确保必要的集合存在
-        collections = ['user', 'store', 'order', 'book']
+        collections = ['user', 'store', 'order', 'catalog', 'inventory', 'lease', 'facet_count', 'session', 'schema_version',
+                       'cache_generation']
+        existing_collections = self.db.list_collection_names()
         for collection in collections:
-            if collection not in self.db.list_collection_names():
+            if collection not in existing_collections:
                 self.db.create_collection(collection)
-        
-        # 为user集合创建索引
-        self.db.user.create_index("user_id", unique=True)
-
-        # 为store集合创建索引
-        self.db.store.create_index("store_id", unique=True)
-
-        # 为book集合创建索引
-        # book_id不应该全局唯一，应该是book_id和belong_store_id的组合唯一
-        # 这样同一本书可以在不同商店中存在不同的记录
-        # 创建复合唯一索引：book_id和belong_store_id的组合必须唯一
-        self.db.book.create_index([("book_id", 1), ("belong_store_id", 1)], unique=True, name="book_id_store_id_unique")
-        
-        # 创建非唯一索引以优化查询性能
-        self.db.book.create_index("book_id", unique=False)
-        self.db.book.create_index("belong_store_id", unique=False)
-        
-        # 创建文本索引以支持全文搜索功能
-        # 覆盖title、tags、content、book_intro、author、publisher，并设置权重
-        try:
-            self.db.book.drop_index("book_text_index")
-        except Exception:
-            pass
-        self.db.book.create_index(
-            [
-                ("title", "text"),
-                ("tags", "text"),
-                ("content", "text"),
-                ("book_intro", "text"),
-                ("author", "text"),
-                ("publisher", "text"),
-            ],
-            name="book_text_index",
-            default_language="english",
-            weights={
-                "title": 10,
-                "tags": 6,
-                "book_intro": 5,
-                "content": 3,
-                "author": 2,
-                "publisher": 1,
-            },
-        )
-        
-        # 为order集合创建索引    
-        # 创建order_id的非唯一索引以优化查询性能
-        self.db.order.create_index("order_id", unique=False)
-        # 创建复合索引：同一订单中同一本书只能有一条记录
-        self.db.order.create_index([("order_id", 1), ("book_id", 1)], unique=True, name="order_id_book_id_unique")
-        
+
+        # 按 migration.INDEXES 和 migration.MIGRATIONS 只执行有变化的部分，
+        # 索引已是最新时启动只需一次 list_indexes() 对比
+        if migrate:
+            migration.apply(self.db, background=background)
+        else:
+            pending = migration.plan(self.db)
+            if pending:
+                logging.error("存在{}项未执行的迁移，请运行 python -m be.migrate apply".format(len(pending)))
 
     def get_db(self):
         return self.db
@@ -77,11 +63,25 @@ database_instance: Store = None
 init_completed_event = threading.Event()
 
 
-def init_database(db_path):
+def init_database(db_path, migrate: bool = AUTO_MIGRATE):
     global database_instance
-    database_instance = Store(db_path)
+    database_instance = Store(db_path, migrate)
+
+
+def prepare_database(db_path):
+    """多进程部署时由主进程在fork之前调用：创建集合、同步执行迁移，然后关闭连接
+
+    工作进程不再各自迁移，也不会继承主进程的MongoClient。
+    """
+    instance = Store(db_path, AUTO_MIGRATE, background=False)
+    instance.client.close()
 
 
 def get_db():
     global database_instance
     return database_instance.get_db()
+
+
+def use_transaction() -> bool:
+    global database_instance
+    return database_instance.use_transaction
@@ -0,0 +1,240 @@
+import bisect
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from be.model import db_conn
+from be.model import metrics
+from be.model import ngram
+
+# 书名、作者、标签的前缀补全：排序数组上二分查找前缀区间，按热度取前K个
+
+# 每次最多返回的补全个数
+MAX_K = 20
+# 长度不超过该值的前缀命中的区间很大，预先保存其前MAX_K个条目，不在查询时扫描
+HEAD_LEN = 3
+# 统计延迟分位数时保留的最近查询数
+LATENCY_SAMPLES = 1000
+
+
+def normalize(text: str) -> str:
+    return " ".join(str(text).lower().split())
+
+
+class SuggestIndex(db_conn.DBConn):
+    """前缀补全索引
+
+    keys为按规范化文本排序的数组，entries为对应的[显示文本, 类型, 热度, 规范化文本]，两者下标一致；
+    同一类型的同一文本只有一个条目。热度为该书（或该作者、标签的所有书）的上架记录数，
+    只增不减，因此短前缀的前K个条目可以在热度增加时就地维护。
+    """
+
+    def __init__(self):
+        db_conn.DBConn.__init__(self)
+        self.lock = threading.Lock()
+        # 全量构建和增量拉取只持有refresh_lock，Mongo查询和构建期间补全、上架不被阻塞
+        self.refresh_lock = threading.Lock()
+        self.keys = []
+        self.entries = []
+        self.position = {}
+        self.heads = {}
+        self.books = set()
+        self.loaded = False
+        self.watermark = None
+        self.last_refresh = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.queries = 0
+        metrics.register("suggest", self.snapshot)
+
+    @staticmethod
+    def book_terms(book: dict) -> [(str, str)]:
+        terms = [(book.get("title") or "", "title"), (book.get("author") or "", "author")]
+        terms.extend((tag, "tag") for tag in set(book.get("tags") or []))
+        return terms
+
+    def add_term(self, text: str, kind: str, weight: int, new: list):
+        # 调用者持有锁；新条目追加到new中，由insert_entries一次放入有序数组
+        key = normalize(text)
+        if not key:
+            return
+        entry = self.position.get((key, kind))
+        if entry is None:
+            entry = [text, kind, 0, key]
+            self.position[(key, kind)] = entry
+            new.append(entry)
+        entry[2] = entry[2] + weight
+        for n in range(1, min(HEAD_LEN, len(key)) + 1):
+            head = self.heads.setdefault(key[:n], [])
+            if entry not in head:
+                if len(head) >= MAX_K and head[-1][2] >= entry[2]:
+                    continue
+                head.append(entry)
+            head.sort(key=lambda e: (-e[2], e[3]))
+            del head[MAX_K:]
+
+    def insert_entries(self, new: [list]):
+        # 调用者持有锁：少量新条目二分插入，较多时追加后整体排序（已有部分有序，接近线性）
+        if len(new) <= 32:
+            for entry in new:
+                i = bisect.bisect_left(self.keys, entry[3])
+                self.keys.insert(i, entry[3])
+                self.entries.insert(i, entry)
+        else:
+            self.entries.extend(new)
+            self.entries.sort(key=lambda e: e[3])
+            self.keys = [e[3] for e in self.entries]
+
+    def add_books(self, books: [(dict, int)], skip_known: bool = False):
+        # books为[(catalog文档, 新增的上架记录数)]；skip_known时跳过已统计过的书目（增量拉取）
+        with self.lock:
+            new = []
+            for book, listings in books:
+                if skip_known and book["_id"] in self.books:
+                    continue
+                self.books.add(book["_id"])
+                for text, kind in self.book_terms(book):
+                    self.add_term(text, kind, listings, new)
+                created_at = book.get("created_at")
+                if created_at is not None and (self.watermark is None or created_at > self.watermark):
+                    self.watermark = created_at
+            self.insert_entries(new)
+
+    def add_book(self, book: dict, listings: int = 1):
+        self.add_books([(book, listings)])
+
+    @staticmethod
+    def build(books: [(dict, int)]) -> (list, list, dict, dict):
+        """不持有锁地从[(书目, 上架记录数)]构建(keys, entries, position, heads)，只排序一次"""
+        position = {}
+        for book, listings in books:
+            for text, kind in SuggestIndex.book_terms(book):
+                key = normalize(text)
+                if not key:
+                    continue
+                entry = position.get((key, kind))
+                if entry is None:
+                    entry = [text, kind, 0, key]
+                    position[(key, kind)] = entry
+                entry[2] = entry[2] + listings
+        entries = sorted(position.values(), key=lambda e: e[3])
+        keys = [e[3] for e in entries]
+        heads = {}
+        for entry in entries:
+            for n in range(1, min(HEAD_LEN, len(entry[3])) + 1):
+                heads.setdefault(entry[3][:n], []).append(entry)
+        for prefix, head in heads.items():
+            heads[prefix] = heapq.nsmallest(MAX_K, head, key=lambda e: (-e[2], e[3]))
+        return keys, entries, position, heads
+
+    def fetch(self, query: dict = None) -> [(dict, int)]:
+        # 读取书目及其上架记录数（热度），不持有锁
+        books = []
+        fields = {"title": 1, "author": 1, "tags": 1, "created_at": 1}
+        batch = []
+        for book in self.conn.catalog.find(query or {}, fields).sort("created_at", 1):
+            batch.append(book)
+            if len(batch) >= 1000:
+                books.extend(self.fetch_counts(batch))
+                batch = []
+        if batch:
+            books.extend(self.fetch_counts(batch))
+        return books
+
+    def fetch_counts(self, books: [dict]) -> [(dict, int)]:
+        counts = {
+            group["_id"]: group["n"]
+            for group in self.conn.inventory.aggregate([
+                {"$match": {"book_id": {"$in": [book["_id"] for book in books]}}},
+                {"$group": {"_id": "$book_id", "n": {"$sum": 1}}},
+            ])
+        }
+        return [(book, counts.get(book["_id"], 1)) for book in books]
+
+    def ensure_fresh(self):
+        # 第一次使用时全量构建，之后按created_at增量拉取其他进程写入的书目
+        now = time.time()
+        with self.lock:
+            loaded = self.loaded
+            if loaded and now - self.last_refresh < ngram.REFRESH_INTERVAL:
+                return
+        # 构建完成前的查询等待构建结束；已构建时不等待其他线程正在进行的拉取
+        if not self.refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            with self.lock:
+                if not loaded and self.loaded:
+                    return
+                self.last_refresh = now
+                watermark = self.watermark
+            if not loaded:
+                start = time.time()
+                books = self.fetch()
+                keys, entries, position, heads = self.build(books)
+                with self.lock:
+                    self.keys, self.entries, self.position, self.heads = keys, entries, position, heads
+                    self.books = {book["_id"] for book, _ in books}
+                    for book, _ in books:
+                        created_at = book.get("created_at")
+                        if created_at is not None and (self.watermark is None or created_at > self.watermark):
+                            self.watermark = created_at
+                    self.loaded = True
+                logging.info("suggest index built: %d books in %.2fs", len(books), time.time() - start)
+            else:
+                query = {}
+                if watermark is not None:
+                    query = {"created_at": {"$gte": watermark - timedelta(seconds=ngram.REFRESH_OVERLAP)}}
+                self.add_books(self.fetch(query), skip_known=True)
+        finally:
+            self.refresh_lock.release()
+
+    def complete(self, prefix: str, k: int = 10) -> [dict]:
+        self.ensure_fresh()
+        start = time.perf_counter()
+        key = normalize(prefix)
+        k = max(1, min(k, MAX_K))
+        with self.lock:
+            if not key:
+                entries = []
+            elif len(key) <= HEAD_LEN:
+                entries = self.heads.get(key, [])[:k]
+            else:
+                lo = bisect.bisect_left(self.keys, key)
+                hi = bisect.bisect_left(self.keys, key + "\U0010ffff")
+                entries = heapq.nsmallest(k, self.entries[lo:hi], key=lambda e: (-e[2], e[3]))
+            result = [{"text": e[0], "type": e[1], "weight": e[2]} for e in entries]
+            self.queries = self.queries + 1
+            self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = sorted(self.latencies)
+            data = {"terms": len(self.keys), "books": len(self.books), "queries": self.queries}
+        if samples:
+            data["p99_ms"] = samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000
+        return data
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> SuggestIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SuggestIndex()
+        return _index
+
+
+def warm_up():
+    # 启动时在后台线程中构建索引，构建完成前的查询会等待构建结束
+    threading.Thread(target=get_index().ensure_fresh, name="suggest-build", daemon=True).start()
+
+
+def record_listing(book: dict):
+    # 上架一本书时增加其书名、作者、标签的热度；索引尚未构建时由构建过程统计
+    if _index is not None and _index.loaded:
+        _index.add_book(book)
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from be.model import metrics
+from be.model.search_cache import LocalGenerations, SharedGenerations
+
+# 缓存的已验证令牌数上限
+CAPACITY = int(os.environ.get("BOOKSTORE_TOKEN_CACHE_SIZE", "10000"))
+# 条目最长保留的秒数，到期后重新读取会话
+REVALIDATE = float(os.environ.get("BOOKSTORE_TOKEN_REVALIDATE", "30"))
+
+
+def user_scope(user_id: str) -> str:
+    return "user:" + user_id
+
+
+class TokenCache:
+    """进程内的已验证令牌缓存，键为(user_id, token)
+
+    条目在令牌到期时（最长REVALIDATE秒后）失效。登录替换、登出、改密和注销时递增该用户的失效代号
+    （与搜索缓存相同的LocalGenerations/SharedGenerations，范围为user:<user_id>），并删除本进程中的相应条目。
+    条目保存校验前取得的代号，命中时代号已变化即视为失效：校验期间发生的登出不会被并发的校验重新放回，
+    多进程部署时改用共享代号，其他进程的登出、改密在下一次命中时即被发现。
+    共享代号的命中多一次按_id的读取，仍省去会话查询和JWT解码。
+    """
+
+    def __init__(self, capacity: int = CAPACITY, revalidate: float = REVALIDATE, generations=None):
+        self.capacity = capacity
+        self.revalidate = revalidate
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.users = {}
+        self.generations = generations or LocalGenerations()
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0, "invalidated": 0}
+
+    def lookup(self, key: tuple):
+        # 返回未到期条目保存的代号，没有时为None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+            if entry is not None:
+                self.remove(key)
+            self.counts["misses"] = self.counts["misses"] + 1
+            return None
+
+    def settle(self, key: tuple, generation: tuple, current: tuple) -> bool:
+        with self.lock:
+            if generation != current:
+                if key in self.entries:
+                    self.remove(key)
+                self.counts["invalidated"] = self.counts["invalidated"] + 1
+                self.counts["misses"] = self.counts["misses"] + 1
+                return False
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.counts["hits"] = self.counts["hits"] + 1
+            return True
+
+    def get(self, user_id: str, token: str) -> bool:
+        key = (user_id, token)
+        generation = self.lookup(key)
+        if generation is None:
+            return False
+        # 共享代号需要读取数据库，不在持有锁时进行
+        return self.settle(key, generation, self.generations.read((user_scope(user_id),)))
+
+    async def get_async(self, conn, user_id: str, token: str) -> bool:
+        key = (user_id, token)
+        generation = self.lookup(key)
+        if generation is None:
+            return False
+        return self.settle(key, generation, await self.generations.read_async(conn, (user_scope(user_id),)))
+
+    def snapshot_generation(self, user_id: str) -> tuple:
+        return self.generations.read((user_scope(user_id),))
+
+    async def snapshot_generation_async(self, conn, user_id: str) -> tuple:
+        return await self.generations.read_async(conn, (user_scope(user_id),))
+
+    def put(self, user_id: str, token: str, expires_at: float, generation: tuple):
+        """generation 为读取会话前调用 snapshot_generation 得到的代号"""
+        key = (user_id, token)
+        with self.lock:
+            if not self.capacity:
+                return
+            self.entries[key] = (min(expires_at, time.time() + self.revalidate), generation)
+            self.entries.move_to_end(key)
+            self.users.setdefault(user_id, set()).add(token)
+            while len(self.entries) > self.capacity:
+                self.remove(next(iter(self.entries)))
+                self.counts["evictions"] = self.counts["evictions"] + 1
+
+    def remove(self, key: tuple):
+        # 调用者持有锁
+        del self.entries[key]
+        tokens = self.users.get(key[0])
+        if tokens is not None:
+            tokens.discard(key[1])
+            if not tokens:
+                del self.users[key[0]]
+
+    def discard(self, user_id: str, token: str = None):
+        # 删除本进程中该用户某个令牌（token为None时为全部令牌）的条目
+        with self.lock:
+            tokens = list(self.users.get(user_id, ())) if token is None else [token]
+            for token in tokens:
+                if (user_id, token) in self.entries:
+                    self.remove((user_id, token))
+                    self.counts["invalidated"] = self.counts["invalidated"] + 1
+
+    def invalidate(self, user_id: str, token: str = None):
+        self.generations.bump((user_scope(user_id),))
+        self.discard(user_id, token)
+
+    async def invalidate_async(self, conn, user_id: str, token: str = None):
+        await self.generations.bump_async(conn, (user_scope(user_id),))
+        self.discard(user_id, token)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            data = dict(self.counts, size=len(self.entries), enabled=self.capacity > 0)
+        data["shared"] = isinstance(self.generations, SharedGenerations)
+        return data
+
+
+cache = TokenCache()
+metrics.register("token_cache", cache.snapshot)
+
+
+def share_generations():
+    # 多进程部署时在工作进程中调用，此后的登出、改密对所有进程可见
+    cache.generations = SharedGenerations()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import random
+import time
+from pymongo.errors import PyMongoError
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from be.model import metrics
+
+# 事务因写冲突等瞬时错误被中止后的最大重试次数
+MAX_RETRIES = 5
+# 重试前的随机退避上限（秒），避免并发买家同时重试再次冲突
+RETRY_BACKOFF = 0.01
+
+stats = metrics.Counters("transaction")
+
+
+class Abort(Exception):
+    """业务校验失败，需要回滚整个事务并向客户端返回(code, message)"""
+
+    def __init__(self, code: int, message: str):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def _has_label(e: Exception, label: str) -> bool:
+    return isinstance(e, PyMongoError) and e.has_error_label(label)
+
+
+def run(client, body, use_transaction: bool):
+    """执行 body(session, undo) 并返回其结果
+
+    事务模式下 body 在多文档事务中执行，遇到 TransientTransactionError
+    （如写冲突）时整体重试，提交结果未知时重试提交；undo 列表被忽略。
+    补偿模式下 session 为 None，body 每完成一次写操作就向 undo 追加
+    对应的补偿函数，出错时按相反顺序执行补偿后重新抛出异常。
+    """
+    if not use_transaction:
+        return _run_compensating(body)
+
+    retries = 0
+    while True:
+        with client.start_session() as session:
+            session.start_transaction(
+                read_concern=ReadConcern("snapshot"),
+                write_concern=WriteConcern("majority"),
+            )
+            try:
+                result = body(session, [])
+                _commit(session)
+            except Exception as e:
+                if session.in_transaction:
+                    session.abort_transaction()
+                stats.inc("abort")
+                if _has_label(e, "TransientTransactionError") and retries < MAX_RETRIES:
+                    retries = retries + 1
+                    stats.inc("retry")
+                    time.sleep(random.uniform(0, RETRY_BACKOFF * retries))
+                    continue
+                raise
+            stats.inc("commit")
+            return result
+
+
+def _commit(session):
+    attempts = 0
+    while True:
+        try:
+            session.commit_transaction()
+            return
+        except PyMongoError as e:
+            if e.has_error_label("UnknownTransactionCommitResult") and attempts < MAX_RETRIES:
+                attempts = attempts + 1
+                stats.inc("commit_retry")
+                continue
+            raise
+
+
+def _run_compensating(body):
+    undo = []
+    try:
+        result = body(None, undo)
+    except Exception:
+        stats.inc("abort")
+        for compensate in reversed(undo):
+            try:
+                compensate()
+                stats.inc("compensation")
+            except Exception as e:
+                logging.error("补偿操作失败: {}".format(str(e)))
+        raise
+    stats.inc("commit")
+    return result
+
+
+async def run_async(client, body, use_transaction: bool):
+    """run的asyncio版本：body为 async body(session, undo)，client为AsyncMongoClient
+
+    补偿模式下undo中登记的是async函数，出错时按相反顺序await。
+    """
+    if not use_transaction:
+        return await _run_compensating_async(body)
+
+    retries = 0
+    while True:
+        async with client.start_session() as session:
+            await session.start_transaction(
+                read_concern=ReadConcern("snapshot"),
+                write_concern=WriteConcern("majority"),
+            )
+            try:
+                result = await body(session, [])
+                await _commit_async(session)
+            except Exception as e:
+                if session.in_transaction:
+                    await session.abort_transaction()
+                stats.inc("abort")
+                if _has_label(e, "TransientTransactionError") and retries < MAX_RETRIES:
+                    retries = retries + 1
+                    stats.inc("retry")
+                    await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * retries))
+                    continue
+                raise
+            stats.inc("commit")
+            return result
+
+
+async def _commit_async(session):
+    attempts = 0
+    while True:
+        try:
+            await session.commit_transaction()
+            return
+        except PyMongoError as e:
+            if e.has_error_label("UnknownTransactionCommitResult") and attempts < MAX_RETRIES:
+                attempts = attempts + 1
+                stats.inc("commit_retry")
+                continue
+            raise
+
+
+async def _run_compensating_async(body):
+    undo = []
+    try:
+        result = await body(None, undo)
+    except Exception:
+        stats.inc("abort")
+        for compensate in reversed(undo):
+            try:
+                await compensate()
+                stats.inc("compensation")
+            except Exception as e:
+                logging.error("补偿操作失败: {}".format(str(e)))
+        raise
+    stats.inc("commit")
+    return result
@@ -3,6 +3,8 @@ import time
 import logging
 from be.model import error
 from be.model import db_conn
+from be.model import token_cache
+from be.model import session
 
 # encode a json string like:
 #   {
@@ -18,7 +20,8 @@ def jwt_encode(user_id: str, terminal: str) -> str:
         key=user_id,
         algorithm="HS256",
     )
-    return encoded.decode("utf-8")
+    # PyJWT 2.x直接返回str，1.x返回bytes
+    return encoded if isinstance(encoded, str) else encoded.decode("utf-8")
 
 
 # decode a JWT to a json string like:
@@ -32,37 +35,40 @@ def jwt_decode(encoded_token, user_id: str) -> str:
     return decoded
 
 
+def token_expires_at(user_id: str, db_token: str, token: str, lifetime: int) -> float:
+    # 令牌与会话中的令牌一致且未过期时返回其到期时间，否则返回None
+    try:
+        if db_token != token:
+            return None
+        ts = jwt_decode(encoded_token=token, user_id=user_id)["timestamp"]
+        if ts is not None and lifetime > time.time() - ts >= 0:
+            return ts + lifetime
+    except jwt.exceptions.InvalidSignatureError as e:
+        logging.error(str(e))
+    return None
+
+
+def terminal_of(user_id: str, token: str) -> str:
+    # 令牌中带有登录终端，签名不属于该用户或格式错误时返回None
+    try:
+        return jwt_decode(encoded_token=token, user_id=user_id).get("terminal")
+    except jwt.exceptions.InvalidTokenError:
+        return None
+
+
 class User(db_conn.DBConn):
-    token_lifetime: int = 3600  # 3600 second
+    token_lifetime: int = session.TOKEN_LIFETIME
 
     def __init__(self):
         db_conn.DBConn.__init__(self)
 
-    def __check_token(self, user_id, db_token, token) -> bool:
-        try:
-            if db_token != token:
-                return False
-            jwt_text = jwt_decode(encoded_token=token, user_id=user_id)
-            ts = jwt_text["timestamp"]
-            if ts is not None:
-                now = time.time()
-                if self.token_lifetime > now - ts >= 0:
-                    return True
-        except jwt.exceptions.InvalidSignatureError as e:
-            logging.error(str(e))
-            return False
-
     def register(self, user_id: str, password: str):
         try:
-            terminal = "terminal_{}".format(str(time.time()))
-            token = jwt_encode(user_id, terminal)
-            # 使用MongoDB插入用户数据
+            # 使用MongoDB插入用户数据；登录会话保存在session集合中
             user_data = {
                 "user_id": user_id,
                 "password": password,
                 "balance": 0,
-                "token": token,
-                "terminal": terminal
             }
             result = self.conn.user.insert_one(user_data)
             if not result.acknowledged:
@@ -72,18 +78,29 @@ class User(db_conn.DBConn):
         return 200, "ok"
 
     def check_token(self, user_id: str, token: str) -> (int, str):
-        # 使用MongoDB查询用户token
-        user = self.conn.user.find_one({"user_id": user_id})
-        if user is None:
+        # 最近验证过且未失效的令牌直接通过，不读取会话也不重新解码JWT
+        if not user_id or not token:
+            return error.error_authorization_fail()
+        if token_cache.cache.get(user_id, token):
+            return 200, "ok"
+        generation = token_cache.cache.snapshot_generation(user_id)
+
+        # 按令牌中的终端读取该终端的会话，只取token字段
+        terminal = terminal_of(user_id, token)
+        if terminal is None:
             return error.error_authorization_fail()
-        db_token = user["token"]
-        if not self.__check_token(user_id, db_token, token):
+        row = self.conn.session.find_one({"user_id": user_id, "terminal": terminal}, {"_id": 0, "token": 1})
+        if row is None:
             return error.error_authorization_fail()
+        expires_at = token_expires_at(user_id, row["token"], token, self.token_lifetime)
+        if expires_at is None:
+            return error.error_authorization_fail()
+        token_cache.cache.put(user_id, token, expires_at, generation)
         return 200, "ok"
 
     def check_password(self, user_id: str, password: str) -> (int, str):
         # 使用MongoDB查询用户密码
-        user = self.conn.user.find_one({"user_id": user_id})
+        user = self.conn.user.find_one({"user_id": user_id}, {"_id": 0, "password": 1})
         if user is None:
             return error.error_authorization_fail()
 
@@ -99,14 +116,16 @@ class User(db_conn.DBConn):
             if code != 200:
                 return code, message, ""
 
+            # 每个终端一个会话，重新登录只替换该终端的令牌，其他终端的会话不受影响
             token = jwt_encode(user_id, terminal)
-            # 使用MongoDB更新用户token和terminal
-            result = self.conn.user.update_one(
-                {"user_id": user_id},
-                {"$set": {"token": token, "terminal": terminal}}
+            previous = self.conn.session.find_one_and_update(
+                {"user_id": user_id, "terminal": terminal},
+                {"$set": {"token": token, "expires_at": session.expires_at(time.time())}},
+                projection={"_id": 0, "token": 1},
+                upsert=True,
             )
-            if result.matched_count == 0:
-                return error.error_authorization_fail() + ("",)
+            if previous is not None:
+                token_cache.cache.invalidate(user_id, previous["token"])
         except Exception as e:
             return 528, "{}".format(str(e)), ""
         return 200, "ok", token
@@ -117,15 +136,12 @@ class User(db_conn.DBConn):
             if code != 200:
                 return code, message
 
-            terminal = "terminal_{}".format(str(time.time()))
-            dummy_token = jwt_encode(user_id, terminal)
-
-            # 使用MongoDB更新用户token和terminal
-            result = self.conn.user.update_one(
-                {"user_id": user_id},
-                {"$set": {"token": dummy_token, "terminal": terminal}}
+            # 只删除该令牌所在终端的会话
+            result = self.conn.session.delete_one(
+                {"user_id": user_id, "terminal": terminal_of(user_id, token), "token": token}
             )
-            if result.matched_count == 0:
+            token_cache.cache.invalidate(user_id, token)
+            if result.deleted_count == 0:
                 return error.error_authorization_fail()
         except Exception as e:
             return 528, "{}".format(str(e))
@@ -137,8 +153,10 @@ class User(db_conn.DBConn):
             if code != 200:
                 return code, message
 
-            # 使用MongoDB删除用户
+            # 使用MongoDB删除用户及其全部会话
             result = self.conn.user.delete_one({"user_id": user_id})
+            self.conn.session.delete_many({"user_id": user_id})
+            token_cache.cache.invalidate(user_id)
             if result.deleted_count != 1:
                 return error.error_authorization_fail()
         except Exception as e:
@@ -153,13 +171,13 @@ class User(db_conn.DBConn):
             if code != 200:
                 return code, message
 
-            terminal = "terminal_{}".format(str(time.time()))
-            token = jwt_encode(user_id, terminal)
-            # 使用MongoDB更新用户密码、token和terminal
+            # 使用MongoDB更新用户密码，并使所有终端的会话失效
             result = self.conn.user.update_one(
                 {"user_id": user_id},
-                {"$set": {"password": new_password, "token": token, "terminal": terminal}}
+                {"$set": {"password": new_password}}
             )
+            self.conn.session.delete_many({"user_id": user_id})
+            token_cache.cache.invalidate(user_id)
             if result.matched_count == 0:
                 return error.error_authorization_fail()
         except Exception as e:
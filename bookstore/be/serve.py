@@ -1,25 +1,42 @@
+import fcntl
 import logging
 import os
 import threading
-import time
-from datetime import datetime
 from flask import Flask
 from flask import Blueprint
-from flask import request
+from werkzeug.serving import make_server
 from be.view import auth
 from be.view import seller
 from be.view import buyer
+from be.view import metrics
+from be.view import token_check
+from be.view import admission
 from be.model.store import init_database, init_completed_event
-from be.model.buyer import Buyer
+from be.model import expiry
+from be.model import ngram
+from be.model import suggest
+from be.model import similar
+from be.model import search_cache
+from be.model import token_cache
 
 bp_shutdown = Blueprint("shutdown", __name__)
 
+# be_run启动的开发服务器，/shutdown通过它停止
+server = None
+# gunicorn、ASGI服务器的多个工作进程中，拿到这个文件锁的进程负责只需运行一份的后台任务
+SINGLETON_LOCK = os.environ.get(
+    "BOOKSTORE_SINGLETON_LOCK",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "singleton.lock"),
+)
+singleton_lock = None
+logging_initialized = False
+
 
 def shutdown_server():
-    func = request.environ.get("werkzeug.server.shutdown")
-    if func is None:
-        raise RuntimeError("Not running with the Werkzeug Server")
-    func()
+    if server is None:
+        raise RuntimeError("Not running with be_run")
+    # shutdown()等待serve_forever退出，不能在处理请求的线程中直接调用
+    threading.Thread(target=server.shutdown, name="shutdown", daemon=True).start()
 
 
 @bp_shutdown.route("/shutdown")
@@ -28,84 +45,96 @@ def be_shutdown():
     return "Server shutting down..."
 
 
-def check_expired_orders():
-    """后台检查过期订单并取消它们"""
-    buyer = Buyer()
-    while True:
-        try:
-            # 查询所有待付款且已过期的订单
-            current_time = datetime.now()
-            expired_orders = list(buyer.conn.order.find({
-                "status": "pending",
-                "payment_deadline": {"$lt": current_time}
-            }))
-            
-            # 按order_id分组订单
-            order_groups = {}
-            for order in expired_orders:
-                order_id = order["order_id"]
-                if order_id not in order_groups:
-                    order_groups[order_id] = []
-                order_groups[order_id].append(order)
-            
-            # 取消每个过期订单
-            for order_id, orders in order_groups.items():
-                if not orders:
-                    continue
-                    
-                store_id = orders[0]["store_id"]
-                
-                # 更新订单状态为已取消
-                buyer.conn.order.update_many(
-                    {"order_id": order_id},
-                    {"$set": {"status": "canceled"}}
-                )
-                
-                # 恢复所有书籍的库存
-                for order in orders:
-                    book_id = order["book_id"]
-                    count = order["count"]
-                    buyer.conn.book.update_one(
-                        {"book_id": book_id, "belong_store_id": store_id},
-                        {"$inc": {"stock_level": count}}
-                    )
-            
-            # 每隔一段时间检查一次（例如60秒）
-            time.sleep(60)
-        except Exception as e:
-            logging.error("检查过期订单时出错: {}".format(str(e)))
-            time.sleep(60)  # 出错时也继续检查
-
-
-def start_background_tasks():
-    """启动后台任务"""
-    # 启动检查过期订单的线程
-    order_check_thread = threading.Thread(target=check_expired_orders, daemon=True)
-    order_check_thread.start()
-
-
-def be_run():
+def create_app() -> Flask:
+    """创建Flask应用：注册蓝图和令牌校验，不连接数据库（连接由init_worker在fork之后创建）"""
+    app = Flask(__name__)
+    # 先做准入控制，过载时直接拒绝；除公开接口外，所有请求再校验登录令牌
+    app.before_request(admission.admit)
+    app.teardown_request(admission.release)
+    app.before_request(token_check.check_token)
+    app.register_blueprint(bp_shutdown)
+    app.register_blueprint(auth.bp_auth)
+    app.register_blueprint(seller.bp_seller)
+    app.register_blueprint(buyer.bp_buyer)
+    app.register_blueprint(metrics.bp_metrics)
+    return app
+
+
+def init_logging():
+    # 只配置一次：be.launcher的主进程已经配置过，fork出的工作进程继承这些处理器，再添加会使每行日志输出两次
+    global logging_initialized
+    if logging_initialized:
+        return
+    logging_initialized = True
     this_path = os.path.dirname(__file__)
     parent_path = os.path.dirname(this_path)
     log_file = os.path.join(parent_path, "app.log")
-    init_database(parent_path)
-
     logging.basicConfig(filename=log_file, level=logging.ERROR)
     handler = logging.StreamHandler()
     formatter = logging.Formatter(
-        "%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s"
+        "%(asctime)s [%(process)d] [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s"
     )
     handler.setFormatter(formatter)
     logging.getLogger().addHandler(handler)
 
-    app = Flask(__name__)
-    app.register_blueprint(bp_shutdown)
-    app.register_blueprint(auth.bp_auth)
-    app.register_blueprint(seller.bp_seller)
-    app.register_blueprint(buyer.bp_buyer)
+
+def start_background_tasks(singleton: bool = True):
+    """启动后台任务
+
+    singleton为False时只启动每个进程都需要的任务；多进程部署时只有一个指定的工作进程传入True。
+    """
+    if singleton:
+        # 启动按付款截止时间取消过期订单的调度器
+        expiry.start_scheduler()
+    # 在后台构建n-gram检索索引和搜索补全索引，第一次搜索不必等待全量构建
+    ngram.warm_up()
+    suggest.warm_up()
+    # 映射相似图书的TF-IDF矩阵，不存在时在后台构建
+    similar.warm_up()
+
+
+def stop_background_tasks():
+    expiry.stop_scheduler()
+
+
+def acquire_singleton() -> bool:
+    # 锁在进程退出时随文件描述符释放，由重启的工作进程重新获取
+    global singleton_lock
+    lock_file = open(SINGLETON_LOCK, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    singleton_lock = lock_file
+    return True
+
+
+def init_worker(singleton: bool = True, migrate: bool = None, shared: bool = False):
+    """在工作进程中（fork之后）初始化：日志、数据库连接和后台任务
+
+    migrate为None时按BOOKSTORE_AUTO_MIGRATE；多进程部署时迁移已由主进程完成，传入False。
+    shared为真时（多个进程同时服务：be.launcher多于一个工作进程时，以及gunicorn、ASGI入口）搜索缓存和令牌缓存改用数据库中共享的失效代号。
+    """
+    this_path = os.path.dirname(__file__)
+    parent_path = os.path.dirname(this_path)
+    init_logging()
+    if migrate is None:
+        init_database(parent_path)
+    else:
+        init_database(parent_path, migrate)
+    if shared:
+        search_cache.share_generations()
+        token_cache.share_generations()
     init_completed_event.set()
-    
-    # 启动后台任务
-    start_background_tasks()
-    
-    app.run()
+    start_background_tasks(singleton)
+
+
+def be_run(host: str = "127.0.0.1", port: int = 5000):
+    # 单进程的开发服务器，测试时由fe/conftest.py在线程中启动
+    global server
+    app = create_app()
+    init_worker()
+    server = make_server(host, port, app, threaded=True)
+    server.serve_forever()
+    stop_background_tasks()
@@ -0,0 +1,29 @@
+from flask import g
+from flask import request
+from flask import jsonify
+from be.model import admission
+from be.model import error
+
+# ASGI入口转交给Flask的请求在environ中带有此标记
+ADMITTED = "bookstore.admitted"
+
+
+def admit():
+    """before_request：按端点的准入控制，未被放行时返回503和Retry-After
+
+    在令牌校验之前执行，过载时被拒绝的请求不访问数据库。
+    """
+    # ASGI入口已在事件循环中放行的请求不再重复计数
+    if request.endpoint is None or request.environ.get(ADMITTED):
+        return None
+    try:
+        g.admission_ticket = admission.controller.admit(request.endpoint)
+    except admission.Overloaded as e:
+        code, message = error.error_overloaded(e.retry_after)
+        return jsonify({"message": message}), code, {"Retry-After": str(e.retry_after)}
+    return None
+
+
+def release(exc):
+    # teardown_request：请求结束（包括出错）时归还并发名额
+    admission.controller.release(g.pop("admission_ticket", None))
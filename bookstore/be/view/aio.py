@@ -0,0 +1,130 @@
+import json
+from be.model.aio.user import User
+from be.model.aio.buyer import Buyer
+from be.model.aio.seller import Seller
+
+# ASGI入口（be/asgi.py）中直接以asyncio处理的接口，请求和响应格式与be/view中同名的Flask视图一致。
+# 每个处理函数接收请求体和请求头，返回(响应体, 状态码)。
+
+
+async def login(body: dict, headers: dict) -> (dict, int):
+    code, message, token = await User().login(
+        user_id=body.get("user_id", ""), password=body.get("password", ""), terminal=body.get("terminal", "")
+    )
+    return {"message": message, "token": token}, code
+
+
+async def logout(body: dict, headers: dict) -> (dict, int):
+    code, message = await User().logout(user_id=body.get("user_id"), token=headers.get("token"))
+    return {"message": message}, code
+
+
+async def register(body: dict, headers: dict) -> (dict, int):
+    code, message = await User().register(user_id=body.get("user_id", ""), password=body.get("password", ""))
+    return {"message": message}, code
+
+
+async def unregister(body: dict, headers: dict) -> (dict, int):
+    code, message = await User().unregister(user_id=body.get("user_id", ""), password=body.get("password", ""))
+    return {"message": message}, code
+
+
+async def change_password(body: dict, headers: dict) -> (dict, int):
+    code, message = await User().change_password(
+        user_id=body.get("user_id", ""),
+        old_password=body.get("oldPassword", ""),
+        new_password=body.get("newPassword", ""),
+    )
+    return {"message": message}, code
+
+
+async def seller_create_store(body: dict, headers: dict) -> (dict, int):
+    code, message = await Seller().create_store(body.get("user_id"), body.get("store_id"))
+    return {"message": message}, code
+
+
+async def seller_add_book(body: dict, headers: dict) -> (dict, int):
+    book_info = body.get("book_info")
+    code, message = await Seller().add_book(
+        body.get("user_id"), body.get("store_id"), book_info.get("id"), json.dumps(book_info),
+        body.get("stock_level", 0),
+    )
+    return {"message": message}, code
+
+
+async def add_stock_level(body: dict, headers: dict) -> (dict, int):
+    code, message = await Seller().add_stock_level(
+        body.get("user_id"), body.get("store_id"), body.get("book_id"), body.get("add_stock_level", 0)
+    )
+    return {"message": message}, code
+
+
+async def send(body: dict, headers: dict) -> (dict, int):
+    order_id = body.get("order_id")
+    if not headers.get("token") or not order_id:
+        return {"message": "Missing token or order_id"}, 400
+    user_id = body.get("user_id")
+    if not user_id:
+        return {"message": "Missing user_id"}, 400
+    code, message = await Seller().send(user_id, order_id)
+    return {"message": message}, code
+
+
+async def new_order(body: dict, headers: dict) -> (dict, int):
+    id_and_count = [(book.get("id"), book.get("count")) for book in body.get("books")]
+    code, message, order_id = await Buyer().new_order(body.get("user_id"), body.get("store_id"), id_and_count)
+    return {"message": message, "order_id": order_id}, code
+
+
+async def payment(body: dict, headers: dict) -> (dict, int):
+    code, message = await Buyer().payment(body.get("user_id"), body.get("password"), body.get("order_id"))
+    return {"message": message}, code
+
+
+async def add_funds(body: dict, headers: dict) -> (dict, int):
+    code, message = await Buyer().add_funds(body.get("user_id"), body.get("password"), body.get("add_value"))
+    return {"message": message}, code
+
+
+async def receive(body: dict, headers: dict) -> (dict, int):
+    code, message = await Buyer().receive(body.get("user_id"), body.get("order_id"))
+    return {"message": message}, code
+
+
+async def query_order(body: dict, headers: dict) -> (dict, int):
+    user_id = body.get("user_id")
+    order_id = body.get("order_id")
+    if not user_id or not order_id:
+        return {"message": "Missing required parameters", "data": {}}, 400
+    code, message, data = await Buyer().query_order(user_id, order_id)
+    return {"message": message, "data": data}, code
+
+
+async def cancel_order(body: dict, headers: dict) -> (dict, int):
+    user_id = body.get("user_id")
+    order_id = body.get("order_id")
+    password = body.get("password")
+    if not user_id or not order_id or not password:
+        return {"message": "Missing required parameters"}, 400
+    code, message = await Buyer().cancel_order(user_id, order_id, password)
+    return {"message": message}, code
+
+
+# 路径 -> (Flask中的端点名, 处理函数)；端点名用于判断是否需要令牌（token_check.PUBLIC_ENDPOINTS）
+ROUTES = {
+    "/auth/login": ("auth.login", login),
+    "/auth/logout": ("auth.logout", logout),
+    "/auth/register": ("auth.register", register),
+    "/auth/unregister": ("auth.unregister", unregister),
+    "/auth/password": ("auth.change_password", change_password),
+    "/seller/create_store": ("seller.seller_create_store", seller_create_store),
+    "/seller/add_book": ("seller.seller_add_book", seller_add_book),
+    "/seller/add_stock_level": ("seller.add_stock_level", add_stock_level),
+    "/seller/send": ("seller.send", send),
+    "/buyer/new_order": ("buyer.new_order", new_order),
+    "/buyer/payment": ("buyer.payment", payment),
+    "/buyer/add_funds": ("buyer.add_funds", add_funds),
+    "/buyer/receive": ("buyer.receive", receive),
+    "/buyer/query_order": ("buyer.query_order", query_order),
+    "/buyer/cancel_order": ("buyer.cancel_order", cancel_order),
+}
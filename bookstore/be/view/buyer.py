@@ -2,6 +2,7 @@ from flask import Blueprint
 from flask import request
 from flask import jsonify
 from be.model.buyer import Buyer
+from be.model import search
 
 bp_buyer = Blueprint("buyer", __name__, url_prefix="/buyer")
 
@@ -51,16 +52,51 @@ def receive():
     return jsonify({"message": message}), code
 
 
-@bp_buyer.route("/search_global", methods=["POST"])
-def search_global():
-    keyword: str = request.json.get("keyword")
-    page = request.json.get("page", 1)
-    limit = request.json.get("limit", 10)
-    
-    # 参数验证
-    if not keyword:
-        return jsonify({"message": "Missing keyword parameter", "data": {}}), 400
-    
+def parse_search_options(body: dict) -> (list, dict, str):
+    """解析搜索的限定字段和结构化筛选条件，返回(fields, filters, 错误信息)"""
+    fields = body.get("fields") or None
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+    if fields is not None and (not isinstance(fields, list) or any(field not in search.FIELDS for field in fields)):
+        return None, None, "Invalid fields parameter"
+
+    filters = {}
+    for name in ("author", "publisher", "tag", "pub_year"):
+        value = body.get(name)
+        if value not in (None, ""):
+            filters[name] = str(value)
+    for name in ("min_price", "max_price"):
+        value = body.get(name)
+        if value is None:
+            continue
+        try:
+            filters[name] = int(value)
+        except Exception:
+            return None, None, "Invalid {} parameter".format(name)
+    return fields, filters, None
+
+
+def parse_flag(body: dict, name: str) -> (bool, str):
+    """解析布尔参数，缺省为false；只接受JSON的true/false，字符串"false"等返回错误信息，不会被当作true"""
+    value = body.get(name, False)
+    if not isinstance(value, bool):
+        return None, "Invalid {} parameter".format(name)
+    return value, None
+
+
+def parse_search_request(body: dict) -> (dict, str):
+    """解析一个搜索请求的公共参数，返回(Buyer搜索方法的关键字参数, 错误信息)"""
+    keyword: str = body.get("keyword")
+    page = body.get("page", 1)
+    limit = body.get("limit", 10)
+
+    # 参数验证：没有关键词时至少要给出一个筛选条件
+    fields, filters, message = parse_search_options(body)
+    if message:
+        return None, message
+    if not keyword and not filters:
+        return None, "Missing keyword parameter"
+
     # 确保page和limit是正整数（容错字符串数字）
     try:
         page = int(page)
@@ -74,41 +110,150 @@ def search_global():
         page = 1
     if limit <= 0:
         limit = 10
-    
+
+    # 检索后端，缺省时使用部署配置的后端
+    engine = body.get("engine") or None
+    if engine is not None and engine not in search.ENGINES:
+        return None, "Invalid engine parameter"
+    # 结果视图：compact只返回精简字段和简介摘要
+    view = body.get("view") or "full"
+    if view not in search.VIEWS:
+        return None, "Invalid view parameter"
+    # approx_total：只需要近似总数时，总数最多统计到一定数量；explain：在结果中附带执行计划；
+    # facets：在第一页结果中附带分面计数
+    flags = {}
+    for name in ("approx_total", "explain", "facets"):
+        flags[name], message = parse_flag(body, name)
+        if message:
+            return None, message
+
+    return {
+        "keyword": keyword,
+        "page": page,
+        "limit": limit,
+        # 上一页返回的next_cursor，给出时按游标续页
+        "cursor": body.get("cursor") or None,
+        "engine": engine,
+        "fields": fields,
+        "filters": filters,
+        "view": view,
+        **flags,
+    }, None
+
+
+@bp_buyer.route("/search_global", methods=["POST"])
+def search_global():
+    options, message = parse_search_request(request.json)
+    if message:
+        return jsonify({"message": message, "data": {}}), 400
+    # 为true时按书目合并各商店的上架记录，每本书只返回一条
+    grouped, message = parse_flag(request.json, "grouped")
+    if message:
+        return jsonify({"message": message, "data": {}}), 400
+
     b = Buyer()
-    code, message, data = b.search_global(keyword, page, limit)
+    code, message, data = b.search_global(grouped=grouped, **options)
     return jsonify({"message": message, "data": data}), code
 
 
 @bp_buyer.route("/search_in_store", methods=["POST"])
 def search_in_store():
-    keyword: str = request.json.get("keyword")
     store_id: str = request.json.get("store_id")
-    page = request.json.get("page", 1)
-    limit = request.json.get("limit", 10)
-    
-    # 参数验证
-    if not keyword:
-        return jsonify({"message": "Missing keyword parameter", "data": {}}), 400
+    options, message = parse_search_request(request.json)
+    if message:
+        return jsonify({"message": message, "data": {}}), 400
     if not store_id:
         return jsonify({"message": "Missing store_id parameter", "data": {}}), 400
-    
-    # 确保page和limit是正整数（容错字符串数字）
+
+    b = Buyer()
+    code, message, data = b.search_in_store(store_id=store_id, **options)
+    return jsonify({"message": message, "data": data}), code
+
+
+@bp_buyer.route("/search_batch", methods=["POST"])
+def search_batch():
+    # queries中每一项与search_global的参数相同，给出store_id时为店铺内搜索
+    queries = request.json.get("queries")
+    if not isinstance(queries, list) or not queries:
+        return jsonify({"message": "Missing queries parameter", "data": {}}), 400
+    if len(queries) > search.BATCH_MAX:
+        return jsonify({"message": "Too many queries", "data": {}}), 400
+
+    # 参数错误只影响对应的一项，其余查询照常执行
+    parsed = []
+    for query in queries:
+        if not isinstance(query, dict):
+            parsed.append((None, "Invalid query"))
+            continue
+        options, message = parse_search_request(query)
+        if options is not None:
+            if query.get("store_id"):
+                options["store_id"] = query["store_id"]
+            else:
+                options["grouped"], message = parse_flag(query, "grouped")
+                if message:
+                    options = None
+        parsed.append((options, message))
+
+    b = Buyer()
+    code, message, data = b.search_batch([options for options, _ in parsed if options is not None])
+    if code != 200:
+        return jsonify({"message": message, "data": data}), code
+    results = iter(data["results"])
+    data["results"] = [
+        next(results) if options is not None else {"code": 400, "message": error_message, "data": {}}
+        for options, error_message in parsed
+    ]
+    return jsonify({"message": message, "data": data}), code
+
+
+@bp_buyer.route("/facets", methods=["POST"])
+def facets():
+    # store_id为空时返回全站的分面计数
+    store_id: str = request.json.get("store_id") or None
+
+    b = Buyer()
+    code, message, data = b.facets(store_id)
+    return jsonify({"message": message, "data": data}), code
+
+
+@bp_buyer.route("/suggest", methods=["POST"])
+def suggest():
+    prefix: str = request.json.get("prefix")
+    limit = request.json.get("limit", 10)
+
+    # 参数验证
+    if not prefix:
+        return jsonify({"message": "Missing prefix parameter", "data": {}}), 400
     try:
-        page = int(page)
+        limit = int(limit)
     except Exception:
-        page = 1
+        limit = 10
+    if limit <= 0:
+        limit = 10
+
+    b = Buyer()
+    code, message, data = b.suggest(prefix, limit)
+    return jsonify({"message": message, "data": data}), code
+
+
+@bp_buyer.route("/similar", methods=["POST"])
+def similar():
+    book_id: str = request.json.get("book_id")
+    limit = request.json.get("limit", 10)
+
+    # 参数验证
+    if not book_id:
+        return jsonify({"message": "Missing book_id parameter", "data": {}}), 400
     try:
         limit = int(limit)
     except Exception:
         limit = 10
-    if page <= 0:
-        page = 1
-    if limit <= 0:
+    if limit <= 0 or limit > 100:
         limit = 10
-    
+
     b = Buyer()
-    code, message, data = b.search_in_store(keyword, store_id, page, limit)
+    code, message, data = b.similar(book_id, limit)
     return jsonify({"message": message, "data": data}), code
 
 
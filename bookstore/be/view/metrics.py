@@ -0,0 +1,10 @@
+from flask import Blueprint
+from flask import jsonify
+from be.model import metrics
+
+bp_metrics = Blueprint("metrics", __name__)
+
+
+@bp_metrics.route("/metrics")
+def be_metrics():
+    return jsonify(metrics.snapshot()), 200
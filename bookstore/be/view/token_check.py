@@ -0,0 +1,34 @@
+from flask import request
+from flask import jsonify
+from be.model import user
+
+# 不需要登录令牌的接口：认证接口自行校验密码或令牌，搜索类接口公开访问
+PUBLIC_ENDPOINTS = {
+    "shutdown.be_shutdown",
+    "metrics.be_metrics",
+    "auth.login",
+    "auth.logout",
+    "auth.register",
+    "auth.unregister",
+    "auth.change_password",
+    "buyer.search_global",
+    "buyer.search_in_store",
+    "buyer.search_batch",
+    "buyer.facets",
+    "buyer.suggest",
+    "buyer.similar",
+}
+
+
+def check_token():
+    """before_request：校验请求头中的token属于请求体中的user_id
+
+    未知路径交给Flask返回404；校验结果由User.check_token缓存，通常不访问数据库。
+    """
+    if request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    body = request.get_json(silent=True) or {}
+    code, message = user.User().check_token(body.get("user_id"), request.headers.get("token"))
+    if code != 200:
+        return jsonify({"message": message}), code
+    return None
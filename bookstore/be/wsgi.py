@@ -0,0 +1,10 @@
+from be import serve
+
+# gunicorn入口：gunicorn -w 4 --threads 8 be.wsgi:app
+# 不要使用--preload，否则MongoClient会在主进程中创建后被fork。
+# 过期订单调度器只在拿到锁文件（serve.SINGLETON_LOCK）的一个工作进程中启动。
+# 工作进程不迁移：由 -c python:be.gunicorn_conf 在主进程中执行一次，或事先运行 python -m be.migrate apply；
+# gunicorn通常有多个工作进程，缓存失效总是在进程间共享。
+
+app = serve.create_app()
+serve.init_worker(singleton=serve.acquire_singleton(), migrate=False, shared=True)
@@ -88,17 +88,78 @@ class Buyer:
         r = requests.post(url, headers=headers, json=json)
         return r.status_code
     
-    def search_global(self, keyword: str, page: int = 1, limit: int = 10) -> Tuple[int, str, dict]:
-        json = {"keyword": keyword, "page": page, "limit": limit}
+    def search_global(
+        self, keyword: str, page: int = 1, limit: int = 10, approx_total: bool = False, cursor: str = None,
+        engine: str = None, fields: list = None, filters: dict = None, explain: bool = False, facets: bool = False,
+        grouped: bool = False, view: str = None
+    ) -> Tuple[int, str, dict]:
+        json = {
+            "keyword": keyword,
+            "page": page,
+            "limit": limit,
+            "approx_total": approx_total,
+            "cursor": cursor,
+            "engine": engine,
+            "fields": fields,
+            "explain": explain,
+            "facets": facets,
+            "grouped": grouped,
+            "view": view,
+        }
+        # 筛选条件：author、publisher、tag、pub_year、min_price、max_price
+        json.update(filters or {})
         url = urljoin(self.url_prefix, "search_global")
         headers = {"token": self.token}
-        return self.__send_and_receive_json(url, "POST", json=json)
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
     
-    def search_in_store(self, keyword: str, store_id: str, page: int = 1, limit: int = 10) -> Tuple[int, str, dict]:
-        json = {"keyword": keyword, "store_id": store_id, "page": page, "limit": limit}
+    def search_in_store(
+        self, keyword: str, store_id: str, page: int = 1, limit: int = 10, approx_total: bool = False,
+        cursor: str = None, engine: str = None, fields: list = None, filters: dict = None, explain: bool = False,
+        facets: bool = False, view: str = None
+    ) -> Tuple[int, str, dict]:
+        json = {
+            "keyword": keyword,
+            "store_id": store_id,
+            "page": page,
+            "limit": limit,
+            "approx_total": approx_total,
+            "cursor": cursor,
+            "engine": engine,
+            "fields": fields,
+            "explain": explain,
+            "facets": facets,
+            "view": view,
+        }
+        # 筛选条件：author、publisher、tag、pub_year、min_price、max_price
+        json.update(filters or {})
         url = urljoin(self.url_prefix, "search_in_store")
         headers = {"token": self.token}
-        return self.__send_and_receive_json(url, "POST", json=json)
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
+
+    def search_batch(self, queries: list) -> Tuple[int, str, dict]:
+        # queries中每一项为search_global的请求体，带store_id时为店铺内搜索；筛选条件直接写在各项中
+        json = {"queries": queries}
+        url = urljoin(self.url_prefix, "search_batch")
+        headers = {"token": self.token}
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
+
+    def facets(self, store_id: str = None) -> Tuple[int, str, dict]:
+        json = {"store_id": store_id}
+        url = urljoin(self.url_prefix, "facets")
+        headers = {"token": self.token}
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
+
+    def suggest(self, prefix: str, limit: int = 10) -> Tuple[int, str, dict]:
+        json = {"prefix": prefix, "limit": limit}
+        url = urljoin(self.url_prefix, "suggest")
+        headers = {"token": self.token}
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
+
+    def similar(self, book_id: str, limit: int = 10) -> Tuple[int, str, dict]:
+        json = {"book_id": book_id, "limit": limit}
+        url = urljoin(self.url_prefix, "similar")
+        headers = {"token": self.token}
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
 
     def query_order(self, order_id: str) -> Tuple[int, str, dict]:
         json = {
@@ -107,7 +168,7 @@ class Buyer:
         }
         url = urljoin(self.url_prefix, "query_order")
         headers = {"token": self.token}
-        return self.__send_and_receive_json(url, "POST", json=json)
+        return self.__send_and_receive_json(url, "POST", json=json, headers=headers)
 
     def cancel_order(self, order_id: str, password: str) -> int:
         json = {
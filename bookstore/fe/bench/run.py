@@ -1,5 +1,7 @@
 from fe.bench.workload import Workload
 from fe.bench.session import Session
+import logging
+import time
 
 
 def run_bench():
@@ -11,11 +13,26 @@ def run_bench():
         ss = Session(wl)
         sessions.append(ss)
 
+    start = time.time()
     for ss in sessions:
         ss.start()
 
     for ss in sessions:
         ss.join()
+    elapsed = time.time() - start
+
+    # 整体吞吐量：所有会话完成的下单和付款请求数除以墙钟时间；GOODPUT只计成功的请求
+    n = sum(ss.new_order_i + ss.payment_i for ss in sessions)
+    ok = sum(ss.new_order_ok + ss.payment_ok for ss in sessions)
+    logging.info(
+        "THROUGHPUT SESSIONS:{} REQUESTS:{} SECONDS:{:.2f} RPS:{:.1f} GOODPUT:{:.1f}".format(
+            len(sessions), n, elapsed, n / elapsed if elapsed else 0.0, ok / elapsed if elapsed else 0.0
+        )
+    )
+
+    wl.report_new_order_latency()
+    wl.report_latency_percentiles()
+    wl.report_server_metrics()
 
 
 # if __name__ == "__main__":
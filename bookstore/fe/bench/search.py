@@ -0,0 +1,224 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+import requests
+from urllib.parse import urljoin
+from fe.access import book
+from fe.access.new_seller import register_new_seller
+from fe.access.new_buyer import register_new_buyer
+from fe import conf
+
+# 对比$text与n-gram两种检索后端的延迟和召回率
+SEARCH_BENCH_BOOKS = 200
+SEARCH_BENCH_QUERIES = 50
+# 合并模式对比时同一批书另外上架的商店数
+SEARCH_BENCH_EXTRA_STORES = 3
+# 对比结果视图时每页的条数
+SEARCH_BENCH_VIEW_LIMIT = 50
+# 突发请求：每个关键词同时发出的相同搜索数；每页条数与其他对比不同，保证第一次执行时缓存未命中
+SEARCH_BENCH_BURST = 20
+SEARCH_BENCH_BURST_LIMIT = 13
+ENGINES = ["text", "ngram"]
+
+CJK_RUN = re.compile("[一-鿿]{2,}")
+WORD = re.compile("[A-Za-z]{3,}")
+
+
+def indexed_text(bk: book.Book) -> str:
+    # 与后端索引的字段一致
+    return " ".join([
+        bk.title or "", " ".join(bk.tags), bk.book_intro or "", bk.content or "", bk.author or "", bk.publisher or "",
+    ]).lower()
+
+
+def pick_keyword(bk: book.Book) -> str:
+    # 优先取标题中间的两个汉字（$text无法切分中文时会漏掉），没有中文时取一个英文单词
+    runs = CJK_RUN.findall(bk.title or "")
+    if runs:
+        run = random.choice(runs)
+        i = random.randint(0, len(run) - 2)
+        return run[i:i + 2]
+    words = WORD.findall(bk.title or "")
+    if words:
+        return random.choice(words).lower()
+    return None
+
+
+def singleflight_stats() -> dict:
+    return requests.get(urljoin(conf.URL, "metrics")).json().get("search_singleflight", {})
+
+
+def measure(items, call) -> (float, list):
+    # 依次对每一项调用call，返回平均延迟（秒）和各次的返回值
+    elapsed = 0.0
+    results = []
+    for item in items:
+        start = time.time()
+        results.append(call(item))
+        elapsed = elapsed + time.time() - start
+    return elapsed / max(len(items), 1), results
+
+
+def checked(response) -> dict:
+    # 搜索接口返回(code, message, data)，只取成功响应的data
+    code, _, data = response
+    assert code == 200
+    return data
+
+
+def response_bytes(results: [dict]) -> float:
+    return sum(len(json.dumps(data, ensure_ascii=False).encode("utf-8")) for data in results) / max(len(results), 1)
+
+
+def prepare(seller, store_id: str) -> ([book.Book], list):
+    # 在新商店中上架SEARCH_BENCH_BOOKS本书，抽取关键词和应召回的书目集合
+    book_db = book.BookDB(conf.Use_Large_DB)
+    books = book_db.get_book_info(0, SEARCH_BENCH_BOOKS)
+    for bk in books:
+        assert seller.add_book(store_id, 10, bk) == 200
+
+    queries = []
+    for bk in random.sample(books, min(SEARCH_BENCH_QUERIES, len(books))):
+        keyword = pick_keyword(bk)
+        if keyword:
+            # 以“索引字段中包含该关键词”的书作为应召回的集合
+            expected = {b.id for b in books if keyword in indexed_text(b)}
+            queries.append((keyword, expected))
+    return books, queries
+
+
+def run_engines(buyer, store_id: str, books: [book.Book], queries: list):
+    # $text与n-gram两种后端的延迟和召回率
+    for engine in ENGINES:
+        latency, results = measure(
+            queries,
+            lambda query: checked(buyer.search_in_store(query[0], store_id, 1, len(books), engine=engine)),
+        )
+        recall = sum(
+            len({bk["id"] for bk in data["books"]} & expected) / len(expected)
+            for (_, expected), data in zip(queries, results)
+        )
+        logging.info(
+            "SEARCH ENGINE:{} QUERIES:{} LATENCY:{} RECALL:{}".format(
+                engine, len(queries), latency, recall / max(len(queries), 1)
+            )
+        )
+
+
+def run_facets(buyer, store_id: str, queries: list):
+    # 带分面的搜索与普通搜索的延迟对比，目标为不超过2倍
+    for facets in (False, True):
+        latency, _ = measure(
+            queries, lambda query: checked(buyer.search_in_store(query[0], store_id, 1, 10, facets=facets))
+        )
+        logging.info("SEARCH FACETS:{} QUERIES:{} LATENCY:{}".format(facets, len(queries), latency))
+
+
+def run_views(buyer, store_id: str, queries: list):
+    # 完整视图与精简视图的响应大小和延迟对比
+    for view in ("full", "compact"):
+        latency, results = measure(
+            queries,
+            lambda query: checked(buyer.search_in_store(query[0], store_id, 1, SEARCH_BENCH_VIEW_LIMIT, view=view)),
+        )
+        logging.info(
+            "SEARCH VIEW:{} QUERIES:{} LATENCY:{} BYTES:{}".format(
+                view, len(queries), latency, response_bytes(results)
+            )
+        )
+
+
+def run_burst(buyer, queries: list):
+    # 每个关键词同时发出SEARCH_BENCH_BURST个相同的全站搜索，统计实际执行次数与共享结果的请求数
+    def burst(query):
+        codes = []
+        threads = [
+            threading.Thread(
+                target=lambda: codes.append(buyer.search_global(query[0], 1, SEARCH_BENCH_BURST_LIMIT)[0])
+            )
+            for _ in range(SEARCH_BENCH_BURST)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert codes == [200] * SEARCH_BENCH_BURST
+
+    before = singleflight_stats()
+    latency, _ = measure(queries, burst)
+    after = singleflight_stats()
+    executions = after.get("executions", 0) - before.get("executions", 0)
+    shared = after.get("shared", 0) - before.get("shared", 0)
+    logging.info(
+        "SEARCH BURST:{} QUERIES:{} LATENCY:{} EXECUTIONS:{} SHARED:{}".format(
+            SEARCH_BENCH_BURST, len(queries), latency, executions, shared
+        )
+    )
+
+
+def run_shelves(buyer, store_id: str, queries: list):
+    # 一个页面的多个货架：逐个请求与一次批量请求的延迟对比
+    shelves = [
+        [
+            {"keyword": keyword, "limit": 10},
+            {"keyword": keyword, "store_id": store_id, "limit": 10},
+            {"keyword": keyword, "store_id": store_id, "limit": 10, "view": "compact", "page": 2},
+        ]
+        for keyword, _ in queries
+    ]
+
+    def serial(shelf):
+        for query in shelf:
+            if "store_id" in query:
+                checked(buyer.search_in_store(
+                    query["keyword"], query["store_id"], query.get("page", 1), query["limit"], view=query.get("view")
+                ))
+            else:
+                checked(buyer.search_global(query["keyword"], 1, query["limit"]))
+
+    def batch(shelf):
+        # 每页条数加1，避免命中逐个请求刚写入的结果缓存
+        checked(buyer.search_batch([dict(query, limit=query["limit"] + 1) for query in shelf]))
+
+    for mode, call in (("serial", serial), ("batch", batch)):
+        latency, _ = measure(shelves, call)
+        logging.info("SEARCH SHELVES:{} PAGES:{} LATENCY:{}".format(mode, len(shelves), latency))
+
+
+def run_grouped(seller, buyer, store_id: str, books: [book.Book], queries: list):
+    # 同一批书在多个商店上架，对比全站搜索按上架记录返回与按书目合并返回的响应大小和延迟
+    for i in range(SEARCH_BENCH_EXTRA_STORES):
+        extra_store_id = "{}_{}".format(store_id, i)
+        assert seller.create_store(extra_store_id) == 200
+        for bk in books:
+            assert seller.add_book(extra_store_id, 10, bk) == 200
+    for grouped in (False, True):
+        latency, results = measure(
+            queries, lambda query: checked(buyer.search_global(query[0], 1, 20, grouped=grouped))
+        )
+        logging.info(
+            "SEARCH GROUPED:{} QUERIES:{} LATENCY:{} BYTES:{}".format(
+                grouped, len(queries), latency, response_bytes(results)
+            )
+        )
+
+
+def run_search_bench():
+    suffix = str(uuid.uuid1())
+    seller = register_new_seller("search_bench_seller_" + suffix, "password_" + suffix)
+    buyer = register_new_buyer("search_bench_buyer_" + suffix, "password_" + suffix)
+    store_id = "search_bench_store_" + suffix
+    assert seller.create_store(store_id) == 200
+
+    books, queries = prepare(seller, store_id)
+    run_engines(buyer, store_id, books, queries)
+    run_facets(buyer, store_id, queries)
+    run_views(buyer, store_id, queries)
+    run_burst(buyer, queries)
+    run_shelves(buyer, store_id, queries)
+    # 最后再在其他商店上架同一批书，不影响前面的单店对比
+    run_grouped(seller, buyer, store_id, books, queries)
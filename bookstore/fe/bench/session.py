@@ -34,6 +34,9 @@ class Session(threading.Thread):
             ok, order_id = new_order.run()
             after = time.time()
             self.time_new_order = self.time_new_order + after - before
+            self.workload.record_new_order_latency(
+                len(new_order.book_id_and_count), after - before
+            )
             self.new_order_i = self.new_order_i + 1
             if ok:
                 self.new_order_ok = self.new_order_ok + 1
@@ -55,6 +58,7 @@ class Session(threading.Thread):
                     ok = payment.run()
                     after = time.time()
                     self.time_payment = self.time_payment + after - before
+                    self.workload.record_payment_latency(after - before)
                     self.payment_i = self.payment_i + 1
                     if ok:
                         self.payment_ok = self.payment_ok + 1
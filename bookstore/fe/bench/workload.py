@@ -2,6 +2,8 @@ import logging
 import uuid
 import random
 import threading
+import requests
+from urllib.parse import urljoin
 from fe.access import book
 from fe.access.new_seller import register_new_seller
 from fe.access.new_buyer import register_new_buyer
@@ -35,6 +37,8 @@ class Workload:
         self.uuid = str(uuid.uuid1())
         self.book_ids = {}
         self.buyer_ids = []
+        # 每个买家只登录一次，之后的请求复用同一个令牌
+        self.buyers = {}
         self.store_ids = []
         self.book_db = book.BookDB(conf.Use_Large_DB)
         self.row_count = self.book_db.get_book_count()
@@ -58,6 +62,10 @@ class Workload:
         self.time_new_order = 0
         self.time_payment = 0
         self.lock = threading.Lock()
+        # 按订单行数统计下单延迟：{行数: [次数, 总耗时]}
+        self.new_order_latency_by_size = {}
+        # 每次下单、付款请求的耗时，用于输出延迟分位数
+        self.latencies = {"new_order": [], "payment": []}
         # 存储上一次的值，用于两次做差
         self.n_new_order_past = 0
         self.n_payment_past = 0
@@ -105,6 +113,7 @@ class Workload:
             buyer = register_new_buyer(user_id, password)
             buyer.add_funds(self.user_funds)
             self.buyer_ids.append(user_id)
+            self.buyers[user_id] = buyer
         logging.info("buyer data loaded.")
 
     def get_new_order(self) -> NewOrder:
@@ -124,10 +133,63 @@ class Workload:
                 book_temp.append(book_id)
                 count = random.randint(1, 10)
                 book_id_and_count.append((book_id, count))
-        b = Buyer(url_prefix=conf.URL, user_id=buyer_id, password=buyer_password)
+        b = self.buyers.get(buyer_id)
+        if b is None:
+            b = Buyer(url_prefix=conf.URL, user_id=buyer_id, password=buyer_password)
+            self.buyers[buyer_id] = b
         new_ord = NewOrder(b, store_id, book_id_and_count)
         return new_ord
 
+    def record_new_order_latency(self, size: int, elapsed: float):
+        self.lock.acquire()
+        stat = self.new_order_latency_by_size.setdefault(size, [0, 0.0])
+        stat[0] = stat[0] + 1
+        stat[1] = stat[1] + elapsed
+        self.latencies["new_order"].append(elapsed)
+        self.lock.release()
+
+    def record_payment_latency(self, elapsed: float):
+        self.lock.acquire()
+        self.latencies["payment"].append(elapsed)
+        self.lock.release()
+
+    def report_latency_percentiles(self):
+        # 输出下单、付款延迟的P50和P99
+        self.lock.acquire()
+        for kind, values in self.latencies.items():
+            if not values:
+                continue
+            values = sorted(values)
+            logging.info(
+                "LATENCY {} COUNT:{} P50:{} P99:{}".format(
+                    kind.upper(), len(values), values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.99))]
+                )
+            )
+        self.lock.release()
+
+    def report_new_order_latency(self):
+        # 输出不同订单行数下的平均下单延迟，用于观察延迟是否随行数增长
+        self.lock.acquire()
+        for size in sorted(self.new_order_latency_by_size):
+            n, total = self.new_order_latency_by_size[size]
+            logging.info(
+                "NEW_ORDER LINES:{} COUNT:{} LATENCY:{}".format(size, n, total / n)
+            )
+        self.lock.release()
+
+    def report_server_metrics(self):
+        # 输出后端的事务提交、中止、重试次数
+        r = requests.get(urljoin(conf.URL, "metrics"))
+        txn_stat = r.json().get("transaction", {})
+        logging.info(
+            "TXN COMMIT:{} ABORT:{} RETRY:{} COMPENSATION:{}".format(
+                txn_stat.get("commit", 0),
+                txn_stat.get("abort", 0),
+                txn_stat.get("retry", 0),
+                txn_stat.get("compensation", 0),
+            )
+        )
+
     def update_stat(
         self,
         n_new_order,
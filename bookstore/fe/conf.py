@@ -1,9 +1,12 @@
-URL = "http://127.0.0.1:5000/"
+import os
+
+# 设置BOOKSTORE_URL并令BOOKSTORE_EXTERNAL_BACKEND=1时，测试连接已启动的后端（例如be.launcher），不再在进程内启动
+URL = os.environ.get("BOOKSTORE_URL", "http://127.0.0.1:5000/")
 Book_Num_Per_Store = 2000
 Store_Num_Per_User = 2
 Seller_Num = 2
 Buyer_Num = 10
-Session = 1
+Session = int(os.environ.get("BOOKSTORE_BENCH_SESSIONS", "1"))
 Request_Per_Session = 1000
 Default_Stock_Level = 1000000
 Default_User_Funds = 10000000
@@ -1,3 +1,4 @@
+import os
 import requests
 import threading
 from urllib.parse import urljoin
@@ -6,6 +7,8 @@ from be.model.store import init_completed_event
 from fe import conf
 
 thread: threading.Thread = None
+# 为1时不启动后端，连接conf.URL上已运行的服务
+EXTERNAL_BACKEND = os.environ.get("BOOKSTORE_EXTERNAL_BACKEND") == "1"
 
 
 # 修改这里启动后端程序，如果不需要可删除这行代码
@@ -17,12 +20,17 @@ def run_backend():
 def pytest_configure(config):
     global thread
     print("frontend begin test")
+    if EXTERNAL_BACKEND:
+        return
     thread = threading.Thread(target=run_backend)
     thread.start()
     init_completed_event.wait()
 
 
 def pytest_unconfigure(config):
+    if EXTERNAL_BACKEND:
+        print("frontend end test")
+        return
     url = urljoin(conf.URL, "shutdown")
     requests.get(url)
     thread.join()
@@ -0,0 +1,186 @@
+import copy
+import re
+import threading
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# 不需要MongoDB的单元测试使用的内存数据库：只实现后端模型层用到的查询和更新操作符，
+# 唯一索引按unique给出的字段组合检查（_id总是唯一）
+
+
+def match_value(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for op, operand in condition.items():
+            if op == "$in":
+                ok = value in operand
+            elif op == "$gte":
+                ok = value is not None and value >= operand
+            elif op == "$gt":
+                ok = value is not None and value > operand
+            elif op == "$lte":
+                ok = value is not None and value <= operand
+            elif op == "$lt":
+                ok = value is not None and value < operand
+            elif op == "$regex":
+                ok = isinstance(value, str) and re.search(operand, value) is not None
+            elif op == "$exists":
+                ok = (value is not None) == operand
+            else:
+                raise NotImplementedError(op)
+            if not ok:
+                return False
+        return True
+    return value == condition
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif not match_value(doc.get(key), condition):
+            return False
+    return True
+
+
+def project(doc: dict, projection: dict) -> dict:
+    if not projection:
+        return copy.deepcopy(doc)
+    included = [key for key, flag in projection.items() if flag and key != "_id"]
+    if not included:
+        # 排除式投影，如{"_id": 0}
+        return {key: copy.deepcopy(value) for key, value in doc.items() if projection.get(key, 1)}
+    result = {key: copy.deepcopy(doc[key]) for key in included if key in doc}
+    if projection.get("_id", 1) and "_id" in doc:
+        result["_id"] = doc["_id"]
+    return result
+
+
+def apply_update(doc: dict, update: dict):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            if op == "$set":
+                doc[key] = value
+            elif op == "$inc":
+                doc[key] = doc.get(key, 0) + value
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op != "$setOnInsert":
+                raise NotImplementedError(op)
+
+
+class UpdateResult:
+    def __init__(self, matched_count: int):
+        self.matched_count = matched_count
+        self.modified_count = matched_count
+
+
+class Collection:
+    def __init__(self, unique: [tuple] = ()):
+        self.docs = []
+        self.unique = [("_id",)] + list(unique)
+        self.lock = threading.RLock()
+        self.seq = 0
+
+    def check_unique(self, doc: dict, ignore: dict = None):
+        for fields in self.unique:
+            if not all(field in doc for field in fields):
+                continue
+            for other in self.docs:
+                if other is not ignore and all(other.get(field) == doc[field] for field in fields):
+                    raise DuplicateKeyError("E11000 duplicate key {}".format(fields), 11000)
+
+    def insert_one(self, doc: dict, session=None):
+        with self.lock:
+            doc = copy.deepcopy(doc)
+            if "_id" not in doc:
+                self.seq = self.seq + 1
+                doc["_id"] = self.seq
+            self.check_unique(doc)
+            self.docs.append(doc)
+
+    def find(self, query: dict = None, projection: dict = None, session=None, **options):
+        with self.lock:
+            return [project(doc, projection) for doc in self.docs if matches(doc, query or {})]
+
+    def find_one(self, query: dict = None, projection: dict = None, session=None):
+        found = self.find(query, projection)
+        return found[0] if found else None
+
+    def count_documents(self, query: dict, session=None, **options) -> int:
+        return len(self.find(query))
+
+    def upsert(self, query: dict, update: dict):
+        # upsert插入的文档由查询条件中的等值字段和更新组成
+        doc = {key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+        apply_update(doc, update)
+        apply_update(doc, {"$set": update.get("$setOnInsert", {})})
+        self.insert_one(doc)
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False, session=None) -> UpdateResult:
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    updated = copy.deepcopy(doc)
+                    apply_update(updated, update)
+                    self.check_unique(updated, ignore=doc)
+                    doc.clear()
+                    doc.update(updated)
+                    return UpdateResult(1)
+            if upsert:
+                self.upsert(query, update)
+            return UpdateResult(0)
+
+    def find_one_and_update(self, query: dict, update: dict, projection: dict = None, upsert: bool = False,
+                            session=None):
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    before = project(doc, projection)
+                    self.update_one({"_id": doc["_id"]}, update)
+                    return before
+            if upsert:
+                self.upsert(query, update)
+            return None
+
+    def delete_one(self, query: dict, session=None):
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    self.docs.remove(doc)
+                    return
+
+    def bulk_write(self, requests: list, ordered: bool = True, session=None):
+        with self.lock:
+            matched = 0
+            for index, request in enumerate(requests):
+                try:
+                    matched = matched + self.update_one(
+                        request._filter, request._doc, upsert=bool(request._upsert)
+                    ).matched_count
+                except DuplicateKeyError as e:
+                    error = {"index": index, "code": 11000, "errmsg": str(e)}
+                    if ordered:
+                        raise BulkWriteError({"writeErrors": [error], "nMatched": matched})
+
+
+class Database:
+    """按属性访问的集合；client只是占位，补偿模式下不会被使用"""
+
+    def __init__(self, unique: dict = None):
+        self.client = None
+        self.unique = unique or {}
+        self.collections = {}
+
+    def __getattr__(self, name: str) -> Collection:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> Collection:
+        if name not in self.collections:
+            self.collections[name] = Collection(self.unique.get(name, ()))
+        return self.collections[name]
+
+
+def bookstore_db() -> Database:
+    return Database({"inventory": [("store_id", "book_id")], "order": [("order_id",)]})
@@ -1,5 +1,11 @@
+import base64
+import copy
+import hashlib
 import pytest
+from pymongo import MongoClient
 
+from be.model import picture
+from be.model import store
 from fe import conf
 from fe.access.new_seller import register_new_seller
 from fe.access import book
@@ -28,6 +34,29 @@ class TestAddBook:
             code = self.seller.add_book(self.store_id, 0, b)
             assert code == 200
 
+    def test_same_picture_stored_once(self):
+        # 相同内容的图片按sha256寻址：通过接口上架两本带相同图片的书，只保存一个GridFS文件；
+        # 后端可能在其他进程中（BOOKSTORE_EXTERNAL_BACKEND=1），按BOOKSTORE_MONGO_URI直接连接数据库检查
+        data = "picture-{}".format(uuid.uuid1()).encode()
+        encoded = base64.b64encode(data).decode("utf-8")
+        book_ids = []
+        for _ in range(2):
+            b = copy.copy(self.books[0])
+            b.id = "test_add_books_picture_{}".format(str(uuid.uuid1()))
+            b.pictures = [encoded, encoded]
+            assert self.seller.add_book(self.store_id, 0, b) == 200
+            book_ids.append(b.id)
+
+        picture_id = hashlib.sha256(data).hexdigest()
+        client = MongoClient(store.MONGO_URI)
+        try:
+            db = client["bookstore"]
+            docs = list(db.catalog.find({"_id": {"$in": book_ids}}, {"picture_ids": 1}))
+            assert [doc["picture_ids"] for doc in docs] == [[picture_id, picture_id]] * 2
+            assert db[picture.PICTURE_BUCKET + ".files"].count_documents({"_id": picture_id}) == 1
+        finally:
+            client.close()
+
     def test_error_non_exist_store_id(self):
         for b in self.books:
             # non exist store id
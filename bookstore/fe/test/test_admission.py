@@ -0,0 +1,74 @@
+import time
+import threading
+
+from be.model import admission
+
+
+class TestAdmission:
+    def controller(self, queue: int = 4) -> admission.Controller:
+        return admission.Controller(
+            limit=1, search_limit=1, endpoint_limits={}, queue=queue,
+            max_wait={admission.ORDER: 2, admission.DEFAULT: 0.2, admission.SEARCH: 0.2},
+        )
+
+    def test_rejects_after_deadline(self):
+        c = self.controller()
+        ticket = c.admit("buyer.search_global")
+        start = time.time()
+        try:
+            c.admit("buyer.search_in_store")
+            assert False, "应被拒绝"
+        except admission.Overloaded as e:
+            assert e.retry_after >= 1
+        # 等待不超过该类别的最长等待时间
+        assert time.time() - start < 1
+        c.release(ticket)
+        assert c.snapshot()["in_flight"] == 0
+
+    def test_order_before_search(self):
+        c = self.controller()
+        ticket = c.admit("buyer.search_global")
+        order = []
+
+        def run(endpoint):
+            try:
+                t = c.admit(endpoint)
+            except admission.Overloaded:
+                order.append("rejected " + endpoint)
+                return
+            order.append(endpoint)
+            c.release(t)
+
+        search = threading.Thread(target=run, args=("buyer.search_in_store",))
+        search.start()
+        time.sleep(0.05)
+        payment = threading.Thread(target=run, args=("buyer.payment",))
+        payment.start()
+        time.sleep(0.05)
+        c.release(ticket)
+        search.join()
+        payment.join()
+        # 后到的付款先于先到的搜索被放行
+        assert order[0] == "buyer.payment"
+
+    def test_queue_full_evicts_lower_priority(self):
+        c = self.controller(queue=1)
+        ticket = c.admit("buyer.new_order")
+        results = []
+
+        def run(endpoint):
+            try:
+                c.release(c.admit(endpoint))
+                results.append(endpoint)
+            except admission.Overloaded:
+                results.append("rejected " + endpoint)
+
+        search = threading.Thread(target=run, args=("buyer.search_global",))
+        search.start()
+        time.sleep(0.05)
+        payment = threading.Thread(target=run, args=("buyer.payment",))
+        payment.start()
+        search.join()
+        c.release(ticket)
+        payment.join()
+        assert results == ["rejected buyer.search_global", "buyer.payment"]
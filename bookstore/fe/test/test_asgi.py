@@ -0,0 +1,82 @@
+import json
+import uuid
+import asyncio
+import pytest
+
+from be import asgi
+from be.model.aio import store
+from fe.test.gen_book_data import GenBook
+
+
+async def call(path: str, body: dict, token: str = None) -> (int, dict):
+    # 在进程内直接调用ASGI应用
+    headers = [(b"content-type", b"application/json")]
+    if token is not None:
+        headers.append((b"token", token.encode()))
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers, "query_string": b""}
+    messages = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+class TestAsgi:
+    @pytest.fixture(autouse=True)
+    def pre_run_initialization(self):
+        self.seller_id = "test_asgi_seller_id_{}".format(str(uuid.uuid1()))
+        self.store_id = "test_asgi_store_id_{}".format(str(uuid.uuid1()))
+        self.buyer_id = "test_asgi_buyer_id_{}".format(str(uuid.uuid1()))
+        self.password = self.buyer_id
+        gen_book = GenBook(self.seller_id, self.store_id)
+        ok, self.buy_book_id_list = gen_book.gen(
+            non_exist_book_id=False, low_stock_level=False, max_book_count=5
+        )
+        assert ok
+        self.keyword = gen_book.buy_book_info_list[0][0].title
+        yield
+
+    def test_order_and_payment(self):
+        async def run():
+            # AsyncMongoClient绑定到创建它的事件循环，每次asyncio.run重新建立
+            store.init_database()
+            try:
+                body = {"user_id": self.buyer_id, "password": self.password}
+                assert (await call("/auth/register", body))[0] == 200
+                code, data = await call("/auth/login", dict(body, terminal="asgi"))
+                assert code == 200
+                token = data["token"]
+
+                books = [{"id": book_id, "count": count} for book_id, count in self.buy_book_id_list]
+                code, data = await call(
+                    "/buyer/new_order", {"user_id": self.buyer_id, "store_id": self.store_id, "books": books}, token
+                )
+                assert code == 200
+                order_id = data["order_id"]
+                # 没有令牌时被拒绝
+                code, _ = await call("/buyer/payment", dict(body, order_id=order_id))
+                assert code == 401
+
+                code, _ = await call("/buyer/add_funds", dict(body, add_value=100000000), token)
+                assert code == 200
+                code, _ = await call("/buyer/payment", dict(body, order_id=order_id), token)
+                assert code == 200
+                code, _ = await call("/buyer/payment", dict(body, order_id=order_id), token)
+                assert code != 200
+                code, data = await call("/buyer/query_order", {"user_id": self.buyer_id, "order_id": order_id}, token)
+                assert code == 200
+                assert data["data"]["status"] == "paid"
+
+                # 未改写的接口由Flask应用处理
+                code, data = await call("/buyer/search_in_store", {"keyword": self.keyword, "store_id": self.store_id})
+                assert code == 200
+            finally:
+                await store.close_database()
+
+        asyncio.run(run())
@@ -1,4 +1,5 @@
 from fe.bench.run import run_bench
+from fe.bench.search import run_search_bench
 
 
 def test_bench():
@@ -6,3 +7,10 @@ def test_bench():
         run_bench()
     except Exception as e:
         assert 200 == 100, "test_bench过程出现异常"
+
+
+def test_search_bench():
+    try:
+        run_search_bench()
+    except Exception as e:
+        assert 200 == 100, "test_search_bench过程出现异常: {}".format(e)
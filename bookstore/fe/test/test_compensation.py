@@ -0,0 +1,58 @@
+import pytest
+
+from be.model import store
+from be.model import buyer
+from fe.test import memory_db
+
+
+class TestCompensation:
+    @pytest.fixture(autouse=True)
+    def pre_run_initialization(self, monkeypatch):
+        # 补偿模式（单机mongod不支持事务）下的下单，使用内存数据库
+        self.db = memory_db.bookstore_db()
+        monkeypatch.setattr(store, "get_db", lambda: self.db)
+        monkeypatch.setattr(store, "use_transaction", lambda: False)
+        self.db.user.insert_one({"user_id": "u"})
+        self.db.store.insert_one({"store_id": "s", "user_id": "seller"})
+        for book_id, stock_level in (("a", 5), ("b", 5), ("c", 1)):
+            self.db.inventory.insert_one({"store_id": "s", "book_id": book_id, "price": 10, "stock_level": stock_level})
+        self.buyer = buyer.Buyer()
+        yield
+
+    def stock(self) -> dict:
+        return {item["book_id"]: item["stock_level"] for item in self.db.inventory.find({"store_id": "s"})}
+
+    def test_ok(self):
+        code, _, order_id = self.buyer.new_order("u", "s", [("a", 2), ("b", 1)])
+        assert code == 200
+        assert self.stock() == {"a": 3, "b": 4, "c": 1}
+        assert self.db.order.find_one({"order_id": order_id}) is not None
+
+    def test_short_line_restores_applied_lines(self, monkeypatch):
+        # 读取库存之后、扣减之前其他买家买走了c：a、b已扣减，c不足，a、b的扣减被补偿
+        find = self.db.inventory.find
+
+        def stale_find(query=None, projection=None, session=None, **options):
+            rows = find(query, projection)
+            for row in rows:
+                if row["book_id"] == "c":
+                    row["stock_level"] = 5
+            return rows
+
+        monkeypatch.setattr(self.db.inventory, "find", stale_find)
+        code, message, _ = self.buyer.new_order("u", "s", [("a", 2), ("b", 1), ("c", 3)])
+        monkeypatch.setattr(self.db.inventory, "find", find)
+        assert code == 517
+        assert message.endswith(" c")
+        assert self.stock() == {"a": 5, "b": 5, "c": 1}
+        assert self.db.order.count_documents({}) == 0
+
+    def test_failed_order_insert_restores_stock(self, monkeypatch):
+        # 库存全部扣减后写订单失败，按相反顺序加回全部库存
+        def fail(doc, session=None):
+            raise RuntimeError("insert failed")
+
+        monkeypatch.setattr(self.db.order, "insert_one", fail)
+        code, _, _ = self.buyer.new_order("u", "s", [("a", 2), ("b", 1)])
+        assert code == 528
+        assert self.stock() == {"a": 5, "b": 5, "c": 1}
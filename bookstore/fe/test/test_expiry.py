@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+
+from be.model import store
+from be.model import expiry
+from fe.test import memory_db
+
+
+class TestExpiry:
+    @pytest.fixture(autouse=True)
+    def pre_run_initialization(self, monkeypatch):
+        # 调度器和租约都使用内存数据库，不启动后台线程
+        self.db = memory_db.bookstore_db()
+        monkeypatch.setattr(store, "get_db", lambda: self.db)
+        monkeypatch.setattr(store, "use_transaction", lambda: False)
+        self.db.inventory.insert_one({"store_id": "s", "book_id": "a", "price": 10, "stock_level": 3})
+        self.now = datetime.now(timezone.utc)
+        self.scheduler = expiry.ExpiryScheduler()
+        self.scheduler.lease.heartbeat()
+        assert self.scheduler.lease.owned_partitions() == set(range(expiry.PARTITIONS))
+        yield
+
+    def add_order(self, order_id: str, deadline: datetime):
+        self.db.order.insert_one({
+            "order_id": order_id, "store_id": "s", "status": "pending", "payment_deadline": deadline,
+            "books": [{"book_id": "a", "count": 2, "price": 10, "total_price": 20}],
+        })
+
+    def run_once(self, now: datetime) -> list:
+        self.scheduler.load(now)
+        return self.scheduler.cancel_batch(self.scheduler.pop_due(now), now)
+
+    def test_expired_order_canceled_once(self):
+        self.add_order("expired", self.now - timedelta(seconds=1))
+        self.add_order("later", self.now + timedelta(minutes=30))
+        # 下单时入堆，装载时再次出现也只入堆一次
+        self.scheduler.schedule("expired", self.now - timedelta(seconds=1))
+
+        canceled = self.run_once(self.now)
+        assert [order["order_id"] for order in canceled] == ["expired"]
+        assert self.db.order.find_one({"order_id": "expired"})["status"] == "canceled"
+        assert self.db.order.find_one({"order_id": "later"})["status"] == "pending"
+        assert self.db.inventory.find_one({"book_id": "a"})["stock_level"] == 5
+
+        # 重新入堆（如其他进程装载后交接）也不会再次取消、重复恢复库存
+        self.scheduler.schedule("expired", self.now - timedelta(seconds=1))
+        assert self.run_once(self.now) == []
+        assert self.db.inventory.find_one({"book_id": "a"})["stock_level"] == 5
+
+    def test_paid_order_discarded(self):
+        self.add_order("paid", self.now - timedelta(seconds=1))
+        self.scheduler.schedule("paid", self.now - timedelta(seconds=1))
+        self.scheduler.discard("paid")
+        self.db.order.update_one({"order_id": "paid"}, {"$set": {"status": "paid"}})
+        assert self.scheduler.pop_due(self.now) == []
+        assert self.db.order.find_one({"order_id": "paid"})["status"] == "paid"
+
+    def test_wait_until_earliest_deadline(self):
+        self.scheduler.load(self.now)
+        self.scheduler.schedule("soon", self.now + timedelta(seconds=5))
+        assert 4 < self.scheduler.wait_seconds(self.now) <= 5
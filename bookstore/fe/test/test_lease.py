@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+
+from be.model import store
+from be.model import lease
+from fe.test import memory_db
+
+
+class TestLease:
+    @pytest.fixture(autouse=True)
+    def pre_run_initialization(self, monkeypatch):
+        self.db = memory_db.bookstore_db()
+        monkeypatch.setattr(store, "get_db", lambda: self.db)
+        self.first = lease.LeaseManager("test", 2)
+        self.second = lease.LeaseManager("test", 2)
+        yield
+
+    def expire(self, manager: lease.LeaseManager):
+        # 模拟持有者崩溃：它的租约和心跳都已过期
+        past = datetime.now(timezone.utc) - timedelta(seconds=1)
+        for doc in self.db.lease.find({"owner": manager.owner}):
+            self.db.lease.update_one({"_id": doc["_id"]}, {"$set": {"expires_at": past}})
+
+    def test_acquire_and_renew(self):
+        self.first.heartbeat()
+        assert self.first.owned_partitions() == {0, 1}
+        before = self.db.lease.find_one({"_id": "test:0"})["expires_at"]
+        self.first.heartbeat()
+        assert self.first.owned_partitions() == {0, 1}
+        assert self.db.lease.find_one({"_id": "test:0"})["expires_at"] >= before
+        assert self.first.snapshot()["lost"] == 0
+
+    def test_live_owner_keeps_partitions(self):
+        self.first.heartbeat()
+        self.second.heartbeat()
+        # 第一个进程未过期，第二个进程抢不到；第一个进程下次心跳时释放多余的分区
+        assert self.second.owned_partitions() == set()
+        self.first.heartbeat()
+        self.second.heartbeat()
+        assert len(self.first.owned_partitions()) == 1
+        assert len(self.second.owned_partitions()) == 1
+        assert not self.first.owned_partitions() & self.second.owned_partitions()
+
+    def test_takeover_after_expiry(self):
+        self.first.heartbeat()
+        self.expire(self.first)
+        self.second.heartbeat()
+        assert self.second.owned_partitions() == {0, 1}
+        assert {doc["owner"] for doc in self.db.lease.find({"_id": {"$in": ["test:0", "test:1"]}})} == {
+            self.second.owner
+        }
+
+        # 原持有者恢复后续约失败，不会与接管者同时持有同一分区
+        self.first.heartbeat()
+        assert self.first.owned_partitions() == set()
+        assert self.first.snapshot()["lost"] == 2
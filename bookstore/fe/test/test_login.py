@@ -3,6 +3,7 @@ import time
 import pytest
 
 from fe.access import auth
+from fe.access.new_buyer import register_new_buyer
 from fe import conf
 
 
@@ -30,6 +31,32 @@ class TestLogin:
         code = self.auth.logout(self.user_id, token)
         assert code == 200
 
+    def test_multiple_terminals(self):
+        # 不同终端的会话互不影响，登出一个终端后另一个终端的令牌仍然有效
+        code, token_1 = self.auth.login(self.user_id, self.password, self.terminal + "_1")
+        assert code == 200
+        code, token_2 = self.auth.login(self.user_id, self.password, self.terminal + "_2")
+        assert code == 200
+
+        assert self.auth.logout(self.user_id, token_1) == 200
+        assert self.auth.logout(self.user_id, token_1) == 401
+        assert self.auth.logout(self.user_id, token_2) == 200
+
+    def test_token_checked(self):
+        # 需要登录的接口校验令牌；登出后旧令牌立即失效
+        buyer_id = self.user_id + "_buyer"
+        buyer = register_new_buyer(buyer_id, self.password)
+        assert buyer.add_funds(10) == 200
+        token = buyer.token
+
+        buyer.token = token + "_x"
+        assert buyer.add_funds(10) == 401
+        buyer.token = token
+        assert buyer.add_funds(10) == 200
+
+        assert self.auth.logout(buyer_id, token) == 200
+        assert buyer.add_funds(10) == 401
+
     def test_error_user_id(self):
         code, token = self.auth.login(self.user_id + "_x", self.password, self.terminal)
         assert code == 401
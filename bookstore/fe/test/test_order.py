@@ -49,6 +49,17 @@ class TestOrder:
         assert "books" in data
         assert "total_price" in data
 
+    def test_query_order_books(self):
+        # 测试订单书籍明细与总价一致
+        code, message, data = self.buyer.query_order(self.order_id)
+        assert code == 200
+        assert len(data["books"]) > 0
+        for book_item in data["books"]:
+            assert "book_id" in book_item
+            assert "count" in book_item
+            assert "price" in book_item
+        assert sum(book_item["price"] for book_item in data["books"]) == data["total_price"]
+
     def test_query_order_error_non_exist_order_id(self):
         # 测试查询不存在的订单
         code, message, data = self.buyer.query_order(self.order_id + "_x")
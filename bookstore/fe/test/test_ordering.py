@@ -0,0 +1,65 @@
+from datetime import datetime, timezone
+import pytest
+from pymongo.errors import BulkWriteError
+
+from be.model import ordering
+from be.model import txn
+
+
+class TestOrdering:
+    @pytest.fixture(autouse=True)
+    def pre_run_initialization(self):
+        # 同步和asyncio两条路径共用的纯逻辑，不需要数据库
+        self.book_counts = ordering.merge_counts([("a", 1), ("b", 2), ("a", 2)])
+        self.book_details = {
+            "a": {"book_id": "a", "price": 10, "stock_level": 5},
+            "b": {"book_id": "b", "price": 7, "stock_level": 2},
+        }
+        yield
+
+    def test_merge_counts_keeps_order(self):
+        assert list(self.book_counts.items()) == [("a", 3), ("b", 2)]
+
+    def test_order_document(self):
+        order_books = ordering.order_lines(self.book_counts, self.book_details)
+        now = datetime.now(timezone.utc)
+        doc = ordering.order_document("o", "u", "s", order_books, now)
+        assert doc["total_price"] == 44
+        assert doc["payment_deadline"] == now + ordering.PAYMENT_WINDOW
+        assert ordering.order_view(doc)["books"] == [
+            {"book_id": "a", "count": 3, "price": 30}, {"book_id": "b", "count": 2, "price": 14}
+        ]
+
+    def test_order_lines_errors(self):
+        with pytest.raises(txn.Abort) as e:
+            ordering.order_lines(dict(self.book_counts, c=1), self.book_details)
+        assert e.value.code == 515
+        with pytest.raises(txn.Abort) as e:
+            ordering.order_lines({"b": 3}, self.book_details)
+        assert e.value.code == 517
+
+    def test_settle_decrement_registers_applied_lines(self):
+        error = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}]})
+        undo = []
+        with pytest.raises(txn.Abort) as e:
+            ordering.settle_decrement(self.book_counts, ordering.short_line(error), undo, lambda *line: line)
+        assert e.value.message.endswith(" b")
+        assert undo == [("a", 3)]
+
+    def test_restock_requests_merge_lines(self):
+        orders = [
+            {"store_id": "s", "books": [{"book_id": "a", "count": 1}]},
+            {"store_id": "s", "books": [{"book_id": "a", "count": 2}, {"book_id": "b", "count": 1}]},
+        ]
+        requests = ordering.restock_requests(orders)
+        assert [(r._filter["book_id"], r._doc["$inc"]["stock_level"]) for r in requests] == [("a", 3), ("b", 1)]
+
+    def test_check_payment(self):
+        order = {"buyer_id": "u", "store_id": "s", "status": "pending", "total_price": 50}
+        buyer = {"password": "p", "balance": 40}
+        store_info = {"owner_id": "seller"}
+        assert ordering.check_payment("u", "p", "o", None, None, None)[0] == 518
+        assert ordering.check_payment("v", "p", "o", order, None, None)[0] == 401
+        assert ordering.check_payment("u", "x", "o", order, buyer, store_info)[0] == 401
+        assert ordering.check_payment("u", "p", "o", order, buyer, store_info)[0] == 519
+        assert ordering.check_payment("u", "p", "o", order, dict(buyer, balance=50), store_info) is None
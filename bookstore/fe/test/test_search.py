@@ -1,4 +1,6 @@
 import pytest
+import re
+import threading
 import uuid
 
 from fe import conf
@@ -88,6 +90,54 @@ class TestSearch:
             # 注意：后端返回的数据中没有belong_store_id字段，这里只验证关键词
             assert keyword.lower() in book_item["title"].lower()
 
+    def test_search_same_book_in_stores(self):
+        # 同一本书在两个商店上架，店铺内搜索只返回该商店的上架记录
+        code = self.seller.add_book(self.store_id_2, 10, self.books[0])
+        assert code == 200
+
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id_2, 1, 10)
+        assert code == 200
+        store_ids = [
+            book_item["belong_store_id"]
+            for book_item in data["books"]
+            if book_item["id"] == self.books[0].id
+        ]
+        assert store_ids == [self.store_id_2]
+
+    def test_search_cache_invalidation(self):
+        # 重复搜索命中缓存；商店上架新书后该商店的搜索结果应立即更新
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id_2, 1, 10)
+        assert code == 200
+        code, message, data_again = buyer.search_in_store(keyword, self.store_id_2, 1, 10)
+        assert code == 200
+        assert data_again == data
+
+        code = self.seller.add_book(self.store_id_2, 10, self.books[0])
+        assert code == 200
+        code, message, data_after = buyer.search_in_store(keyword, self.store_id_2, 1, 10)
+        assert code == 200
+        assert data_after["total"] == data["total"] + 1
+
+    def test_search_approx_total(self):
+        # 近似总数模式下结果页与精确模式一致，结果较少时总数仍为精确值
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10)
+        assert code == 200
+        code, message, data_approx = buyer.search_in_store(keyword, self.store_id, 1, 10, approx_total=True)
+        assert code == 200
+        assert data_approx["books"] == data["books"]
+        assert data_approx["total"] == data["total"]
+        assert data_approx["total_exact"]
+
+        # bool参数只接受true/false，字符串"false"不会被当作true
+        code, message, _ = buyer.search_in_store(keyword, self.store_id, 1, 10, approx_total="false")
+        assert code == 400
+
     def test_search_no_results(self):
         # 搜索无结果的情况
         buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
@@ -127,6 +177,216 @@ class TestSearch:
             # 注意：由于后端返回的书籍数据可能重复，这里我们只验证分页功能本身
             assert data_page_1["page"] != data_page_2["page"]
 
+    def test_search_cursor_pagination(self):
+        # 按游标逐页取完结果，顺序应与按页码分页一致
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10)
+        assert code == 200
+        expected = [bk["id"] for bk in data["books"]]
+
+        seen = []
+        cursor = None
+        while True:
+            code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 1, cursor=cursor)
+            assert code == 200
+            assert data["total"] == len(expected)
+            seen.extend(bk["id"] for bk in data["books"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == expected
+
+        # 游标不能用于其他查询
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 1)
+        if data["next_cursor"] is not None:
+            code, message, _ = buyer.search_in_store(keyword, self.store_id_2, 1, 1, cursor=data["next_cursor"])
+            assert code == 520
+        code, message, _ = buyer.search_global(keyword, 1, 1, cursor="not-a-cursor")
+        assert code == 520
+
+    def test_search_ngram_engine(self):
+        # n-gram后端能搜到标题中间的中文词
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        title = self.books[0].title
+        runs = re.findall("[\u4e00-\u9fff]{3,}", title)
+        keyword = runs[0][1:3] if runs else title.split()[0]
+
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, engine="ngram")
+        assert code == 200
+        assert self.books[0].id in [bk["id"] for bk in data["books"]]
+
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, engine="unknown")
+        assert code == 400
+
+    def test_search_ngram_explain_no_match(self):
+        # 没有匹配的书目时也返回执行计划
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = "nomatch{}".format(uuid.uuid1().hex)
+        code, message, data = buyer.search_global(keyword, 1, 10, engine="ngram", explain=True)
+        assert code == 200
+        assert data["books"] == []
+        assert data["plan"]["driver"] == "ngram"
+        assert data["plan"]["collscan"] is False
+
+    def test_search_fields(self):
+        # 限定在标题中匹配
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, fields=["title"])
+        assert code == 200
+        assert self.books[0].id in [bk["id"] for bk in data["books"]]
+
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, fields=["isbn"])
+        assert code == 400
+
+    def test_search_filters(self):
+        # 只按结构化条件筛选，执行计划不应出现全集合扫描
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        bk = self.books[0]
+        if bk.author:
+            code, message, data = buyer.search_in_store(
+                "", self.store_id, 1, 10, filters={"author": bk.author}, explain=True
+            )
+            assert code == 200
+            assert bk.id in [b["id"] for b in data["books"]]
+            assert all(b["author"] == bk.author for b in data["books"])
+            assert data["plan"]["collscan"] is False
+
+        code, message, data = buyer.search_in_store(
+            "", self.store_id, 1, 10, filters={"min_price": bk.price, "max_price": bk.price}, explain=True
+        )
+        assert code == 200
+        assert bk.id in [b["id"] for b in data["books"]]
+        assert all(b["price"] == bk.price for b in data["books"])
+        assert data["plan"]["collscan"] is False
+
+    def test_search_store_prefilter(self):
+        # 店铺内关键词搜索先取出店铺上架的书目，只返回该店铺的记录
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, explain=True)
+        assert code == 200
+        assert data["plan"]["prefilter"] is True
+        assert self.books[0].id in [bk["id"] for bk in data["books"]]
+        assert all(bk["belong_store_id"] == self.store_id for bk in data["books"])
+
+    def test_search_facets(self):
+        # 查询时分面只统计匹配的记录
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, facets=True)
+        assert code == 200
+        counted = sum(entry["count"] for entry in data["facets"]["price_bucket"])
+        assert counted == data["total"]
+
+        # 预先统计的分面计数包含该商店上架的全部书籍
+        code, message, data = buyer.facets(self.store_id)
+        assert code == 200
+        assert sum(entry["count"] for entry in data["facets"]["price_bucket"]) == len(self.books)
+        if self.books[0].publisher:
+            assert self.books[0].publisher in [entry["value"] for entry in data["facets"]["publisher"]]
+
+        code, message, data = buyer.facets(self.store_id + "_x")
+        assert code != 200
+
+    def test_search_grouped(self):
+        # 同一本书在两个商店上架，合并模式下只返回一条
+        bk = self.books[0]
+        code = self.seller.add_book(self.store_id_2, 10, bk)
+        assert code == 200
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = bk.title.split()[0]
+        code, message, data = buyer.search_global(keyword, 1, 100, grouped=True)
+        assert code == 200
+        ids = [b["id"] for b in data["books"]]
+        assert len(ids) == len(set(ids))
+        assert bk.id in ids
+        item = data["books"][ids.index(bk.id)]
+        assert self.store_id in item["store_ids"] and self.store_id_2 in item["store_ids"]
+        assert item["store_count"] == len(item["store_ids"])
+        assert item["total_stock"] >= 20
+        assert item["min_price"] <= bk.price
+
+    def test_search_compact_view(self):
+        # 精简视图不返回简介全文，改为关键词附近的摘要
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, view="compact")
+        assert code == 200
+        assert len(data["books"]) > 0
+        for item in data["books"]:
+            assert set(item) == {"id", "title", "author", "price", "belong_store_id", "snippet"}
+            assert "<em>" not in item["snippet"] or keyword.lower() in item["snippet"].lower()
+
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 10, view="tiny")
+        assert code == 400
+
+    def test_search_concurrent_identical(self):
+        # 并发的相同搜索合并执行，每个请求得到的结果与单独搜索一致
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(buyer.search_in_store(keyword, self.store_id, 1, 7)))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        code, message, data = buyer.search_in_store(keyword, self.store_id, 1, 7)
+        assert code == 200
+        assert [r[0] for r in results] == [200] * 8
+        assert all(r[2] == data for r in results)
+
+    def test_search_batch(self):
+        # 批量搜索的每一项与单独搜索的结果一致，参数错误只影响对应的一项
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        keyword = self.books[0].title.split()[0]
+        code, message, data = buyer.search_batch([
+            {"keyword": keyword, "limit": 5},
+            {"keyword": keyword, "store_id": self.store_id, "limit": 5},
+            {"page": 1},
+            {"keyword": keyword, "store_id": self.store_id + "_x"},
+        ])
+        assert code == 200
+        results = data["results"]
+        assert len(results) == 4
+        assert results[0]["data"] == buyer.search_global(keyword, 1, 5)[2]
+        assert results[1]["data"] == buyer.search_in_store(keyword, self.store_id, 1, 5)[2]
+        assert results[2]["code"] == 400
+        assert results[3]["code"] != 200
+
+        code, message, data = buyer.search_batch([])
+        assert code == 400
+
+    def test_suggest(self):
+        # 书名前缀补全
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        title = self.books[0].title
+        code, message, data = buyer.suggest(title[:4], 20)
+        assert code == 200
+        assert len(data["suggestions"]) <= 20
+        assert all(s["text"].lower().startswith(title[:4].lower()) for s in data["suggestions"])
+
+        code, message, data = buyer.suggest("", 10)
+        assert code == 400
+
+    def test_similar(self):
+        # 相似图书不包含该书本身，按相似度降序
+        buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
+        code, message, data = buyer.similar(self.books[0].id, 5)
+        assert code == 200
+        assert len(data["books"]) <= 5
+        assert self.books[0].id not in [bk["id"] for bk in data["books"]]
+        scores = [bk["score"] for bk in data["books"]]
+        assert scores == sorted(scores, reverse=True)
+
+        code, message, data = buyer.similar(self.books[0].id + "_x", 5)
+        assert code == 515
+
     def test_search_missing_parameters(self):
         # 缺少必要参数的测试
         buyer = Buyer(conf.URL, self.buyer_id, self.buyer_password)
@@ -0,0 +1,48 @@
+import time
+import pytest
+
+from be.model import store
+from be.model import token_cache
+from be.model.search_cache import SharedGenerations
+from fe.test import memory_db
+
+
+class TestTokenCache:
+    @pytest.fixture(autouse=True)
+    def pre_run_initialization(self, monkeypatch):
+        # 两个缓存共享内存数据库中的失效代号，模拟两个工作进程
+        self.db = memory_db.bookstore_db()
+        monkeypatch.setattr(store, "get_db", lambda: self.db)
+        self.first = token_cache.TokenCache(generations=SharedGenerations())
+        self.second = token_cache.TokenCache(generations=SharedGenerations())
+        self.expires_at = time.time() + 3600
+        yield
+
+    def validate(self, cache: token_cache.TokenCache, user_id: str, token: str):
+        # 与User.check_token相同：读取会话前取得代号
+        cache.put(user_id, token, self.expires_at, cache.snapshot_generation(user_id))
+
+    def test_hit(self):
+        self.validate(self.first, "u", "t")
+        assert self.first.get("u", "t")
+        assert not self.first.get("u", "other")
+        assert self.first.snapshot()["hits"] == 1
+        assert self.first.snapshot()["shared"]
+
+    def test_logout_in_other_process(self):
+        self.validate(self.first, "u", "t")
+        self.validate(self.first, "v", "t")
+        self.second.invalidate("u", "t")
+        assert not self.first.get("u", "t")
+        assert self.first.snapshot()["invalidated"] == 1
+        # 其他用户的条目不受影响
+        assert self.first.get("v", "t")
+
+    def test_invalidated_during_validation(self):
+        # 读取会话期间其他进程登出：写入的条目带着旧代号，下一次命中时失效
+        generation = self.first.snapshot_generation("u")
+        self.second.invalidate("u")
+        self.first.put("u", "t", self.expires_at, generation)
+        assert not self.first.get("u", "t")
+        self.validate(self.first, "u", "t")
+        assert self.first.get("u", "t")